@@ -0,0 +1,286 @@
+"""Local stand-in for the Azure OpenAI endpoints used by part_1, part_2 and data_load.
+
+Embeddings are deterministic hashed bag-of-words vectors, so similar texts get similar
+embeddings and retrieval behaves sensibly. Chat completions echo the words of the last
+user message, streamed token by token when requested. Latency and 429 responses are
+configurable so client retries and queueing show up in the measurements.
+
+Run standalone and point TI_OAI_ENDPOINT at it:
+    python fake_openai.py --port 8300 --latency-ms 200 --token-latency-ms 20
+"""
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+EMBEDDING_DIMENSIONS = 1536
+WORD_PATTERN = re.compile(r"\w+")
+
+
+@dataclass
+class FakeOpenAISettings:
+    # Time to first byte of chat completions and embeddings
+    latency_ms: float = 200.0
+    embedding_latency_ms: float = 50.0
+    # Delay between streamed completion tokens
+    token_latency_ms: float = 20.0
+    # Words per completion unless the request asks for fewer with max_tokens
+    completion_tokens: int = 64
+    # Share of requests answered with 429 Too Many Requests
+    error_rate: float = 0.0
+    retry_after_ms: int = 100
+    seed: int = 0
+
+
+def _feature(value: Any) -> tuple[int, float]:
+    digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+    index, sign = struct.unpack("<IxxxB", digest)
+    return index % EMBEDDING_DIMENSIONS, 1.0 if sign & 1 else -1.0
+
+
+def fake_embedding(value: str | list[int]) -> list[float]:
+    """Hashed bag-of-words (or bag-of-token-ids) embedding, normalized to unit length."""
+    features = WORD_PATTERN.findall(value.lower()) if isinstance(value, str) else value
+    vector = [0.0] * EMBEDDING_DIMENSIONS
+    for feature in features or [""]:
+        index, sign = _feature(feature)
+        vector[index] += sign
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def _message_text(messages: list[dict]) -> str:
+    for message in reversed(messages):
+        if message.get("role") != "user":
+            continue
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            return content
+        return " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return ""
+
+
+def fake_completion(messages: list[dict], n_tokens: int) -> list[str]:
+    """The words of the last user message, repeated or cut to n_tokens."""
+    words = WORD_PATTERN.findall(_message_text(messages)) or ["Arr"]
+    return [words[i % len(words)] for i in range(n_tokens)]
+
+
+def _count_prompt_tokens(messages: list[dict]) -> int:
+    # Roughly 4 characters per token, images are not counted
+    return sum(len(json.dumps(message.get("content", ""))) // 4 for message in messages)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeOpenAIServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: dict[str, str] | None = None) -> None:
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = self.path.split("?")[0]
+        settings = self.server.settings
+
+        self.server.count_request(path)
+        if self.server.should_fail():
+            self._send_json(
+                429,
+                {"error": {"code": "429", "message": "Rate limit exceeded (fake)"}},
+                {
+                    "retry-after-ms": str(settings.retry_after_ms),
+                    "retry-after": str(math.ceil(settings.retry_after_ms / 1000)),
+                },
+            )
+            return
+
+        if path.endswith("/embeddings"):
+            self._embeddings(body)
+        elif path.endswith("/chat/completions"):
+            self._chat_completions(body)
+        else:
+            self._send_json(404, {"error": {"code": "404", "message": f"Unknown path {path}"}})
+
+    def _embeddings(self, body: dict) -> None:
+        time.sleep(self.server.settings.embedding_latency_ms / 1000)
+        inputs = body["input"]
+        # A single string, a list of strings, a list of token ids or a list of lists of them
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        data = []
+        for i, value in enumerate(inputs):
+            embedding: Any = fake_embedding(value)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(struct.pack(f"<{len(embedding)}f", *embedding))
+                embedding = embedding.decode("ascii")
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        n_tokens = sum(
+            len(value) if isinstance(value, list) else len(WORD_PATTERN.findall(value))
+            for value in inputs
+        )
+        self._send_json(
+            200,
+            {
+                "object": "list",
+                "data": data,
+                "model": body.get("model", "text-embedding-ada-002"),
+                "usage": {"prompt_tokens": n_tokens, "total_tokens": n_tokens},
+            },
+        )
+
+    def _chat_completions(self, body: dict) -> None:
+        settings = self.server.settings
+        time.sleep(settings.latency_ms / 1000)
+        messages = body.get("messages", [])
+        n_tokens = min(body.get("max_tokens") or settings.completion_tokens, settings.completion_tokens)
+        tokens = fake_completion(messages, n_tokens)
+        usage = {
+            "prompt_tokens": _count_prompt_tokens(messages),
+            "completion_tokens": len(tokens),
+            "total_tokens": _count_prompt_tokens(messages) + len(tokens),
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = body.get("model", "gpt-4o")
+
+        if not body.get("stream"):
+            time.sleep(settings.token_latency_ms * len(tokens) / 1000)
+            self._send_json(
+                200,
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": " ".join(tokens)},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                },
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(choices: list[dict], **extra: Any) -> None:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": choices,
+                **extra,
+            }
+            self._send_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(settings.token_latency_ms / 1000)
+            delta = {"content": token if i == 0 else f" {token}"}
+            if i == 0:
+                delta["role"] = "assistant"
+            event([{"index": 0, "delta": delta, "finish_reason": None}])
+        event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if (body.get("stream_options") or {}).get("include_usage"):
+            event([], usage=usage)
+        self._send_chunk(b"data: [DONE]\n\n")
+        self._send_chunk(b"")
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], settings: FakeOpenAISettings) -> None:
+        super().__init__(address, FakeOpenAIHandler)
+        self.settings = settings
+        self.requests: dict[str, int] = {}
+        self._random = random.Random(settings.seed)
+        self._lock = threading.Lock()
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count_request(self, path: str) -> None:
+        kind = path.rsplit("/", 1)[-1]
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.settings.error_rate
+
+
+def start_fake_openai(
+    settings: FakeOpenAISettings, host: str = "127.0.0.1", port: int = 0
+) -> FakeOpenAIServer:
+    """Serve the fake endpoints from a background thread, port 0 picks a free port."""
+    server = FakeOpenAIServer((host, port), settings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_settings_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = FakeOpenAISettings()
+    parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms)
+    parser.add_argument("--embedding-latency-ms", type=float, default=defaults.embedding_latency_ms)
+    parser.add_argument("--token-latency-ms", type=float, default=defaults.token_latency_ms)
+    parser.add_argument("--completion-tokens", type=int, default=defaults.completion_tokens)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--retry-after-ms", type=int, default=defaults.retry_after_ms)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def settings_from_arguments(args: argparse.Namespace) -> FakeOpenAISettings:
+    return FakeOpenAISettings(
+        latency_ms=args.latency_ms,
+        embedding_latency_ms=args.embedding_latency_ms,
+        token_latency_ms=args.token_latency_ms,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        retry_after_ms=args.retry_after_ms,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8300)
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    server = FakeOpenAIServer((args.host, args.port), settings_from_arguments(args))
+    print(f"Fake OpenAI listening on {server.endpoint}")
+    server.serve_forever()
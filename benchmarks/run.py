@@ -0,0 +1,240 @@
+"""Offline benchmark suite for data_load, part_1 and part_2.
+
+Starts the fake OpenAI server and the Postgres/Redis of docker-compose.yaml, runs the
+bench scripts of each part against them and compares the tracked metrics with
+baseline.json. No baseline is committed, the numbers depend on the machine: record one
+with --update-baseline where the suite runs. Exits with 1 when a scenario fails, a tracked
+metric regresses or there is no baseline to compare with, unless --no-baseline is given.
+Run from the repository root with the requirements of all parts installed:
+    python benchmarks/run.py --update-baseline
+    python benchmarks/run.py
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+from fake_openai import add_settings_arguments, settings_from_arguments, start_fake_openai
+
+BENCHMARKS_DIR = Path(__file__).parent
+ROOT_DIR = BENCHMARKS_DIR.parent
+COMPOSE_FILE = BENCHMARKS_DIR / "docker-compose.yaml"
+BASELINE_FILE = BENCHMARKS_DIR / "baseline.json"
+RESULTS_DIR = BENCHMARKS_DIR / "results"
+
+
+@dataclass
+class Scenario:
+    name: str
+    part: str
+    args: list[str]
+    # Scripts without a --json option are timed as a whole
+    writes_json: bool = True
+
+
+# In order: each part's retrieval and chat scenarios need the data its loader wrote
+SCENARIOS = [
+    Scenario("data_load.indexing", "data_load", ["bench_indexing.py", "--scale", "20"]),
+    Scenario("data_load.ingestion", "data_load", ["bench_ingestion.py"]),
+    Scenario("part_2.retrieval", "part_2", ["bench_retrieval_concurrency.py"]),
+    Scenario("part_2.chat", "part_2", ["bench_chat.py"]),
+    Scenario("part_2.image_policy", "part_2", ["bench_image_policy.py"]),
+    Scenario("part_2.startup", "part_2", ["bench_startup.py"]),
+    Scenario("part_2.workers", "part_2", ["bench_workers.py", "--workers", "1", "2"]),
+    Scenario("part_2.rate_limit", "part_2", ["bench_rate_limit.py"]),
+    Scenario("part_2.metadata_filter", "part_2", ["bench_metadata_filter.py"]),
+    Scenario("part_1.load", "part_1", ["_get_text.py"], writes_json=False),
+    Scenario("part_1.retrieval", "part_1", ["bench_retrieval.py"]),
+    Scenario("part_1.chat", "part_1", ["bench_chat.py"]),
+]
+
+
+@dataclass
+class Tracked:
+    # "lower" or "higher" is better
+    better: str
+    # Allowed relative change before it counts as a regression
+    tolerance: float = 0.2
+    # Allowed absolute change on top, so millisecond-sized metrics are not flaky
+    slack: float = 0.0
+
+
+TRACKED_METRICS = {
+    "data_load.indexing.batched.docs_per_second": Tracked("higher"),
+    "data_load.ingestion.elements_per_second": Tracked("higher"),
+    "part_1.load.seconds": Tracked("lower", slack=1.0),
+    "part_1.retrieval.hybrid.mrr": Tracked("higher", tolerance=0.0),
+    "part_1.retrieval.hybrid.mean_latency_ms": Tracked("lower", slack=5.0),
+    "part_1.chat.c10.p50_ms": Tracked("lower", slack=50.0),
+    "part_1.chat.c10.p99_ms": Tracked("lower", tolerance=0.3, slack=100.0),
+    "part_1.chat.c50.p99_ms": Tracked("lower", tolerance=0.3, slack=100.0),
+    "part_1.chat.burst50.coalesce_ratio": Tracked("higher", tolerance=0.1),
+    "part_2.retrieval.async.c50.p95_ms": Tracked("lower", slack=20.0),
+    "part_2.retrieval.async.max_sessions_within_slo": Tracked("higher", tolerance=0.0),
+    "part_2.chat.c10.first_token.p50_ms": Tracked("lower", slack=50.0),
+    "part_2.chat.c10.full_answer.p99_ms": Tracked("lower", tolerance=0.3, slack=100.0),
+    "part_2.chat.c50.full_answer.p99_ms": Tracked("lower", tolerance=0.3, slack=100.0),
+    "part_2.chat.burst50.full_answer.p99_ms": Tracked("lower", tolerance=0.3, slack=100.0),
+    "part_2.chat.burst50.coalesce_ratio": Tracked("higher", tolerance=0.1),
+    "part_2.image_policy.image_tokens_saved": Tracked("higher", tolerance=0.0),
+    "part_2.image_policy.policy.full_answer.p50_ms": Tracked("lower", slack=50.0),
+    "part_2.workers.w2.speedup": Tracked("higher", tolerance=0.3),
+    "part_2.startup.server.ready_seconds": Tracked("lower", tolerance=0.3, slack=1.0),
+    "part_2.startup.first_answer_seconds": Tracked("lower", tolerance=0.3, slack=1.0),
+    "part_2.rate_limit.reserve20.chat.wait_p95_ms": Tracked("lower", slack=50.0),
+    "part_2.rate_limit.reserve20.batch.calls_per_minute": Tracked("higher"),
+    "part_2.metadata_filter.hybrid.file.p95_ms": Tracked("lower", slack=5.0),
+    "part_2.metadata_filter.hybrid.file.uses_index": Tracked("higher", tolerance=0.0),
+}
+
+
+def start_services() -> None:
+    subprocess.run(
+        ["docker", "compose", "-f", str(COMPOSE_FILE), "up", "-d", "--build", "--wait"],
+        check=True,
+    )
+
+
+def stop_services() -> None:
+    subprocess.run(["docker", "compose", "-f", str(COMPOSE_FILE), "down", "-v"], check=False)
+
+
+def run_scenario(scenario: Scenario, env: dict[str, str]) -> dict[str, float]:
+    print(f"==> {scenario.name}", flush=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = Path(tmp) / "metrics.json"
+        args = scenario.args + (["--json", str(json_path)] if scenario.writes_json else [])
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, *args], cwd=ROOT_DIR / scenario.part, env=env, check=True
+        )
+        if not scenario.writes_json:
+            return {"seconds": time.perf_counter() - start}
+        return json.loads(json_path.read_text())
+
+
+def find_regressions(results: dict[str, float], baseline: dict[str, float]) -> list[str]:
+    regressions = []
+    for name, tracked in TRACKED_METRICS.items():
+        if name not in results or name not in baseline:
+            continue
+        value, reference = results[name], baseline[name]
+        if tracked.better == "lower":
+            regressed = value > reference * (1 + tracked.tolerance) + tracked.slack
+        else:
+            regressed = value < reference * (1 - tracked.tolerance) - tracked.slack
+        if regressed:
+            regressions.append(f"{name}: {value:.2f} vs baseline {reference:.2f}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scenarios", nargs="+", help="Names or prefixes of the scenarios to run, e.g. part_1"
+    )
+    parser.add_argument(
+        "--no-services", action="store_true", help="Use already running Postgres and Redis"
+    )
+    parser.add_argument("--postgres-port", default="55432")
+    parser.add_argument("--redis-port", default="56379")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument(
+        "--no-baseline", action="store_true", help="Only record the results, do not compare them"
+    )
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    scenarios = [
+        scenario
+        for scenario in SCENARIOS
+        if not args.scenarios or any(scenario.name.startswith(s) for s in args.scenarios)
+    ]
+    fake_openai = start_fake_openai(settings_from_arguments(args))
+    env = {
+        **os.environ,
+        "TI_OAI_ENDPOINT": fake_openai.endpoint,
+        "TI_OAI_API_KEY": "fake",
+        # The parts import the shared package at the repository root, like their images do
+        "PYTHONPATH": os.pathsep.join(
+            filter(None, [str(ROOT_DIR), os.environ.get("PYTHONPATH")])
+        ),
+        "TI_POSTGRES_HOST": "127.0.0.1",
+        "TI_POSTGRES_PORT": args.postgres_port,
+        "TI_REDIS_URL": f"redis://127.0.0.1:{args.redis_port}",
+        "TI_REPORTS_FOLDER": str(RESULTS_DIR),
+        # Keep the bench processes off the metrics port of running chatbots
+        "TI_METRICS_PORT": "0",
+        # Limits the fake server never reaches, so the load scenarios are not shed
+        "TI_LLM_RATE_LIMITS": json.dumps(
+            {
+                deployment: [1_000_000, 1_000_000_000]
+                for deployment in ("gpt-4o", "gpt-4", "text-embedding-ada-002")
+            }
+        ),
+    }
+
+    if not args.no_services:
+        start_services()
+    results: dict[str, float] = {}
+    failed = []
+    try:
+        for scenario in scenarios:
+            try:
+                metrics = run_scenario(scenario, env)
+            except subprocess.CalledProcessError as e:
+                print(f"Scenario {scenario.name} failed with exit code {e.returncode}")
+                failed.append(scenario.name)
+                continue
+            results.update({f"{scenario.name}.{name}": value for name, value in metrics.items()})
+    finally:
+        if not args.no_services:
+            stop_services()
+        fake_openai.shutdown()
+
+    RESULTS_DIR.mkdir(exist_ok=True)
+    results_path = RESULTS_DIR / f"bench_{datetime.now().strftime('%Y%m%dT%H%M%S')}.json"
+    results_path.write_text(
+        json.dumps({"requests": fake_openai.requests, "metrics": results}, indent=2)
+    )
+    print(f"\nResults written to {results_path}")
+    for name in TRACKED_METRICS:
+        if name in results:
+            print(f"{name:<50} {results[name]:>10.2f}")
+
+    if args.update_baseline:
+        baseline = json.loads(BASELINE_FILE.read_text()) if BASELINE_FILE.exists() else {}
+        baseline.update({name: results[name] for name in TRACKED_METRICS if name in results})
+        BASELINE_FILE.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print(f"Baseline updated in {BASELINE_FILE}")
+    elif BASELINE_FILE.exists():
+        baseline = json.loads(BASELINE_FILE.read_text())
+        unchecked = [name for name in TRACKED_METRICS if name in results and name not in baseline]
+        if unchecked:
+            print(f"Not in the baseline, not checked: {', '.join(unchecked)}")
+        regressions = find_regressions(results, baseline)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    elif not args.no_baseline:
+        print(
+            f"No baseline at {BASELINE_FILE}, nothing was checked for regressions. Record one "
+            "with --update-baseline, or pass --no-baseline to only record the results"
+        )
+        return 1
+
+    if failed:
+        print(f"Failed scenarios: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
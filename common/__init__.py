@@ -0,0 +1 @@
+"""Code shared by part_1, part_2 and data_load, copied into each of their images."""
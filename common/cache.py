@@ -0,0 +1,213 @@
+import logging
+import threading
+import time
+from typing import Any
+
+import psycopg2
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+# The share of "hit" lookups is the hit rate of a namespace
+ANSWER_CACHE_LOOKUPS = Counter(
+    "answer_cache_lookups",
+    "Answer cache lookups by namespace and outcome (hit or miss)",
+    ["namespace", "outcome"],
+)
+
+ANSWER_CACHE_SAVED_SECONDS = Counter(
+    "answer_cache_latency_saved_seconds",
+    "Retrieval and completion time that answer cache hits avoided, estimated from misses",
+    ["namespace"],
+)
+
+# Cached answers are only served while their namespace's knowledge_version is unchanged.
+# part_1's _get_text.py calls invalidate_answer_cache, which bumps the version and drops
+# the rows, data_load bumps the version of the "multimodalrag" namespace on every ingestion.
+ANSWER_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS knowledge_version (
+    namespace varchar PRIMARY KEY,
+    version varchar NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS answer_cache (
+    id bigserial PRIMARY KEY,
+    namespace varchar NOT NULL,
+    question text NOT NULL,
+    embedding vector(1536) NOT NULL,
+    doc_ids text[] NOT NULL,
+    docs_version varchar NOT NULL,
+    answer text NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    last_hit_at timestamptz NOT NULL DEFAULT now(),
+    hits integer NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS answer_cache_embedding_idx
+    ON answer_cache USING hnsw (embedding vector_cosine_ops);
+"""
+
+LOOKUP_QUERY = """
+WITH candidate AS (
+    SELECT c.id, c.answer, c.doc_ids, 1 - (c.embedding <=> %(embedding)s::vector) AS similarity
+    FROM answer_cache c
+    JOIN knowledge_version v ON v.namespace = c.namespace AND v.version = c.docs_version
+    WHERE c.namespace = %(namespace)s
+      AND c.created_at > now() - %(ttl_seconds)s * interval '1 second'
+    ORDER BY c.embedding <=> %(embedding)s::vector
+    LIMIT 1
+)
+UPDATE answer_cache
+SET hits = answer_cache.hits + 1, last_hit_at = now()
+FROM candidate
+WHERE answer_cache.id = candidate.id AND candidate.similarity >= %(threshold)s
+RETURNING candidate.answer, candidate.doc_ids, candidate.similarity;
+"""
+
+# Entries are only written while a version exists, i.e. after the first ingestion.
+STORE_QUERY = """
+INSERT INTO answer_cache (namespace, question, embedding, doc_ids, docs_version, answer)
+SELECT %(namespace)s, %(question)s, %(embedding)s::vector, %(doc_ids)s, version, %(answer)s
+FROM knowledge_version
+WHERE namespace = %(namespace)s;
+"""
+
+# Expired entries go first, then the least recently used ones above max_entries.
+EVICT_QUERY = """
+DELETE FROM answer_cache
+WHERE namespace = %(namespace)s
+  AND (
+    created_at <= now() - %(ttl_seconds)s * interval '1 second'
+    OR id IN (
+        SELECT id FROM answer_cache
+        WHERE namespace = %(namespace)s
+        ORDER BY last_hit_at DESC
+        OFFSET %(max_entries)s
+    )
+  );
+"""
+
+INVALIDATE_QUERY = """
+INSERT INTO knowledge_version (namespace, version)
+VALUES (%(namespace)s, md5(random()::text || clock_timestamp()::text))
+ON CONFLICT (namespace) DO UPDATE
+SET version = EXCLUDED.version, updated_at = now();
+DELETE FROM answer_cache WHERE namespace = %(namespace)s;
+"""
+
+
+def invalidate_answer_cache(cur: Any, namespace: str) -> None:
+    """Mark the documents of a namespace as changed, dropping its cached answers."""
+    cur.execute(ANSWER_CACHE_SCHEMA)
+    cur.execute(INVALIDATE_QUERY, {"namespace": namespace})
+
+
+class SemanticCache:
+    """
+    Answer cache keyed by question embedding, backed by pgvector.
+    A cached answer is served when a new question is within similarity_threshold (cosine)
+    of a cached one and the namespace has not been re-ingested since it was stored.
+    Lookups and stores reuse up to pool_size connections, opened on first use.
+    Hits, misses and the latency the hits saved are exported as Prometheus counters.
+    """
+
+    def __init__(
+        self,
+        connection_params: dict[str, str],
+        namespace: str,
+        similarity_threshold: float = 0.95,
+        ttl_seconds: int = 24 * 60 * 60,
+        max_entries: int = 10_000,
+        pool_size: int = 10,
+    ) -> None:
+        self.connection_params = connection_params
+        # Idle connections, at most pool_size are open and callers wait for a free one
+        self._idle: list[Any] = []
+        self._pool_slots = threading.BoundedSemaphore(pool_size)
+        self._pool_lock = threading.Lock()
+        self.namespace = namespace
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        # Moving average of the retrieval + completion time that a hit avoids
+        self.miss_latency_seconds = 0.0
+        self._miss_latency_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connection(self) -> Any:
+        with self._pool_lock:
+            while self._idle:
+                conn = self._idle.pop()
+                if not conn.closed:
+                    return conn
+        return psycopg2.connect(**self.connection_params)
+
+    def _execute(self, query: str, params: dict[str, Any]) -> list[tuple]:
+        with self._pool_slots:
+            conn = self._connection()
+            try:
+                with conn.cursor() as cur:
+                    if not self._schema_ready:
+                        cur.execute(ANSWER_CACHE_SCHEMA)
+                        self._schema_ready = True
+                    cur.execute(query, params)
+                    rows = cur.fetchall() if cur.description else []
+                conn.commit()
+            except Exception:
+                # The connection may be broken, e.g. after a Postgres restart, it is not reused
+                conn.close()
+                raise
+            with self._pool_lock:
+                self._idle.append(conn)
+        return rows
+
+    def lookup(self, embedding: list[float]) -> tuple[str, list[str]] | None:
+        """Return (answer, doc_ids) of the closest valid cached question, if close enough."""
+        start = time.perf_counter()
+        rows = self._execute(
+            LOOKUP_QUERY,
+            {
+                "embedding": embedding,
+                "namespace": self.namespace,
+                "ttl_seconds": self.ttl_seconds,
+                "threshold": self.similarity_threshold,
+            },
+        )
+        if not rows:
+            ANSWER_CACHE_LOOKUPS.labels(self.namespace, "miss").inc()
+            return None
+
+        answer, doc_ids, similarity = rows[0]
+        saved_seconds = max(self.miss_latency_seconds - (time.perf_counter() - start), 0.0)
+        ANSWER_CACHE_LOOKUPS.labels(self.namespace, "hit").inc()
+        ANSWER_CACHE_SAVED_SECONDS.labels(self.namespace).inc(saved_seconds)
+        logger.info(f"Answer cache hit (similarity={similarity:.3f}, saved {saved_seconds:.1f}s)")
+        return answer, list(doc_ids)
+
+    def store(
+        self,
+        question: str,
+        embedding: list[float],
+        doc_ids: list[str],
+        answer: str,
+        latency_seconds: float,
+    ) -> None:
+        """Cache an answer produced in latency_seconds and evict expired or surplus entries."""
+        with self._miss_latency_lock:
+            if self.miss_latency_seconds:
+                self.miss_latency_seconds = (
+                    0.9 * self.miss_latency_seconds + 0.1 * latency_seconds
+                )
+            else:
+                self.miss_latency_seconds = latency_seconds
+
+        params = {
+            "namespace": self.namespace,
+            "question": question,
+            "embedding": embedding,
+            "doc_ids": doc_ids,
+            "answer": answer,
+            "ttl_seconds": self.ttl_seconds,
+            "max_entries": self.max_entries,
+        }
+        self._execute(STORE_QUERY + EVICT_QUERY, params)
@@ -0,0 +1,45 @@
+import math
+
+import tiktoken
+from common.ratelimit import RateLimiter
+from langchain_core.embeddings import Embeddings
+
+
+class RateLimitedEmbeddings(Embeddings):
+    """Embeddings whose calls to the deployment are admitted by the rate limiter first."""
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        rate_limiter: RateLimiter,
+        deployment: str = "text-embedding-ada-002",
+        chunk_size: int = 2048,
+    ) -> None:
+        self.embeddings = embeddings
+        self.rate_limiter = rate_limiter
+        self.deployment = deployment
+        # Texts per request of the underlying client
+        self.chunk_size = chunk_size
+        self.tiktoken_model = tiktoken.get_encoding("cl100k_base")
+
+    def _cost(self, texts: list[str]) -> tuple[int, int]:
+        tokens = sum(len(encoded) for encoded in self.tiktoken_model.encode_batch(texts))
+        return tokens, max(1, math.ceil(len(texts) / self.chunk_size))
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        tokens, requests = self._cost(texts)
+        self.rate_limiter.acquire(self.deployment, tokens, requests)
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        self.rate_limiter.acquire(self.deployment, *self._cost([text]))
+        return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        tokens, requests = self._cost(texts)
+        await self.rate_limiter.aacquire(self.deployment, tokens, requests)
+        return await self.embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        await self.rate_limiter.aacquire(self.deployment, *self._cost([text]))
+        return await self.embeddings.aembed_query(text)
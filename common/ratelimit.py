@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections.abc import Callable
+
+import redis
+import redis.asyncio
+
+logger = logging.getLogger(__name__)
+
+# Token buckets of one deployment, requests in KEYS[1] and tokens in KEYS[2], refilling at
+# their per-minute rate up to one minute of capacity. Batch requests leave ARGV[5] of each
+# bucket to interactive ones. Uses the Redis clock, so processes on other hosts agree.
+# Returns 0 when admitted, else the milliseconds until the request fits, -1 if it never can.
+ACQUIRE_SCRIPT = """
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+local rpm, tpm = tonumber(ARGV[1]), tonumber(ARGV[2])
+local requests, tokens, reserve = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+if requests > rpm * (1 - reserve) or tokens > tpm * (1 - reserve) then
+    return -1
+end
+local function level(key, capacity)
+    local state = redis.call('HMGET', key, 'level', 'at')
+    local value, at = tonumber(state[1]), tonumber(state[2])
+    if value == nil then
+        return capacity
+    end
+    return math.min(capacity, value + (now - at) * capacity / 60000)
+end
+local request_level, token_level = level(KEYS[1], rpm), level(KEYS[2], tpm)
+local request_need, token_need = requests + reserve * rpm, tokens + reserve * tpm
+if request_level >= request_need and token_level >= token_need then
+    redis.call('HSET', KEYS[1], 'level', request_level - requests, 'at', now)
+    redis.call('HSET', KEYS[2], 'level', token_level - tokens, 'at', now)
+    redis.call('PEXPIRE', KEYS[1], 120000)
+    redis.call('PEXPIRE', KEYS[2], 120000)
+    return 0
+end
+return math.ceil(math.max(
+    (request_need - request_level) * 60000 / rpm,
+    (token_need - token_level) * 60000 / tpm
+))
+"""
+
+
+class RateLimitExceeded(Exception):
+    """The deployment has no capacity for the call within the time it may wait."""
+
+
+class RateLimiter:
+    """
+    Admission control for the Azure OpenAI deployments, modelled as token buckets of their
+    requests and tokens per minute that part_1, part_2 and data_load share through Redis.
+    Like Azure, a call is charged its prompt tokens plus the completion tokens it may use
+    when it is sent. A call waits for capacity up to max_wait_seconds and is rejected with
+    RateLimitExceeded as soon as the wait would be longer. Batch callers only use what
+    is left above reserve of each bucket, so interactive calls get through first.
+    Without Redis, or for deployments without limits, calls are not limited.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        async_client: redis.asyncio.Redis | None,
+        limits: dict[str, tuple[int, int]],
+        priority: str,
+        max_wait_seconds: float,
+        reserve: float = 0.0,
+        namespace: str = "ratelimit",
+        observe_wait: Callable[[str, str, float], None] | None = None,
+        observe_shed: Callable[[str, str], None] | None = None,
+    ) -> None:
+        self.limits = limits
+        self.priority = priority
+        self.max_wait_seconds = max_wait_seconds
+        self.reserve = reserve
+        self.namespace = namespace
+        # Called with (deployment, priority[, seconds waited]), e.g. to export metrics
+        self.observe_wait = observe_wait
+        self.observe_shed = observe_shed
+        self._script = client.register_script(ACQUIRE_SCRIPT)
+        self._async_script = (
+            async_client.register_script(ACQUIRE_SCRIPT) if async_client is not None else None
+        )
+        # Totals of the process, e.g. for the ingestion report
+        self.admitted = 0
+        self.shed = 0
+        self.waited_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def counts(self) -> dict[str, float]:
+        with self._lock:
+            return {
+                "admitted": self.admitted,
+                "shed": self.shed,
+                "waited_seconds": self.waited_seconds,
+            }
+
+    def _args(self, deployment: str, tokens: int, requests: int) -> dict | None:
+        if deployment not in self.limits:
+            return None
+        rpm, tpm = self.limits[deployment]
+        key = f"{self.namespace}/{deployment}"
+        return {
+            "keys": [f"{key}/requests", f"{key}/tokens"],
+            "args": [rpm, tpm, requests, tokens, self.reserve],
+        }
+
+    def _admitted(self, deployment: str, waited: float) -> float:
+        with self._lock:
+            self.admitted += 1
+            self.waited_seconds += waited
+        if self.observe_wait is not None:
+            self.observe_wait(deployment, self.priority, waited)
+        return waited
+
+    def _next_sleep(self, deployment: str, tokens: int, wait_ms: int, deadline: float) -> float:
+        """Seconds to sleep before trying again, or raise if the call has to be shed."""
+        if wait_ms < 0 or time.monotonic() + wait_ms / 1000 > deadline:
+            with self._lock:
+                self.shed += 1
+            if self.observe_shed is not None:
+                self.observe_shed(deployment, self.priority)
+            reason = (
+                "more than the deployment's capacity"
+                if wait_ms < 0
+                else f"{self.max_wait_seconds:g} s of waiting exceeded"
+            )
+            raise RateLimitExceeded(
+                f"{deployment} cannot take a call of {tokens} tokens ({self.priority}): {reason}"
+            )
+        # Jitter, so the callers woken together do not all try again at once
+        return min(wait_ms / 1000 * random.uniform(1.0, 1.2), deadline - time.monotonic())
+
+    def acquire(self, deployment: str, tokens: int, requests: int = 1) -> float:
+        """Wait until the deployment can take the call, returns the seconds waited.
+        Blocks the calling thread, async code uses aacquire."""
+        script_args = self._args(deployment, tokens, requests)
+        if script_args is None:
+            return 0.0
+        start = time.monotonic()
+        deadline = start + self.max_wait_seconds
+        while True:
+            try:
+                wait_ms = self._script(**script_args)
+            except redis.RedisError as e:
+                logger.warning(f"Rate limiter unavailable, {deployment} call not limited: {e}")
+                return 0.0
+            if wait_ms == 0:
+                return self._admitted(deployment, time.monotonic() - start)
+            time.sleep(self._next_sleep(deployment, tokens, wait_ms, deadline))
+
+    async def aacquire(self, deployment: str, tokens: int, requests: int = 1) -> float:
+        """Like acquire, waiting without blocking the event loop."""
+        if self._async_script is None:
+            return await asyncio.to_thread(self.acquire, deployment, tokens, requests)
+        script_args = self._args(deployment, tokens, requests)
+        if script_args is None:
+            return 0.0
+        start = time.monotonic()
+        deadline = start + self.max_wait_seconds
+        while True:
+            try:
+                wait_ms = await self._async_script(**script_args)
+            except redis.RedisError as e:
+                logger.warning(f"Rate limiter unavailable, {deployment} call not limited: {e}")
+                return 0.0
+            if wait_ms == 0:
+                return self._admitted(deployment, time.monotonic() - start)
+            await asyncio.sleep(self._next_sleep(deployment, tokens, wait_ms, deadline))
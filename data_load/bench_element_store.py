@@ -0,0 +1,112 @@
+"""Load time and disk footprint of the element store vs the former JSON folder layout.
+
+Writes a synthetic corpus in the former layout (pretty-printed texts.json/tables.json and
+loose images per file), packs it into an element store and measures the bytes on disk,
+loading every file, and reading single elements by id. Needs no services:
+    python3 bench_element_store.py --files 200
+"""
+import argparse
+import base64
+import json
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from bench_ingestion import write_processed_data
+from element_store import ElementStore
+from PIL import Image
+
+
+def json_load_file_data(folder_path: Path) -> tuple[list[str], list[str], list[tuple]]:
+    """The former loader: parse the whole JSON files and open every image."""
+    texts, tables, images = [], [], []
+    if (folder_path / "texts.json").exists():
+        texts = json.loads((folder_path / "texts.json").read_text(encoding="utf-8"))
+    if (folder_path / "tables.json").exists():
+        tables = json.loads((folder_path / "tables.json").read_text(encoding="utf-8"))
+    for img_file in (folder_path / "images").iterdir():
+        img_base64 = base64.b64encode(img_file.read_bytes()).decode("utf-8")
+        images.append((img_file.name, img_base64, Image.open(img_file).format.lower()))
+    return texts, tables, images
+
+
+def _disk_bytes(paths: list[Path]) -> int:
+    # Allocated blocks, small files take a whole block each
+    return sum(path.stat().st_blocks * 512 for path in paths if path.is_file())
+
+
+def run_benchmark(files: int, lookups: int) -> dict[str, float]:
+    metrics: dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        json_folder, store_folder = Path(tmp) / "json", Path(tmp) / "store"
+        elements = write_processed_data(json_folder, files, texts=40, tables=5, images=5)
+        folders = sorted(json_folder.iterdir())
+        for folder in folders:
+            # extract_data wrote the JSON files pretty-printed
+            for kind in ("texts", "tables"):
+                path = folder / f"{kind}.json"
+                path.write_text(json.dumps(json.loads(path.read_text()), indent=4))
+        store = ElementStore(store_folder)
+        for folder in folders:
+            store.import_json_folder(folder)
+
+        metrics["json.bytes"] = _disk_bytes(list(json_folder.rglob("*")))
+        metrics["store.bytes"] = _disk_bytes([store.segment_path, store.index_path])
+        metrics["json.text_bytes"] = _disk_bytes(
+            [folder / f"{kind}.json" for folder in folders for kind in ("texts", "tables")]
+        )
+        metrics["store.text_bytes"] = sum(
+            record.length
+            for file_name in store.file_names()
+            for record in store.records(file_name)
+            if record.kind != "images"
+        ) + store.index_path.stat().st_size
+
+        start = time.perf_counter()
+        for folder in folders:
+            json_load_file_data(folder)
+        metrics["json.load_all_seconds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store = ElementStore(store_folder)
+        metrics["store.open_seconds"] = time.perf_counter() - start
+        for file_name in store.file_names():
+            store.load_file_data(file_name)
+        metrics["store.load_all_seconds"] = time.perf_counter() - start
+
+        # One text element of a random file, by the file and position in the former layout
+        rng = random.Random(0)
+        targets = [rng.randrange(files) for _ in range(lookups)]
+        start = time.perf_counter()
+        for i in targets:
+            texts = json.loads((folders[i] / "texts.json").read_text(encoding="utf-8"))
+            _ = texts[len(texts) // 2]
+        metrics["json.lookup_ms"] = (time.perf_counter() - start) / lookups * 1000
+
+        ids = [store.records(folders[i].name, "texts")[20].id for i in targets]
+        start = time.perf_counter()
+        for element_id in ids:
+            store.get(element_id).decode("utf-8")
+        metrics["store.lookup_ms"] = (time.perf_counter() - start) / lookups * 1000
+
+    print(f"{files} files, {elements} elements")
+    for layout in ("json", "store"):
+        print(
+            f"{layout:>5}: {metrics[f'{layout}.bytes'] / 2**20:.1f} MB on disk "
+            f"({metrics[f'{layout}.text_bytes'] / 2**20:.2f} MB without images), "
+            f"load all {metrics[f'{layout}.load_all_seconds']:.2f} s, "
+            f"one element {metrics[f'{layout}.lookup_ms']:.3f} ms"
+        )
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--lookups", type=int, default=1000)
+    parser.add_argument("--json", type=Path, help="Write the metrics to this file")
+    args = parser.parse_args()
+    metrics = run_benchmark(args.files, args.lookups)
+    if args.json:
+        args.json.write_text(json.dumps(metrics, indent=2))
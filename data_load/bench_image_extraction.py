@@ -0,0 +1,134 @@
+"""Image extraction of large docx/pptx: python-docx/python-pptx vs streaming the zip.
+
+Builds a deck with one distinct photo per slide plus a logo repeated on every slide, and
+a document with the same pictures, then extracts their images both ways and reports the
+wall time and the peak Python memory. Run in the data_load container:
+    python3 bench_image_extraction.py --slides 200
+"""
+import argparse
+import io
+import json
+import random
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable
+from pathlib import Path
+
+from docx import Document
+from docx.shared import Inches
+from extract_data import ooxml_extract_images
+from PIL import Image, ImageDraw
+from pptx import Presentation
+from pptx.util import Inches as PptxInches
+
+
+def python_docx_extract_images(doc_path: Path, images_folder: Path) -> list:
+    """The former extraction: parse the document and copy every blob through memory."""
+    doc = Document(doc_path)
+    images = []
+    for i, rel in enumerate(rel for rel in doc.part.rels.values() if "image" in rel.target_ref):
+        image_path = images_folder / f"{doc_path.stem}_image{i}.jpg"
+        image_path.write_bytes(rel.target_part.blob)
+        images.append(str(image_path))
+    return images
+
+
+def python_pptx_extract_images(pptx_path: Path, images_folder: Path) -> list:
+    """The former extraction: parse the deck and copy every shape's blob through memory."""
+    prs = Presentation(pptx_path)
+    images = []
+    for slide in prs.slides:
+        for shape in slide.shapes:
+            if hasattr(shape, "image"):
+                name = f"{pptx_path.stem}_image{len(images)}.{shape.image.ext}"
+                image_path = images_folder / name
+                image_path.write_bytes(shape.image.blob)
+                images.append(str(image_path))
+    return images
+
+
+def _photo(rng: random.Random, size: tuple[int, int]) -> io.BytesIO:
+    image = Image.effect_noise(size, 40).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(20):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x, y, x + rng.randrange(50, 400), y + rng.randrange(50, 400)), fill=color)
+    stream = io.BytesIO()
+    image.save(stream, "JPEG", quality=90)
+    stream.seek(0)
+    return stream
+
+
+def write_documents(folder: Path, slides: int, seed: int = 0) -> tuple[Path, Path]:
+    """A pptx and a docx with one photo per slide or page and a repeated logo."""
+    rng = random.Random(seed)
+    logo = io.BytesIO()
+    Image.new("RGB", (400, 120), (200, 30, 30)).save(logo, "PNG")
+    photos = [_photo(rng, (1920, 1080)) for _ in range(slides)]
+
+    prs = Presentation()
+    for photo in photos:
+        slide = prs.slides.add_slide(prs.slide_layouts[6])
+        slide.shapes.add_picture(photo, PptxInches(0.5), PptxInches(1), width=PptxInches(9))
+        logo.seek(0)
+        slide.shapes.add_picture(logo, PptxInches(0.2), PptxInches(0.2), width=PptxInches(1))
+    pptx_path = folder / "deck.pptx"
+    prs.save(pptx_path)
+
+    doc = Document()
+    for photo in photos:
+        photo.seek(0)
+        logo.seek(0)
+        doc.add_picture(logo, width=Inches(1))
+        doc.add_picture(photo, width=Inches(6))
+        doc.add_page_break()
+    docx_path = folder / "document.docx"
+    doc.save(docx_path)
+    return pptx_path, docx_path
+
+
+def measure(extract: Callable[[Path, Path], list], path: Path, images_folder: Path) -> dict:
+    images_folder.mkdir(parents=True)
+    tracemalloc.start()
+    start = time.perf_counter()
+    images = extract(path, images_folder)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": seconds, "peak_mb": peak / 2**20, "images": len(images)}
+
+
+def run_benchmark(slides: int) -> dict[str, float]:
+    metrics: dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        pptx_path, docx_path = write_documents(Path(tmp), slides)
+        print(
+            f"Deck {pptx_path.stat().st_size / 2**20:.0f} MB, "
+            f"document {docx_path.stat().st_size / 2**20:.0f} MB, {slides} photos each"
+        )
+        runs = [
+            ("pptx.python_pptx", python_pptx_extract_images, pptx_path),
+            ("pptx.streamed", ooxml_extract_images, pptx_path),
+            ("docx.python_docx", python_docx_extract_images, docx_path),
+            ("docx.streamed", ooxml_extract_images, docx_path),
+        ]
+        for name, extract, path in runs:
+            result = measure(extract, path, Path(tmp) / name)
+            print(
+                f"{name:>17}: {result['seconds']:.2f} s, peak {result['peak_mb']:.1f} MB, "
+                f"{result['images']} images written"
+            )
+            metrics.update({f"{name}.{key}": value for key, value in result.items()})
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--slides", type=int, default=200)
+    parser.add_argument("--json", type=Path, help="Write the metrics to this file")
+    args = parser.parse_args()
+    metrics = run_benchmark(args.slides)
+    if args.json:
+        args.json.write_text(json.dumps(metrics, indent=2))
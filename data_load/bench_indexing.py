@@ -0,0 +1,114 @@
+"""Indexing throughput, per-file add_documents vs the batched COPY indexer.
+
+Indexes one processed file of the element store copied --scale times under different file
+names, by default the London brochure if it was extracted, otherwise a synthetic document.
+Summaries are the contents themselves so no chat completions are made, embeddings are.
+Replaces the knowledge_base collection. Run in the data_load container:
+    python3 bench_indexing.py --scale 100
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from bench_ingestion import write_processed_data
+from checkpoint import IngestionCheckpoint, document_id
+from config import Config
+from element_store import ElementStore
+from indexer import BatchIndexer, IndexRow
+from ingest_multimodal_data import (
+    add_documents,
+    create_docstore,
+    create_embeddings,
+    create_vectorstore,
+    reset_stores,
+)
+
+config = Config()
+
+
+def load_elements(store: ElementStore, file_name: str) -> dict[str, list[tuple[str, str]]]:
+    """(summary, content) pairs of the processed file by content type."""
+    texts, tables, images = store.load_file_data(file_name)
+    return {
+        "texts": [(text[:1000], text) for text in texts],
+        "tables": [(table[:1000], table) for table in tables],
+        "images": [(f"Image {name} of the document", b64) for name, b64, _ in images],
+    }
+
+
+def run_benchmark(store: ElementStore, file_name: str, scale: int) -> dict[str, float]:
+    elements = load_elements(store, file_name)
+    file_names = [f"{file_name}_{i}" for i in range(scale)]
+    n_docs = scale * sum(len(pairs) for pairs in elements.values())
+
+    embeddings = create_embeddings()
+    vectorstore = create_vectorstore(embeddings)
+    docstore = create_docstore()
+    checkpoint = IngestionCheckpoint(vectorstore)
+    metrics: dict[str, float] = {}
+
+    reset_stores(vectorstore, docstore)
+    start = time.perf_counter()
+    for file_name in file_names:
+        for pairs in elements.values():
+            if pairs:
+                summaries, contents = zip(*pairs, strict=True)
+                add_documents(vectorstore, docstore, list(summaries), list(contents), file_name)
+    metrics["per_file.docs_per_second"] = n_docs / (time.perf_counter() - start)
+
+    reset_stores(vectorstore, docstore)
+    checkpoint.clear()
+    indexer = BatchIndexer(
+        vectorstore,
+        docstore,
+        embeddings,
+        checkpoint,
+        max_tokens=config.EMBED_BATCH_TOKENS,
+        max_inputs=config.EMBED_BATCH_SIZE,
+    )
+    start = time.perf_counter()
+    for file_name in file_names:
+        indexer.add(
+            [
+                IndexRow(
+                    file_name, kind, i, document_id(file_name, kind, content), summary, content
+                )
+                for kind, pairs in elements.items()
+                for i, (summary, content) in enumerate(pairs)
+            ]
+        )
+    indexer.flush()
+    metrics["batched.docs_per_second"] = n_docs / (time.perf_counter() - start)
+    metrics["batched.batches"] = indexer.batches
+    metrics["speedup"] = metrics["batched.docs_per_second"] / metrics["per_file.docs_per_second"]
+
+    print(
+        f"{n_docs} documents: per file {metrics['per_file.docs_per_second']:.1f} docs/s, "
+        f"batched {metrics['batched.docs_per_second']:.1f} docs/s in {indexer.batches} batches "
+        f"({metrics['speedup']:.1f}x)"
+    )
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--file",
+        default="1_London_Brochure",
+        help="Processed file of the element store to index",
+    )
+    parser.add_argument("--scale", type=int, default=100)
+    parser.add_argument("--json", type=Path, help="Write the metrics to this file")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        store, file_name = ElementStore(config.PROCESSED_DATA_FOLDER), args.file
+        if not store.has_file(file_name):
+            print(f"{file_name} was not extracted, indexing a synthetic document instead")
+            write_processed_data(Path(tmp), files=1, texts=40, tables=5, images=5)
+            store = ElementStore(Path(tmp) / "store")
+            file_name = store.import_json_folder(Path(tmp) / "document_0")[0].file
+        metrics = run_benchmark(store, file_name, args.scale)
+    if args.json:
+        args.json.write_text(json.dumps(metrics, indent=2))
@@ -0,0 +1,101 @@
+"""Ingestion throughput of the ingestion pipeline on synthetic processed data.
+
+Writes texts, tables and images to an element store, as extract_data does, ingests them into
+the configured Postgres and Redis (replacing the knowledge_base collection) and reports
+elements per second next to the per-stage run report. Run in the data_load container:
+    python3 bench_ingestion.py --files 5 --texts 40 --tables 5 --images 5
+"""
+import argparse
+import json
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from config import Config
+from element_store import ElementStore
+from PIL import Image
+from pipeline import run_ingestion_pipeline
+from profiling import run_report
+
+config = Config()
+
+WORDS = (
+    "London Thames bridge museum gallery tower palace square fountain ferry ticket "
+    "cabin deck harbour route booking departure arrival timetable price family "
+    "restaurant breakfast theatre market park underground bus train station map"
+).split()
+
+
+def _sentence(rng: random.Random, n_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + "."
+
+
+def write_processed_data(
+    folder: Path, files: int, texts: int, tables: int, images: int, seed: int = 0
+) -> int:
+    """
+    Write synthetic processed documents in the former JSON layout, one folder per file,
+    and return the number of elements
+    """
+    rng = random.Random(seed)
+    for i in range(files):
+        file_folder = folder / f"document_{i}"
+        (file_folder / "images").mkdir(parents=True)
+        file_texts = [" ".join(_sentence(rng, 15) for _ in range(8)) for _ in range(texts)]
+        file_tables = [
+            "<table>"
+            + "".join(
+                f"<tr><td>{rng.choice(WORDS)}</td><td>{rng.randint(1, 500)}</td></tr>"
+                for _ in range(10)
+            )
+            + "</table>"
+            for _ in range(tables)
+        ]
+        (file_folder / "texts.json").write_text(json.dumps(file_texts), encoding="utf-8")
+        (file_folder / "tables.json").write_text(json.dumps(file_tables), encoding="utf-8")
+        for j in range(images):
+            image = Image.effect_noise((256, 256), 64 + 8 * j).convert("RGB")
+            image.save(file_folder / "images" / f"document_{i}_image{j}.png")
+    return files * (texts + tables + images)
+
+
+def run_benchmark(files: int, texts: int, tables: int, images: int) -> dict[str, float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        elements = write_processed_data(Path(tmp), files, texts, tables, images)
+        store = ElementStore(Path(tmp) / "store")
+        for folder in sorted(Path(tmp).glob("document_*")):
+            store.import_json_folder(folder)
+        start = time.perf_counter()
+        # Rebuild, otherwise the checkpoints of an earlier run would be resumed
+        run_ingestion_pipeline(store.file_names(), store, rebuild=True)
+        elapsed = time.perf_counter() - start
+
+    report = run_report.to_dict()
+    metrics: dict[str, float] = {
+        "seconds": elapsed,
+        "elements_per_second": elements / elapsed,
+        "peak_rss_mb": report["peak_rss_mb"],
+    }
+    for stage, stats in report["stages"].items():
+        metrics[f"{stage}.wall_seconds"] = stats["wall_seconds"]
+    for stage, throughput in report.get("pipeline", {}).items():
+        metrics[f"pipeline.{stage}.files_per_second"] = throughput["items_per_second"]
+    summary = ", ".join(f"{name}={value:.2f}" for name, value in metrics.items())
+    print(f"Ingested {elements} elements: {summary}")
+    report_path = run_report.write(config.REPORTS_FOLDER)
+    print(f"Ingestion report written to {report_path}")
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=5)
+    parser.add_argument("--texts", type=int, default=40, help="Text elements per file")
+    parser.add_argument("--tables", type=int, default=5, help="Tables per file")
+    parser.add_argument("--images", type=int, default=5, help="Images per file")
+    parser.add_argument("--json", type=Path, help="Write the metrics to this file")
+    args = parser.parse_args()
+    metrics = run_benchmark(args.files, args.texts, args.tables, args.images)
+    if args.json:
+        args.json.write_text(json.dumps(metrics, indent=2))
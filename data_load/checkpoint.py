@@ -0,0 +1,225 @@
+import hashlib
+import json
+import uuid
+from pathlib import Path
+
+from ingest_multimodal_data import ID_KEY
+from langchain_community.vectorstores import PGVector
+from sqlalchemy import bindparam, text
+
+CHECKPOINT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingestion_sources (
+    source varchar PRIMARY KEY,
+    sha256 varchar NOT NULL,
+    -- Name of the processed file in the element store
+    processed_folder varchar NOT NULL,
+    extracted_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS ingestion_items (
+    document_id varchar PRIMARY KEY,
+    file_name varchar NOT NULL,
+    kind varchar NOT NULL,
+    summary text,
+    embedding vector(1536),
+    indexed_at timestamptz,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS ingestion_images (
+    sha256 varchar PRIMARY KEY,
+    phash varchar(16) NOT NULL
+);
+"""
+
+SAVE_SUMMARY_QUERY = """
+INSERT INTO ingestion_items (document_id, file_name, kind, summary)
+VALUES (:document_id, :file_name, :kind, :summary)
+ON CONFLICT (document_id) DO UPDATE
+SET summary = EXCLUDED.summary, updated_at = now();
+"""
+
+# One statement for a whole batch, executemany would be a round trip per row
+SAVE_EMBEDDINGS_QUERY = """
+UPDATE ingestion_items i
+SET embedding = CAST(v.embedding AS vector), updated_at = now()
+FROM unnest(CAST(:document_ids AS varchar[]), CAST(:embeddings AS text[]))
+    AS v(document_id, embedding)
+WHERE i.document_id = v.document_id;
+"""
+
+# Removes the documents of files that are no longer part of the ingested data and returns
+# their docstore keys. Documents indexed before stable ids existed have a random custom_id,
+# their docstore key is the document id in their metadata.
+PRUNE_QUERY = """
+DELETE FROM langchain_pg_embedding e
+USING langchain_pg_collection c
+WHERE e.collection_id = c.uuid
+  AND c.name = :collection_name
+  AND NOT (e.custom_id = ANY(:document_ids))
+RETURNING coalesce(e.cmetadata ->> CAST(:id_key AS text), e.custom_id);
+"""
+
+
+def document_id(file_name: str, kind: str, content: str) -> str:
+    """
+    Stable id of an element, so a re-run indexes it under the same id
+    """
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{file_name}/{kind}/{content_hash}"))
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestionCheckpoint:
+    """
+    Durable progress of the ingestion in Postgres, next to the index it builds.
+    Sources are checkpointed once extracted, elements once summarized, embedded and
+    indexed, so a restarted run skips the work, and the API calls, already done.
+    """
+
+    def __init__(self, vectorstore: PGVector) -> None:
+        self.vectorstore = vectorstore
+        with vectorstore._make_session() as session:
+            session.execute(text(CHECKPOINT_SCHEMA))
+            session.commit()
+
+    def clear(self) -> None:
+        with self.vectorstore._make_session() as session:
+            session.execute(text("TRUNCATE ingestion_sources, ingestion_items, ingestion_images"))
+            session.commit()
+
+    def progress(self) -> dict[str, int]:
+        with self.vectorstore._make_session() as session:
+            row = session.execute(
+                text(
+                    "SELECT count(*), count(summary), count(embedding), count(indexed_at) "
+                    "FROM ingestion_items"
+                )
+            ).one()
+        return dict(zip(("items", "summarized", "embedded", "indexed"), row, strict=True))
+
+    def extracted_file(self, source: Path) -> str | None:
+        """Processed file name of the source if it was extracted from the same content."""
+        with self.vectorstore._make_session() as session:
+            row = session.execute(
+                text(
+                    "SELECT processed_folder FROM ingestion_sources "
+                    "WHERE source = :source AND sha256 = :sha256"
+                ),
+                {"source": str(source), "sha256": file_sha256(source)},
+            ).first()
+        # Rows of the former folder layout hold the path of the folder named after the file
+        return Path(row[0]).name if row is not None else None
+
+    def save_extracted(self, source: Path, file_name: str) -> None:
+        with self.vectorstore._make_session() as session:
+            session.execute(
+                text(
+                    "INSERT INTO ingestion_sources (source, sha256, processed_folder) "
+                    "VALUES (:source, :sha256, :processed_folder) "
+                    "ON CONFLICT (source) DO UPDATE SET sha256 = EXCLUDED.sha256, "
+                    "processed_folder = EXCLUDED.processed_folder, extracted_at = now()"
+                ),
+                {
+                    "source": str(source),
+                    "sha256": file_sha256(source),
+                    "processed_folder": file_name,
+                },
+            )
+            session.commit()
+
+    def load(self, document_ids: list[str]) -> dict[str, dict]:
+        """Checkpointed summary, embedding and indexed flag of the given elements."""
+        if not document_ids:
+            return {}
+        with self.vectorstore._make_session() as session:
+            rows = session.execute(
+                text(
+                    "SELECT document_id, summary, embedding::text, indexed_at IS NOT NULL "
+                    "FROM ingestion_items WHERE document_id IN :document_ids"
+                ).bindparams(bindparam("document_ids", expanding=True)),
+                {"document_ids": document_ids},
+            ).all()
+        return {
+            doc_id: {
+                "summary": summary,
+                "embedding": json.loads(embedding) if embedding is not None else None,
+                "indexed": indexed,
+            }
+            for doc_id, summary, embedding, indexed in rows
+        }
+
+    def image_hashes(self) -> list[tuple[str, int]]:
+        """(sha256, perceptual hash) of the canonical images of earlier runs."""
+        with self.vectorstore._make_session() as session:
+            rows = session.execute(text("SELECT sha256, phash FROM ingestion_images")).all()
+        return [(sha256, int(phash, 16)) for sha256, phash in rows]
+
+    def save_image_hashes(self, hashes: list[tuple[str, int]]) -> None:
+        if not hashes:
+            return
+        with self.vectorstore._make_session() as session:
+            session.execute(
+                text(
+                    "INSERT INTO ingestion_images (sha256, phash) VALUES (:sha256, :phash) "
+                    "ON CONFLICT (sha256) DO NOTHING"
+                ),
+                [{"sha256": sha256, "phash": f"{phash:016x}"} for sha256, phash in hashes],
+            )
+            session.commit()
+
+    def save_summary(self, doc_id: str, file_name: str, kind: str, summary: str) -> None:
+        with self.vectorstore._make_session() as session:
+            session.execute(
+                text(SAVE_SUMMARY_QUERY),
+                {"document_id": doc_id, "file_name": file_name, "kind": kind, "summary": summary},
+            )
+            session.commit()
+
+    def save_embeddings(self, document_ids: list[str], embeddings: list[list[float]]) -> None:
+        with self.vectorstore._make_session() as session:
+            session.execute(
+                text(SAVE_EMBEDDINGS_QUERY),
+                {
+                    "document_ids": document_ids,
+                    "embeddings": [str(embedding) for embedding in embeddings],
+                },
+            )
+            session.commit()
+
+    def save_indexed(self, document_ids: list[str]) -> None:
+        with self.vectorstore._make_session() as session:
+            session.execute(
+                text(
+                    "UPDATE ingestion_items SET indexed_at = now(), updated_at = now() "
+                    "WHERE document_id IN :document_ids"
+                ).bindparams(bindparam("document_ids", expanding=True)),
+                {"document_ids": document_ids},
+            )
+            session.commit()
+
+    def prune(self, keep_document_ids: list[str]) -> list[str]:
+        """
+        Remove the checkpoints and indexed summaries of elements that are not in
+        keep_document_ids. Returns the docstore keys of the removed documents.
+        """
+        with self.vectorstore._make_session() as session:
+            removed = session.execute(
+                text(PRUNE_QUERY),
+                {
+                    "collection_name": self.vectorstore.collection_name,
+                    "document_ids": keep_document_ids,
+                    "id_key": ID_KEY,
+                },
+            ).scalars().all()
+            session.execute(
+                text("DELETE FROM ingestion_items WHERE NOT (document_id = ANY(:document_ids))"),
+                {"document_ids": keep_document_ids},
+            )
+            session.commit()
+        return list(dict.fromkeys(key for key in removed if key is not None))
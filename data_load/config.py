@@ -41,3 +41,44 @@ class Config(BaseSettings):
 
     RAW_DATA_FOLDER: Path = get_root_dir() / "data" / "Raw Data"
     PROCESSED_DATA_FOLDER: Path = get_root_dir() / "data" / "Processed Data"
+    REPORTS_FOLDER: Path = get_root_dir() / "data" / "Reports"
+
+    # Run the outermost stages under cProfile and dump the slowest one next to the report
+    PROFILE_SLOWEST_STAGE: bool = False
+
+    # Worker threads per ingestion pipeline stage and files buffered between stages
+    EXTRACT_WORKERS: int = 2
+    SUMMARIZE_WORKERS: int = 4
+    PIPELINE_QUEUE_SIZE: int = 2
+
+    # Summaries are embedded and indexed in batches of up to this many tokens or inputs,
+    # a partial batch is written when no file arrived for INDEX_FLUSH_SECONDS
+    EMBED_BATCH_TOKENS: int = 50_000
+    EMBED_BATCH_SIZE: int = 2048
+    INDEX_FLUSH_SECONDS: float = 5.0
+
+    # Discard the ingestion checkpoints and the index instead of resuming the last run
+    INGESTION_REBUILD: bool = False
+    # Version the indexed documents are tagged with for filtered retrieval, the start of
+    # the run if unset. Documents indexed before the tag existed need a rebuild to get it
+    INGESTION_VERSION: str | None = None
+
+    # Images smaller than IMAGE_MIN_SIDE pixels or with a grayscale entropy below
+    # IMAGE_MIN_ENTROPY bits are decorative and not indexed. Charts and diagrams are mostly
+    # background and score as low as 0.08 bits, only blank images fall below the default.
+    # Images whose perceptual hashes differ in at most IMAGE_PHASH_DISTANCE of 64 bits
+    # share one summary
+    IMAGE_MIN_SIDE: int = 64
+    IMAGE_MIN_ENTROPY: float = 0.02
+    IMAGE_PHASH_DISTANCE: int = 6
+
+    # (requests, tokens) per minute of each Azure OpenAI deployment, a budget shared by
+    # part_1, part_2 and data_load through this Redis database. Set it to the quotas of
+    # your deployments, e.g. TI_LLM_RATE_LIMITS='{"gpt-4o": [480, 80000]}'. Deployments
+    # not listed are not limited, so nothing is by default
+    LLM_RATE_LIMITS: dict[str, tuple[int, int]] = {}
+    RATE_LIMIT_REDIS_DB: int = 2
+    # Share of each budget batch ingestion leaves to chat, and how long a call of each
+    # priority may wait for capacity before it is rejected
+    RATE_LIMIT_BATCH_RESERVE: float = 0.2
+    RATE_LIMIT_MAX_WAIT_SECONDS: dict[str, float] = {"interactive": 10.0, "batch": 300.0}
@@ -0,0 +1,295 @@
+import base64
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+import uuid
+import zlib
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from PIL import Image, UnidentifiedImageError
+from profiling import run_report
+
+SEGMENT_FILE = "elements.seg"
+INDEX_FILE = "elements.idx"
+
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".webp", ".gif")
+
+# hi_res partitioning names the images of a PDF figure-<page>-<n>.jpg
+_PAGE_PATTERN = re.compile(r"-(\d+)-\d+\.\w+$")
+
+
+def describe_image(image_path: Path) -> dict:
+    """
+    Format and dimensions of an image, read from its header without decoding the pixels
+    Format is None for parts Pillow does not know, e.g. vector EMF/WMF drawings
+    """
+    try:
+        with Image.open(image_path) as img:
+            img_format, (width, height) = img.format.lower(), img.size
+    except (UnidentifiedImageError, OSError):
+        img_format, width, height = None, None, None
+    match = _PAGE_PATTERN.search(image_path.name)
+    return {
+        "name": image_path.name,
+        "format": img_format,
+        "width": width,
+        "height": height,
+        "page": int(match.group(1)) if match else None,
+    }
+
+
+@dataclass
+class ElementRecord:
+    id: str
+    # "texts", "tables" or "images"
+    kind: str
+    file: str
+    # Of the content, before compression
+    sha256: str
+    # Position of the content in the segment, zlib compressed utf-8 text or the image bytes
+    offset: int
+    length: int
+    source: str | None = None
+    page: int | None = None
+    compressed: bool = False
+    # Images only
+    name: str | None = None
+    format: str | None = None
+    width: int | None = None
+    height: int | None = None
+
+
+def _index_entry(record: ElementRecord) -> dict:
+    # Unset fields are left out, they are most of the fields of text elements
+    return {
+        key: value
+        for key, value in asdict(record).items()
+        if value is not None and value is not False
+    }
+
+
+class ElementStore:
+    """
+    Processed elements of the whole corpus in one append-only segment file, with an index
+    of one JSON line per processed file listing its elements' ids, types, pages, content
+    hashes and offsets. Texts and tables are zlib compressed, images are stored as is.
+    Readers memory-map the segment and only read the elements they ask for.
+    Writing a file again appends a new version, the last line of a file wins.
+    """
+
+    def __init__(self, folder: Path) -> None:
+        self.folder = folder
+        self.segment_path = folder / SEGMENT_FILE
+        self.index_path = folder / INDEX_FILE
+        folder.mkdir(parents=True, exist_ok=True)
+        self.segment_path.touch()
+        self.index_path.touch()
+        self._files: dict[str, list[ElementRecord]] = {}
+        self._by_id: dict[str, ElementRecord] = {}
+        self._index_position = 0
+        self._map: mmap.mmap | None = None
+        self._lock = threading.RLock()
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Read the index lines other processes appended since the last refresh."""
+        with self._lock, self.index_path.open("rb") as f:
+            f.seek(self._index_position)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Still being written
+                    break
+                self._index_position += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Left over by an interrupted writer
+                    continue
+                self._add_entry(entry)
+
+    def _add_entry(self, entry: dict) -> None:
+        records = [ElementRecord(**record) for record in entry["elements"]]
+        for record in self._files.get(entry["file"], []):
+            self._by_id.pop(record.id, None)
+        self._files[entry["file"]] = records
+        for record in records:
+            self._by_id[record.id] = record
+
+    def file_names(self) -> list[str]:
+        with self._lock:
+            return sorted(self._files)
+
+    def has_file(self, file_name: str) -> bool:
+        with self._lock:
+            return file_name in self._files
+
+    def records(self, file_name: str, kind: str | None = None) -> list[ElementRecord]:
+        with self._lock:
+            records = self._files.get(file_name, [])
+        return [record for record in records if kind is None or record.kind == kind]
+
+    def record(self, element_id: str) -> ElementRecord:
+        with self._lock:
+            return self._by_id[element_id]
+
+    def _read_stored(self, record: ElementRecord) -> bytes:
+        end = record.offset + record.length
+        with self._lock:
+            if self._map is None or len(self._map) < end:
+                # The segment grew since it was mapped
+                if self._map is not None:
+                    self._map.close()
+                with self.segment_path.open("rb") as f:
+                    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map[record.offset:end]
+
+    def read(self, record: ElementRecord) -> bytes:
+        """Content of an element, sliced from the memory-mapped segment."""
+        content = self._read_stored(record)
+        return zlib.decompress(content) if record.compressed else content
+
+    def get(self, element_id: str) -> bytes:
+        return self.read(self.record(element_id))
+
+    def load_file_data(
+        self, file_name: str
+    ) -> tuple[list[str], list[str], list[tuple[str, str, str]]]:
+        """
+        Texts, tables and (image_name, base64_string, image_format) images of a file,
+        in the shape the ingestion expects
+        """
+        texts: list[str] = []
+        tables: list[str] = []
+        images: list[tuple[str, str, str]] = []
+        with run_report.stage("load", file_name):
+            for record in self.records(file_name):
+                content = self.read(record)
+                if record.kind == "texts":
+                    texts.append(content.decode("utf-8"))
+                elif record.kind == "tables":
+                    tables.append(content.decode("utf-8"))
+                elif record.format is not None and record.name.lower().endswith(IMAGE_SUFFIXES):
+                    images.append(
+                        (record.name, base64.b64encode(content).decode("utf-8"), record.format)
+                    )
+        return texts, tables, images
+
+    def write_file(
+        self,
+        file_name: str,
+        elements: list[tuple[str, str | Path, dict]],
+        source: Path | None = None,
+    ) -> list[ElementRecord]:
+        """
+        Append the elements of a processed file, replacing its earlier version
+        elements: (kind, content, metadata) with a text, or the path of an image whose bytes
+        are streamed into the segment, and its page, name, format, width and height
+        """
+        with self._lock, self.segment_path.open("ab") as segment:
+            records = []
+            for kind, content, metadata in elements:
+                offset = segment.tell()
+                digest = hashlib.sha256()
+                if isinstance(content, Path):
+                    with content.open("rb") as f:
+                        for block in iter(lambda: f.read(1 << 20), b""):
+                            digest.update(block)
+                            segment.write(block)
+                else:
+                    data = content.encode("utf-8")
+                    digest.update(data)
+                    segment.write(zlib.compress(data))
+                sha256 = digest.hexdigest()
+                records.append(
+                    ElementRecord(
+                        id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"{file_name}/{kind}/{sha256}")),
+                        kind=kind,
+                        file=file_name,
+                        source=str(source) if source is not None else None,
+                        page=metadata.get("page"),
+                        sha256=sha256,
+                        offset=offset,
+                        length=segment.tell() - offset,
+                        compressed=not isinstance(content, Path),
+                        name=metadata.get("name"),
+                        format=metadata.get("format"),
+                        width=metadata.get("width"),
+                        height=metadata.get("height"),
+                    )
+                )
+            segment.flush()
+            os.fsync(segment.fileno())
+
+            # The index line goes last, readers never see elements missing from the segment
+            line = json.dumps(
+                {"file": file_name, "elements": [_index_entry(record) for record in records]},
+                separators=(",", ":"),
+            )
+            with self.index_path.open("ab+") as index:
+                # Terminate a line an interrupted writer left unfinished
+                if index.tell() > 0:
+                    index.seek(-1, os.SEEK_END)
+                    if index.read(1) != b"\n":
+                        index.write(b"\n")
+                index.write(line.encode("utf-8") + b"\n")
+            run_report.count_bytes_written(
+                sum(record.length for record in records) + len(line) + 1
+            )
+            self.refresh()
+            return records
+
+    def import_json_folder(self, folder_path: Path) -> list[ElementRecord]:
+        """Add a processed file of the former layout, texts.json, tables.json and images/."""
+        elements: list[tuple[str, str | Path, dict]] = []
+        for kind in ("texts", "tables"):
+            json_path = folder_path / f"{kind}.json"
+            if json_path.exists():
+                with json_path.open(encoding="utf-8") as f:
+                    elements += [(kind, content, {}) for content in json.load(f)]
+        images_folder = folder_path / "images"
+        if images_folder.exists():
+            for image_path in sorted(images_folder.iterdir()):
+                if image_path.is_file():
+                    elements.append(("images", image_path, describe_image(image_path)))
+        return self.write_file(folder_path.name, elements)
+
+    def live_bytes(self) -> int:
+        """Bytes of the segment used by the current version of every file."""
+        with self._lock:
+            return sum(record.length for records in self._files.values() for record in records)
+
+    def compact(self) -> None:
+        """Rewrite the segment without the superseded versions of files."""
+        with self._lock:
+            compacted_folder = self.folder / "compacting"
+            shutil.rmtree(compacted_folder, ignore_errors=True)
+            compacted_folder.mkdir()
+            offset = 0
+            with (compacted_folder / SEGMENT_FILE).open("wb") as segment, (
+                compacted_folder / INDEX_FILE
+            ).open("wb") as index:
+                for file_name in self.file_names():
+                    entries = []
+                    for record in self.records(file_name):
+                        segment.write(self._read_stored(record))
+                        entries.append({**_index_entry(record), "offset": offset})
+                        offset += record.length
+                    line = json.dumps(
+                        {"file": file_name, "elements": entries}, separators=(",", ":")
+                    )
+                    index.write(line.encode("utf-8") + b"\n")
+                segment.flush()
+                os.fsync(segment.fileno())
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            os.replace(compacted_folder / SEGMENT_FILE, self.segment_path)
+            os.replace(compacted_folder / INDEX_FILE, self.index_path)
+            compacted_folder.rmdir()
+            self._files, self._by_id, self._index_position = {}, {}, 0
+            self.refresh()
@@ -1,9 +1,11 @@
-import json
+import shutil
+import tempfile
+import zipfile
 from pathlib import Path
 
 from config import Config
-from docx import Document
-from pptx import Presentation
+from element_store import ElementStore, describe_image
+from profiling import run_report
 from unstructured.documents.elements import Element
 from unstructured.partition.docx import partition_docx
 from unstructured.partition.pdf import partition_pdf
@@ -13,59 +15,46 @@ from unstructured.partition.xlsx import partition_xlsx
 config = Config()
 
 
-def create_file_output_folder(output_folder: Path, base_name: str) -> tuple[Path, Path]:
-    """
-    Create a specific folder for each file's outputs
-    """
-    file_output_folder = Path(output_folder) / base_name
-    images_folder = file_output_folder / "images"
-    file_output_folder.mkdir(parents=True, exist_ok=True)
-    images_folder.mkdir(parents=True, exist_ok=True)
-    return file_output_folder, images_folder
+# Zip folder with the media parts of each OOXML document type
+OOXML_MEDIA_FOLDERS = {".docx": "word/media/", ".pptx": "ppt/media/"}
 
+# Pillow format names of the extensions that differ from them
+_SUFFIX_FORMATS = {".jpg": "jpeg", ".tif": "tiff"}
 
-def docx_extract_images(doc_path: Path, images_folder: Path) -> list:
-    doc = Document(doc_path)
-    images = []
-    image_count = 0
-    base_name = doc_path.stem
 
-    # Ensure the images_folder exists
+def ooxml_extract_images(doc_path: Path, images_folder: Path) -> list[dict]:
+    """
+    Stream the pictures of a docx or pptx from its zip package straight to the images
+    folder, in chunks, without parsing the document. Each media part is written once
+    however many times the document uses it, under the extension of its real format.
+    Returns the description of every written image
+    """
     images_folder.mkdir(parents=True, exist_ok=True)
-
-    # Extract all images
-    for rel in doc.part.rels.values():
-        if "image" in rel.target_ref:
-            img = rel.target_part.blob
-            image_path = images_folder / f"{base_name}_image{image_count}.jpg"
-            with image_path.open("wb") as img_file:
-                img_file.write(img)
-            image_count += 1
-            images.append(str(image_path))
-
-    return images
-
-
-def pptx_extract_images(pptx_path: Path, images_folder: Path) -> list:
-    prs = Presentation(pptx_path)
+    media_folder = OOXML_MEDIA_FOLDERS[doc_path.suffix.lower()]
     images = []
-    image_count = 0
-    base_name = pptx_path.stem
-
-    # Ensure the images_folder exists
-    images_folder.mkdir(parents=True, exist_ok=True)
-
-    # Extract images from shapes in each slide
-    for slide in prs.slides:
-        for shape in slide.shapes:
-            if hasattr(shape, "image"):
-                image = shape.image
-                image_bytes = image.blob
-                image_path = images_folder / f"{base_name}_image{image_count}.{image.ext}"
-                with image_path.open("wb") as img_file:
-                    img_file.write(image_bytes)
-                image_count += 1
-                images.append(str(image_path))
+    if not zipfile.is_zipfile(doc_path):
+        # Not a zip package, e.g. a renamed legacy .doc, its pictures come from partitioning
+        return images
+
+    with zipfile.ZipFile(doc_path) as package:
+        media = [
+            info
+            for info in package.infolist()
+            if info.filename.startswith(media_folder) and not info.is_dir()
+        ]
+        for image_count, info in enumerate(media):
+            suffix = Path(info.filename).suffix.lower()
+            image_path = images_folder / f"{doc_path.stem}_image{image_count}{suffix}"
+            with package.open(info) as part, image_path.open("wb") as img_file:
+                shutil.copyfileobj(part, img_file, 1 << 20)
+            image = describe_image(image_path)
+            # Part names do not always match the content, e.g. PNGs stored as image1.jpg
+            if image["format"] is not None and image["format"] != _SUFFIX_FORMATS.get(
+                suffix, suffix.lstrip(".")
+            ):
+                image_path = image_path.rename(image_path.with_suffix(f".{image['format']}"))
+                image["name"] = image_path.name
+            images.append(image)
 
     return images
 
@@ -118,72 +107,90 @@ def extract_document_elements(
     return None
 
 
-def categorize_elements(raw_elements: list[Element]) -> tuple[list[str], list[str]]:
+def categorize_elements(
+    raw_elements: list[Element],
+) -> tuple[list[tuple[str, int | None]], list[tuple[str, int | None]]]:
     """
     Categorize extracted elements from documents into tables and texts.
     raw_elements: List of unstructured.documents.elements
+    Returns (content, page_number) pairs, page_number is None for formats without pages
     """
     tables = []
     texts = []
     for element in raw_elements:
         element_type = str(type(element))
+        page = getattr(element.metadata, "page_number", None)
         if "Table" in element_type:
-            tables.append(str(element))
+            tables.append((str(element), page))
         elif any(
             text_type in element_type
             for text_type in ["CompositeElement", "Text", "Title", "NarrativeText"]
         ):
-            texts.append(str(element))
+            texts.append((str(element), page))
     return texts, tables
 
 
-def process_documents(input_folder: Path, output_folder: Path) -> None:
+SUPPORTED_EXTENSIONS = (".pdf", ".pptx", ".ppt", ".docx", ".doc", ".xlsx", ".xlsm")
+
+
+def list_documents(input_folder: Path) -> list[Path]:
     """
-    Process all supported document types in the input folder
+    Supported documents in the input folder
+    """
+    return [
+        fname for fname in input_folder.iterdir() if fname.suffix.lower() in SUPPORTED_EXTENSIONS
+    ]
+
+
+def process_document(fname: Path, store: ElementStore) -> str | None:
+    """
+    Extract the texts, tables and images of one document into the element store
+    Returns the name of the processed file in the store, or None if it could not be processed
     """
-    supported_extensions = (".pdf", ".pptx", ".ppt", ".docx", ".doc", ".xlsx", ".xlsm")
-
-    for fname in input_folder.iterdir():
-        if fname.suffix.lower() in supported_extensions:
-            try:
-                print(f"Processing {fname}...")
-                base_name = fname.stem
-
-                # Create specific folders for this file's outputs
-                file_output_folder, images_folder = create_file_output_folder(
-                    output_folder, base_name
-                )
-
-                if fname.suffix.lower() in (".docx", ".doc"):
-                    # Extract images separately
-                    _ = docx_extract_images(fname, images_folder)
-                elif fname.suffix.lower() in (".pptx", ".ppt"):
-                    # Extract images separately
-                    _ = pptx_extract_images(fname, images_folder)
-                # Extract elements with the specific images folder
-                raw_elements = extract_document_elements(input_folder, images_folder, fname.name)
+    try:
+        print(f"Processing {fname}...")
+        base_name = fname.stem
+
+        # Images are written to a scratch folder by the extractors, then packed into the store
+        with tempfile.TemporaryDirectory() as tmp:
+            images_folder = Path(tmp)
+            images = []
+            if fname.suffix.lower() in OOXML_MEDIA_FOLDERS:
+                # Extract images separately
+                with run_report.stage("extract_images", fname.name):
+                    images = ooxml_extract_images(fname, images_folder)
+            # Extract elements with the specific images folder
+            with run_report.stage("partition", fname.name):
+                raw_elements = extract_document_elements(fname.parent, images_folder, fname.name)
                 texts, tables = categorize_elements(raw_elements)
 
-                # Save texts
-                text_file = file_output_folder / "texts.json"
-                with text_file.open("w", encoding="utf-8") as f:
-                    json.dump(texts, f, indent=4, ensure_ascii=False)
+            with run_report.stage("serialize", fname.name):
+                described = {image["name"]: image for image in images}
+                elements = [("texts", text, {"page": page}) for text, page in texts]
+                elements += [("tables", table, {"page": page}) for table, page in tables]
+                for image_path in sorted(images_folder.iterdir()):
+                    if image_path.is_file():
+                        image = described.get(image_path.name) or describe_image(image_path)
+                        elements.append(("images", image_path, image))
+                store.write_file(base_name, elements, source=fname)
+
+        print(f"Successfully processed {fname}")
+        return base_name
 
-                # Save tables if any exist
-                if tables:
-                    table_file = file_output_folder / "tables.json"
-                    with table_file.open("w", encoding="utf-8") as f:
-                        json.dump(tables, f, indent=4, ensure_ascii=False)
+    except Exception as e:
+        print(f"Error processing {fname}: {str(e)}")
+        return None
 
-                print(f"Successfully processed {fname}")
 
-            except Exception as e:
-                print(f"Error processing {fname}: {str(e)}")
+def process_documents(input_folder: Path, store: ElementStore) -> None:
+    """
+    Process all supported document types in the input folder
+    """
+    for fname in list_documents(input_folder):
+        process_document(fname, store)
 
 
 def extract_advanced_data_demo() -> None:
     input_folder = config.RAW_DATA_FOLDER
-    output_folder = config.PROCESSED_DATA_FOLDER
     input_folder.mkdir(parents=True, exist_ok=True)
-    output_folder.mkdir(parents=True, exist_ok=True)
-    process_documents(input_folder, output_folder)
+    process_documents(input_folder, ElementStore(config.PROCESSED_DATA_FOLDER))
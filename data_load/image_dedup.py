@@ -0,0 +1,132 @@
+import base64
+import hashlib
+import io
+import threading
+import uuid
+from dataclasses import dataclass
+
+import numpy as np
+from PIL import Image
+
+# Unnormalized DCT-II basis of the 32x32 perceptual hash
+_DCT = np.cos(np.pi * np.outer(np.arange(32), 2 * np.arange(32) + 1) / 64)
+
+
+def image_phash(image: Image.Image) -> int:
+    """
+    64 bit perceptual hash: the signs of the lowest 8x8 DCT frequencies of the
+    32x32 grayscale image against their median. Resized, recompressed or slightly
+    retouched copies of an image differ in a few bits only.
+    """
+    pixels = np.asarray(image.convert("L").resize((32, 32), Image.Resampling.LANCZOS), float)
+    low = (_DCT @ pixels @ _DCT.T)[:8, :8].flatten()
+    # The DC term is the mean brightness, it would dominate the median
+    bits = low > np.median(low[1:])
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def image_document_id(sha256: str) -> str:
+    """
+    Id of an image shared by every file it appears in, so its summary and its docstore
+    entry are stored once
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"images/{sha256}"))
+
+
+@dataclass
+class ImageMatch:
+    # Document id of the canonical image
+    doc_id: str
+    # "new", "exact" or "near"
+    kind: str
+
+
+class ImageDeduplicator:
+    """
+    Maps every image of a run to a canonical image: exact copies by the sha256 of their
+    bytes, near copies by a perceptual hash within max_distance bits. Small images (icons,
+    bullets) and blank ones (backgrounds, separators) are dropped as decorative. The
+    entropy threshold must stay far below that of charts and diagrams, which are mostly
+    one background colour.
+    Known hashes can be seeded from earlier runs, so the canonical image stays the same.
+    """
+
+    def __init__(
+        self, min_side: int = 64, min_entropy: float = 0.02, max_distance: int = 6
+    ) -> None:
+        self.min_side = min_side
+        self.min_entropy = min_entropy
+        self.max_distance = max_distance
+        self.counts = {"images": 0, "decorative": 0, "exact": 0, "near": 0}
+        self._by_sha: dict[str, str] = {}
+        self._phashes: list[tuple[int, str]] = []
+        self._new_hashes: list[tuple[str, int]] = []
+        self._claimed: set[str] = set()
+        self._decorative: set[str] = set()
+        self._lock = threading.Lock()
+
+    def seed(self, hashes: list[tuple[str, int]]) -> None:
+        """Add (sha256, phash) pairs of images indexed by earlier runs."""
+        with self._lock:
+            for sha256, phash in hashes:
+                if sha256 not in self._by_sha:
+                    self._by_sha[sha256] = image_document_id(sha256)
+                    self._phashes.append((phash, sha256))
+
+    def is_decorative(self, image: Image.Image) -> bool:
+        return min(image.size) < self.min_side or image.convert("L").entropy() < self.min_entropy
+
+    def pop_new_hashes(self) -> list[tuple[str, int]]:
+        """(sha256, phash) pairs of the canonical images found since the last call."""
+        with self._lock:
+            hashes, self._new_hashes = self._new_hashes, []
+        return hashes
+
+    def claim(self, doc_id: str) -> bool:
+        """True for the first file of the run with the image, which summarizes and indexes it."""
+        with self._lock:
+            if doc_id in self._claimed:
+                return False
+            self._claimed.add(doc_id)
+            return True
+
+    def vision_calls_avoided(self) -> int:
+        """Images of the run that were not summarized on their own."""
+        with self._lock:
+            return self.counts["images"] - len(self._claimed)
+
+    def match(self, img_base64: str) -> ImageMatch | None:
+        """Canonical image of a base64 image, None if it is decorative."""
+        img_bytes = base64.b64decode(img_base64)
+        sha256 = hashlib.sha256(img_bytes).hexdigest()
+        with self._lock:
+            self.counts["images"] += 1
+            if sha256 in self._decorative:
+                self.counts["decorative"] += 1
+                return None
+            if sha256 in self._by_sha:
+                self.counts["exact"] += 1
+                return ImageMatch(self._by_sha[sha256], "exact")
+
+        image = Image.open(io.BytesIO(img_bytes))
+        if self.is_decorative(image):
+            with self._lock:
+                self.counts["decorative"] += 1
+                self._decorative.add(sha256)
+            return None
+        phash = image_phash(image)
+
+        with self._lock:
+            if sha256 in self._by_sha:
+                # Another thread added the same image meanwhile
+                self.counts["exact"] += 1
+                return ImageMatch(self._by_sha[sha256], "exact")
+            for known_phash, known_sha256 in self._phashes:
+                if (phash ^ known_phash).bit_count() <= self.max_distance:
+                    self.counts["near"] += 1
+                    self._by_sha[sha256] = self._by_sha[known_sha256]
+                    return ImageMatch(self._by_sha[sha256], "near")
+            self._by_sha[sha256] = image_document_id(sha256)
+            self._phashes.append((phash, sha256))
+            self._new_hashes.append((sha256, phash))
+            return ImageMatch(self._by_sha[sha256], "new")
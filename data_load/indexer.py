@@ -0,0 +1,192 @@
+import io
+import json
+import threading
+import uuid
+from dataclasses import dataclass
+
+import tiktoken
+from checkpoint import IngestionCheckpoint
+from ingest_multimodal_data import (
+    bump_knowledge_version,
+    current_ingestion_version,
+    document_metadata,
+)
+from langchain_community.storage import RedisStore
+from langchain_community.vectorstores import PGVector
+from langchain_core.embeddings import Embeddings
+from profiling import run_report
+from sqlalchemy import text
+
+COPY_QUERY = """
+COPY langchain_pg_embedding (uuid, collection_id, embedding, document, cmetadata, custom_id)
+FROM STDIN
+"""
+
+DELETE_QUERY = """
+DELETE FROM langchain_pg_embedding
+WHERE collection_id = CAST(:collection_id AS uuid) AND custom_id = ANY(:document_ids);
+"""
+
+
+@dataclass
+class IndexRow:
+    file_name: str
+    kind: str
+    index: int
+    doc_id: str
+    summary: str
+    content: str
+    embedding: list[float] | None = None
+
+
+def _copy_value(value: str) -> str:
+    # Escapes of COPY's text format
+    return (
+        value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+    )
+
+
+def copy_documents(
+    vectorstore: PGVector, rows: list[IndexRow], ingestion_version: str | None = None
+) -> None:
+    """
+    Write the summaries and their embeddings to the collection with a single COPY,
+    replacing rows indexed under the same ids, in one transaction
+    ingestion_version: tag of the rows in their metadata, the current run's if None
+    """
+    if ingestion_version is None:
+        ingestion_version = current_ingestion_version()
+    with vectorstore._make_session() as session:
+        collection = vectorstore.get_collection(session)
+        if collection is None:
+            raise ValueError("Collection not found")
+        session.execute(
+            text(DELETE_QUERY),
+            {"collection_id": str(collection.uuid), "document_ids": [row.doc_id for row in rows]},
+        )
+        buffer = io.StringIO()
+        for row in rows:
+            metadata = document_metadata(
+                row.doc_id, row.file_name, row.index, row.kind, ingestion_version
+            )
+            fields = [
+                str(uuid.uuid4()),
+                str(collection.uuid),
+                json.dumps(row.embedding, separators=(",", ":")),
+                row.summary,
+                json.dumps(metadata),
+                row.doc_id,
+            ]
+            buffer.write("\t".join(_copy_value(field) for field in fields) + "\n")
+        buffer.seek(0)
+        with session.connection().connection.cursor() as cursor:
+            cursor.copy_expert(COPY_QUERY, buffer)
+        session.commit()
+
+
+class BatchIndexer:
+    """
+    Embeds and indexes the summaries of many files at once. Summaries are accumulated
+    across files until max_tokens or max_inputs, embedded in one request, written to the
+    collection with one COPY and to the docstore with one pipelined mset.
+    Summaries that already have a checkpointed embedding are not embedded again.
+    """
+
+    def __init__(
+        self,
+        vectorstore: PGVector,
+        docstore: RedisStore,
+        embeddings: Embeddings,
+        checkpoint: IngestionCheckpoint,
+        max_tokens: int = 50_000,
+        max_inputs: int = 2048,
+        ingestion_version: str | None = None,
+    ) -> None:
+        self.vectorstore = vectorstore
+        self.docstore = docstore
+        self.embeddings = embeddings
+        self.checkpoint = checkpoint
+        self.max_tokens = max_tokens
+        self.max_inputs = max_inputs
+        self.ingestion_version = ingestion_version or current_ingestion_version()
+        self.tiktoken_model = tiktoken.get_encoding("cl100k_base")
+        self.batches = 0
+        self.rows = 0
+        self._pending: list[IndexRow] = []
+        self._tokens = 0
+        # Rows of each file still waiting in the batch
+        self._files: dict[str, int] = {}
+        self._lock = threading.RLock()
+
+    def add(self, rows: list[IndexRow]) -> None:
+        """Queue the rows of one file, flushing whenever the batch is full."""
+        if not rows:
+            return
+        file_name = rows[0].file_name
+        with self._lock:
+            self._files[file_name] = self._files.get(file_name, 0) + len(rows)
+            try:
+                for row in rows:
+                    n_tokens = 0 if row.embedding is not None else len(
+                        self.tiktoken_model.encode(row.summary)
+                    )
+                    if self._pending and (
+                        self._tokens + n_tokens > self.max_tokens
+                        or len(self._pending) >= self.max_inputs
+                    ):
+                        self.flush()
+                    self._pending.append(row)
+                    self._tokens += n_tokens
+            except Exception:
+                # A flush failed before all rows of the file were queued, it is incomplete
+                self._files.pop(file_name, None)
+                raise
+
+    def flush(self) -> None:
+        with self._lock:
+            rows, self._pending, self._tokens = self._pending, [], 0
+            if not rows:
+                return
+
+            to_embed = [row for row in rows if row.embedding is None]
+            try:
+                if to_embed:
+                    with run_report.stage("embed_batch"):
+                        vectors = self.embeddings.embed_documents(
+                            [row.summary for row in to_embed]
+                        )
+                    self.checkpoint.save_embeddings([row.doc_id for row in to_embed], vectors)
+                    for row, vector in zip(to_embed, vectors, strict=True):
+                        row.embedding = vector
+
+                with run_report.stage("index_batch"):
+                    copy_documents(self.vectorstore, rows, self.ingestion_version)
+                    self.docstore.mset([(row.doc_id, row.content) for row in rows])
+                    # Summaries with their ada-002 float4 vectors, plus the raw contents in Redis
+                    run_report.count_bytes_written(
+                        sum(
+                            len(row.summary.encode("utf-8")) + 1536 * 4
+                            + len(row.content.encode("utf-8"))
+                            for row in rows
+                        )
+                    )
+                self.checkpoint.save_indexed([row.doc_id for row in rows])
+            except Exception:
+                # The files of the batch are incomplete, rows of theirs in later batches must
+                # not report them as indexed. The next run retries them from the checkpoint
+                for row in rows:
+                    self._files.pop(row.file_name, None)
+                raise
+            # Cached answers must not outlive the documents they were based on
+            bump_knowledge_version(self.vectorstore, "multimodalrag")
+            self.batches += 1
+            self.rows += len(rows)
+
+            for row in rows:
+                if row.file_name not in self._files:
+                    continue
+                self._files[row.file_name] -= 1
+                if self._files[row.file_name] == 0:
+                    del self._files[row.file_name]
+                    print(f"Indexed {row.file_name}")
+            print(f"Indexed a batch of {len(rows)} documents ({len(to_embed)} embedded)")
@@ -1,262 +1,253 @@
-import base64
-import json
 import uuid
-from pathlib import Path
-from PIL import Image
 
 import redis
+import tiktoken
+from common.embeddings import RateLimitedEmbeddings
 from config import Config
-from langchain.retrievers.multi_vector import MultiVectorRetriever
 from langchain_community.storage import RedisStore
 from langchain_community.vectorstores import PGVector
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_core.messages import HumanMessage
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable, RunnableLambda
 from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
+from profiling import ApiUsageCallbackHandler, CountingEmbeddings, run_report
+from ratelimit import admit_step, get_rate_limiter
+from sqlalchemy import text
 
 config = Config()
 
+ID_KEY = "document_id"
 
-def load_serialized_data(
-        data_folder: Path,
-) -> tuple[dict[str, dict], dict[str, dict], dict[str, list]]:
-    """
-    Load all serialized data from the output folder structure
-    Returns dictionaries of texts, tables, and images organized by file name
-    """
-    all_texts: dict[str, dict] = {}
-    all_tables: dict[str, dict] = {}
-    all_images: dict[str, list] = {}
-
-    # Iterate through each subfolder (one per processed file)
-    for folder_path in data_folder.iterdir():
-        if not folder_path.is_dir():
-            continue
-
-        folder_name = folder_path.name
-
-        # Load texts
-        text_path = folder_path / "texts.json"
-        if text_path.exists():
-            with text_path.open(encoding="utf-8") as f:
-                all_texts[folder_name] = json.load(f)
-
-        # Load tables
-        table_path = folder_path / "tables.json"
-        if table_path.exists():
-            with table_path.open(encoding="utf-8") as f:
-                all_tables[folder_name] = json.load(f)
-
-        # Load images from the images subfolder
-        images_folder = folder_path / "images"
-        if images_folder.exists():
-            all_images[folder_name] = []
-            for img_file in images_folder.iterdir():
-                if img_file.suffix.lower() in [".png", ".jpg", ".jpeg", ".webp", ".gif"]:
-                    # Create a tuple of (image_name, base64_string, image_format)
-                    img_base64, img_format = encode_image(img_file)
-                    all_images[folder_name].append((img_file.name, img_base64, img_format))
-
-    return all_texts, all_tables, all_images
-
-
-def encode_image(image_path: Path) -> tuple[str, str]:
-    """Getting the base64 string and image format"""
-    with open(image_path, "rb") as image_file:
-        img_data = image_file.read()
-        img_format = Image.open(image_path).format.lower()
-        return base64.b64encode(img_data).decode("utf-8"), img_format
-
-
-def generate_text_summaries(
-        texts_dict: dict[str, list[str]],
-        tables_dict: dict[str, list[str]],
-        summarize_texts: bool = False,
-        model: AzureChatOpenAI = None,
-) -> tuple[dict[str, list[str]], dict[str, list[str]]]:
+# Completion tokens of a summary, charged in full against the rate limit like Azure does
+SUMMARY_MAX_TOKENS = 2048
+# The most a high detail image can cost: 8 tiles after scaling to 768x2048
+IMAGE_TOKENS_ESTIMATE = 85 + 170 * 8
+
+# Element type recorded in the metadata of each kind of content, retrieval can filter on it
+ELEMENT_TYPES = {"texts": "text", "tables": "table", "images": "image"}
+
+
+def create_text_summarize_chain(model: AzureChatOpenAI) -> Runnable:
     """
-    Summarize text elements organized by file
-    texts_dict: Dictionary of texts by file name
-    tables_dict: Dictionary of tables by file name
-    summarize_texts: Bool to summarize texts
+    Chain that summarizes one text or table element
     """
-    text_summaries = {}
-    table_summaries = {}
-
-    # Prompt
     prompt_text = """You are an assistant tasked with summarizing tables and text for retrieval. \
     These summaries will be embedded and used to retrieve the raw text or table elements. \
     Give a concise summary of the table or text that is well optimized for retrieval.
     Table or text: {element}
     """
     prompt = ChatPromptTemplate.from_template(prompt_text)
+    tiktoken_model = tiktoken.encoding_for_model("gpt-4o")
+    admit = admit_step(
+        get_rate_limiter(),
+        "gpt-4o",
+        lambda prompt_value: len(tiktoken_model.encode(prompt_value.to_string()))
+        + SUMMARY_MAX_TOKENS,
+    )
 
-    summarize_chain = {"element": lambda x: x} | prompt | model | StrOutputParser()
-
-    # Process texts by file
-    for file_name, texts in texts_dict.items():
-        if texts and summarize_texts:
-            text_summaries[file_name] = summarize_chain.batch(texts, {"max_concurrency": 5})
-        elif texts:
-            text_summaries[file_name] = texts
-
-    # Process tables by file
-    for file_name, tables in tables_dict.items():
-        if tables:
-            table_summaries[file_name] = summarize_chain.batch(tables, {"max_concurrency": 5})
-
-    return text_summaries, table_summaries
+    return {"element": lambda x: x} | prompt | admit | model | StrOutputParser()
 
 
-def generate_img_summaries(
-        images_dict: dict[str, list[tuple[str, str, str]]], model: AzureChatOpenAI
-) -> dict[str, list[tuple[str, str]]]:
+def create_image_summarize_chain(model: AzureChatOpenAI) -> Runnable:
     """
-    Generate summaries for images organized by file
-    images_dict: Dictionary of (image_name, base64_string, image_format) tuples by file name
+    Chain that summarizes one (base64_string, image_format) image
     """
-    image_summaries = {}
-
     prompt = """You are an assistant tasked with summarizing images for retrieval. \
     These summaries will be embedded and used to retrieve the raw image. \
     Give a concise summary of the image that is well optimized for retrieval. \
     Do not add the Summary: prefix. Just provide the description."""
 
-    for file_name, images in images_dict.items():
-        image_summaries[file_name] = []
-        for img_name, img_base64, img_format in images:
-            msg = model.invoke(
-                [
-                    HumanMessage(
-                        content=[
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": f"data:image/{img_format};base64,{img_base64}"},
-                            },
-                        ]
-                    )
+    def image_message(image: tuple[str, str]) -> list[HumanMessage]:
+        img_base64, img_format = image
+        return [
+            HumanMessage(
+                content=[
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": f"data:image/{img_format};base64,{img_base64}"},
+                    },
                 ]
             )
-            image_summaries[file_name].append((img_name, msg.content))
+        ]
 
-    return image_summaries
+    tiktoken_model = tiktoken.encoding_for_model("gpt-4o")
+    admit = admit_step(
+        get_rate_limiter(),
+        "gpt-4o",
+        lambda _: len(tiktoken_model.encode(prompt)) + IMAGE_TOKENS_ESTIMATE + SUMMARY_MAX_TOKENS,
+    )
 
+    return RunnableLambda(image_message) | admit | model | StrOutputParser()
 
-def create_multi_vector_retriever(
-        vectorstore: PGVector,
-        text_summaries_dict: dict[str, list[str]],
-        texts_dict: dict[str, list[str]],
-        table_summaries_dict: dict[str, list[str]],
-        tables_dict: dict[str, list[str]],
-        image_summaries_dict: dict[str, list[tuple[str, str]]],
-        images_dict: dict[str, list[tuple[str, str]]],
-) -> MultiVectorRetriever:
+
+def create_text_search_index(vectorstore: PGVector) -> None:
+    """
+    Create the full-text GIN index used by part_2's hybrid retriever.
+    The expression must match the one in part_2/_retrievers.py for the index to be used.
+    """
+    with vectorstore._make_session() as session:
+        session.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS langchain_pg_embedding_document_tsv_idx "
+                "ON langchain_pg_embedding USING gin (to_tsvector('english', document))"
+            )
+        )
+        session.commit()
+
+
+def create_metadata_index(vectorstore: PGVector) -> None:
     """
-    Create retriever that indexes summaries, but returns raw images or texts
-    All inputs are dictionaries keyed by file names
+    Create the GIN index of the metadata used by filtered retrieval in part_2.
+    PGVector stores cmetadata as json, so the index is on its jsonb cast and the queries
+    must filter on the same expression, see part_2/_retrievers.py.
     """
-    # Initialize the storage layer
-    id_key = "document_id"
+    with vectorstore._make_session() as session:
+        session.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS langchain_pg_embedding_cmetadata_idx "
+                "ON langchain_pg_embedding USING gin ((cmetadata::jsonb) jsonb_path_ops)"
+            )
+        )
+        session.commit()
+
+
+def current_ingestion_version() -> str:
+    """Version the documents indexed by this run are tagged with, by default its start."""
+    return config.INGESTION_VERSION or run_report.started_at.strftime("%Y%m%dT%H%M%S")
+
+
+def document_metadata(
+    doc_id: str, file_name: str, index: int, kind: str | None, ingestion_version: str
+) -> dict:
+    metadata = {ID_KEY: doc_id, "file_name": file_name, "index": index}
+    if kind is not None:
+        metadata["type"] = ELEMENT_TYPES[kind]
+    metadata["ingestion_version"] = ingestion_version
+    return metadata
+
 
+def bump_knowledge_version(vectorstore: PGVector, namespace: str) -> None:
+    """
+    Record that the documents of a namespace changed.
+    The chatbots only serve cached answers stored under the current version.
+    """
+    with vectorstore._make_session() as session:
+        session.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS knowledge_version ("
+                "namespace varchar PRIMARY KEY, "
+                "version varchar NOT NULL, "
+                "updated_at timestamptz NOT NULL DEFAULT now())"
+            )
+        )
+        session.execute(
+            text(
+                "INSERT INTO knowledge_version (namespace, version) "
+                "VALUES (:namespace, md5(random()::text || clock_timestamp()::text)) "
+                "ON CONFLICT (namespace) DO UPDATE "
+                "SET version = EXCLUDED.version, updated_at = now()"
+            ),
+            {"namespace": namespace},
+        )
+        session.commit()
+
+
+def create_docstore() -> RedisStore:
     redis_url = config.REDIS_URL
     redis_host, redis_port = redis_url.split("redis://")[1].split(":")
     redis_client = redis.StrictRedis(host=redis_host, port=redis_port, decode_responses=True)
+    return RedisStore(client=redis_client, namespace="multimodalrag")
 
-    store = RedisStore(client=redis_client, namespace="multimodalrag")
 
-    # Clear the vector and doc store
-    store.client.flushdb()
+def reset_stores(vectorstore: PGVector, docstore: RedisStore) -> None:
+    """
+    Clear the vector and doc store
+    """
+    docstore.client.flushdb()
     vectorstore.delete_collection()
     vectorstore.create_collection()
+    create_text_search_index(vectorstore)
+    create_metadata_index(vectorstore)
 
-    # Create the multi-vector retriever
-    retriever = MultiVectorRetriever(
-        vectorstore=vectorstore,
-        id_key=id_key,
-        docstore=store,
-    )
 
-    # Helper function to add documents to the vectorstore and docstore
-    def add_documents(
-            retriever: MultiVectorRetriever,
-            doc_summaries: list[str],
-            doc_contents: list[str],
-            file_name: str,
-    ) -> None:
+def add_documents(
+        vectorstore: PGVector,
+        docstore: RedisStore,
+        doc_summaries: list[str],
+        doc_contents: list[str],
+        file_name: str,
+        summary_embeddings: list[list[float]] | None = None,
+        doc_ids: list[str] | None = None,
+        kind: str | None = None,
+) -> None:
+    """
+    Index the summaries in the vectorstore and the raw contents in the docstore
+    summary_embeddings: precomputed embeddings of the summaries, embedded here if None
+    doc_ids: stable ids of the documents, documents already indexed under them are replaced
+    kind: texts, tables or images, recorded as the element type of the documents
+    """
+    if doc_ids is None:
         doc_ids = [str(uuid.uuid4()) for _ in doc_contents]
-        summary_docs = [
-            Document(
-                page_content=s, metadata={id_key: doc_ids[i], "file_name": file_name, "index": i}
+    else:
+        vectorstore.delete(doc_ids, collection_only=True)
+    ingestion_version = current_ingestion_version()
+    metadatas = [
+        document_metadata(doc_ids[i], file_name, i, kind, ingestion_version)
+        for i in range(len(doc_summaries))
+    ]
+    with run_report.stage("index", file_name):
+        if summary_embeddings is None:
+            vectorstore.add_documents(
+                [
+                    Document(page_content=s, metadata=m)
+                    for s, m in zip(doc_summaries, metadatas, strict=False)
+                ],
+                ids=doc_ids,
             )
-            for i, s in enumerate(doc_summaries)
-        ]
-        retriever.vectorstore.add_documents(summary_docs)
-        print(f"Added {len(summary_docs)} summaries to the vectorstore")
-        retriever.docstore.mset(list(zip(doc_ids, doc_contents, strict=False)))
+        else:
+            vectorstore.add_embeddings(doc_summaries, summary_embeddings, metadatas, ids=doc_ids)
+        print(f"Added {len(doc_summaries)} summaries to the vectorstore")
+        docstore.mset(list(zip(doc_ids, doc_contents, strict=False)))
         print(f"Added {len(doc_contents)} documents to the docstore")
-
-    # Process each file's content
-    for file_name in text_summaries_dict.keys():
-        # Add texts if available
-        if text_summaries_dict.get(file_name):
-            add_documents(
-                retriever, text_summaries_dict[file_name], texts_dict[file_name], file_name
-            )
-
-        # Add tables if available
-        if table_summaries_dict.get(file_name):
-            add_documents(
-                retriever, table_summaries_dict[file_name], tables_dict[file_name], file_name
-            )
-
-        # Add images if available
-        if image_summaries_dict.get(file_name):
-            # Extract summaries and images separately from tuples
-            summaries = [summary for _, summary in image_summaries_dict[file_name]]
-            images = [img_data for _, img_data, _ in images_dict[file_name]]
-            add_documents(retriever, summaries, images, file_name)
-
-    return retriever
-
-
-def run_multimodal_ingestion() -> None:
-    embeddings = AzureOpenAIEmbeddings(
-        model="text-embedding-ada-002",
-        azure_endpoint=config.OAI_ENDPOINT,
-        api_key=config.OAI_API_KEY,
+        # Summaries with their ada-002 float4 vectors, plus the raw contents in Redis
+        run_report.count_bytes_written(
+            sum(len(s.encode("utf-8")) + 1536 * 4 for s in doc_summaries)
+            + sum(len(c.encode("utf-8")) for c in doc_contents)
+        )
+
+
+def create_embeddings() -> CountingEmbeddings:
+    return CountingEmbeddings(
+        RateLimitedEmbeddings(
+            AzureOpenAIEmbeddings(
+                model="text-embedding-ada-002",
+                azure_endpoint=config.OAI_ENDPOINT,
+                api_key=config.OAI_API_KEY,
+            ),
+            get_rate_limiter(),
+        )
     )
 
-    vectorstore = PGVector(
+
+def create_vectorstore(embeddings: Embeddings) -> PGVector:
+    return PGVector(
         connection_string=f"postgresql://{config.POSTGRES_USER}:{config.POSTGRES_PASSWORD}@{config.POSTGRES_HOST}:{config.POSTGRES_PORT}/{config.POSTGRES_DB}",
         embedding_function=embeddings,
         collection_name="knowledge_base",
     )
 
-    model = AzureChatOpenAI(
+
+def create_chat_model() -> AzureChatOpenAI:
+    return AzureChatOpenAI(
         model="gpt-4o",
-        max_tokens=2048,
+        max_tokens=SUMMARY_MAX_TOKENS,
         temperature=0,
         azure_endpoint=config.OAI_ENDPOINT,
         api_key=config.OAI_API_KEY,
         api_version="2024-06-01",
-    )
-
-    data_folder = config.PROCESSED_DATA_FOLDER
-    texts_dict, tables_dict, images_dict = load_serialized_data(data_folder)
-
-    text_summaries_dict, table_summaries_dict = generate_text_summaries(
-        texts_dict, tables_dict, summarize_texts=True, model=model
-    )
-    image_summaries_dict = generate_img_summaries(images_dict, model=model)
-
-    _ = create_multi_vector_retriever(
-        vectorstore,
-        text_summaries_dict,
-        texts_dict,
-        table_summaries_dict,
-        tables_dict,
-        image_summaries_dict,
-        images_dict,
+        callbacks=[ApiUsageCallbackHandler()],
     )
@@ -1,6 +1,31 @@
-from extract_data import extract_advanced_data_demo
-from ingest_multimodal_data import run_multimodal_ingestion
+from functools import partial
+
+from config import Config
+from element_store import ElementStore
+from extract_data import list_documents, process_document
+from pipeline import run_ingestion_pipeline
+from profiling import run_report
 
 if __name__ == "__main__":
-    extract_advanced_data_demo()
-    run_multimodal_ingestion()
+    config = Config()
+    run_report.profile_stages = config.PROFILE_SLOWEST_STAGE
+    config.RAW_DATA_FOLDER.mkdir(parents=True, exist_ok=True)
+    store = ElementStore(config.PROCESSED_DATA_FOLDER)
+    # Processed files of the former layout, one JSON folder per file, are packed once
+    for folder in sorted(config.PROCESSED_DATA_FOLDER.iterdir()):
+        if (folder / "texts.json").exists() and not store.has_file(folder.name):
+            store.import_json_folder(folder)
+            print(f"Imported {folder} into the element store")
+    try:
+        run_ingestion_pipeline(
+            list_documents(config.RAW_DATA_FOLDER),
+            store,
+            extract=partial(process_document, store=store),
+            rebuild=config.INGESTION_REBUILD,
+        )
+    finally:
+        report_path = run_report.write(config.REPORTS_FOLDER)
+        print(f"Ingestion report written to {report_path}")
+    # Re-extracted files leave their former version behind in the segment
+    if store.live_bytes() < store.segment_path.stat().st_size / 2:
+        store.compact()
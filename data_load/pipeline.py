@@ -0,0 +1,396 @@
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from pathlib import Path
+from queue import Empty, Queue
+from typing import Any
+
+from checkpoint import IngestionCheckpoint, document_id
+from config import Config
+from element_store import ElementStore
+from image_dedup import ImageDeduplicator
+from indexer import BatchIndexer, IndexRow
+from ingest_multimodal_data import (
+    bump_knowledge_version,
+    create_chat_model,
+    create_docstore,
+    create_embeddings,
+    create_image_summarize_chain,
+    create_metadata_index,
+    create_text_search_index,
+    create_text_summarize_chain,
+    create_vectorstore,
+    current_ingestion_version,
+    reset_stores,
+)
+from profiling import run_report
+from ratelimit import get_rate_limiter
+
+config = Config()
+
+# Marks the end of the input of a stage
+_DONE = object()
+
+
+KINDS = ("texts", "tables", "images")
+
+
+@dataclass
+class FileItem:
+    """
+    The content of one processed file as it moves through the pipeline
+    Contents, their stable ids and summaries are keyed by content type
+    """
+
+    name: str
+    contents: dict[str, list[str]]
+    doc_ids: dict[str, list[str]]
+    image_formats: list[str]
+    summaries: dict[str, list[str]] = field(default_factory=dict)
+    # Images of the file summarized and indexed with another file of the run
+    shared_ids: list[str] = field(default_factory=list)
+    # Checkpointed state of the elements, by document id
+    checkpointed: dict[str, dict] = field(default_factory=dict)
+
+    @classmethod
+    def from_file_data(
+        cls,
+        name: str,
+        texts: list[str],
+        tables: list[str],
+        images: list[tuple[str, str, str]],
+        deduplicator: ImageDeduplicator | None = None,
+    ) -> "FileItem":
+        """
+        deduplicator: drops decorative images and gives copies of an image, in this or other
+        files, the id of one canonical image that only the first file of the run indexes
+        """
+        item = cls(name, {kind: [] for kind in KINDS}, {kind: [] for kind in KINDS}, [])
+        elements = [("texts", text, None) for text in texts]
+        elements += [("tables", table, None) for table in tables]
+        elements += [("images", img_base64, img_format) for _, img_base64, img_format in images]
+        for kind, content, img_format in elements:
+            if kind == "images" and deduplicator is not None:
+                match = deduplicator.match(content)
+                if match is None:
+                    continue
+                doc_id = match.doc_id
+            else:
+                doc_id = document_id(name, kind, content)
+            # Identical elements of a file are indexed once
+            if doc_id in item.doc_ids[kind] or doc_id in item.shared_ids:
+                continue
+            if kind == "images" and deduplicator is not None and not deduplicator.claim(doc_id):
+                item.shared_ids.append(doc_id)
+                continue
+            item.contents[kind].append(content)
+            item.doc_ids[kind].append(doc_id)
+            if img_format is not None:
+                item.image_formats.append(img_format)
+        return item
+
+    def all_doc_ids(self) -> list[str]:
+        return [doc_id for kind in KINDS for doc_id in self.doc_ids[kind]] + self.shared_ids
+
+
+class Stage:
+    """
+    Worker threads that take items from the inbox, process them and put the results in
+    the outbox. A full outbox blocks the workers, so memory stays bounded by the queue sizes.
+    Items that fail or return None are dropped.
+    flush: called when no item arrived for flush_interval seconds and when the input ends,
+    for stages that batch their work across items
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Any], Any],
+        workers: int,
+        inbox: Queue,
+        outbox: Queue | None,
+        flush: Callable[[], None] | None = None,
+        flush_interval: float = 1.0,
+    ) -> None:
+        self.name = name
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.flush = flush
+        self.flush_interval = flush_interval
+        self.items = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        # Time spent waiting for room in the outbox, i.e. backpressure from the next stage
+        self.blocked_seconds = 0.0
+        self.first_start: float | None = None
+        self.last_end: float | None = None
+        self._running = workers
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self) -> None:
+        for thread in self._threads:
+            thread.start()
+
+    def join(self) -> None:
+        for thread in self._threads:
+            thread.join()
+
+    def _flush(self) -> None:
+        start = time.perf_counter()
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error in {self.name} stage while flushing: {str(e)}")
+            with self._lock:
+                self.failed += 1
+        with self._lock:
+            self.busy_seconds += time.perf_counter() - start
+            self.last_end = time.perf_counter()
+
+    def _work(self) -> None:
+        while True:
+            try:
+                item = self.inbox.get(timeout=self.flush_interval if self.flush else None)
+            except Empty:
+                self._flush()
+                continue
+            if item is _DONE:
+                # Let the other workers of this stage see it too
+                self.inbox.put(_DONE)
+                with self._lock:
+                    self._running -= 1
+                    last = self._running == 0
+                if last and self.flush is not None:
+                    self._flush()
+                if last and self.outbox is not None:
+                    self.outbox.put(_DONE)
+                return
+
+            start = time.perf_counter()
+            try:
+                result = self.func(item)
+            except Exception as e:
+                print(f"Error in {self.name} stage for {getattr(item, 'name', item)}: {str(e)}")
+                result = None
+                with self._lock:
+                    self.failed += 1
+            end = time.perf_counter()
+            with self._lock:
+                self.items += result is not None
+                self.busy_seconds += end - start
+                self.first_start = min(self.first_start or start, start)
+                self.last_end = max(self.last_end or end, end)
+
+            if result is not None and self.outbox is not None:
+                self.outbox.put(result)
+                with self._lock:
+                    self.blocked_seconds += time.perf_counter() - end
+
+    def throughput(self) -> dict[str, float]:
+        active_seconds = (self.last_end or 0.0) - (self.first_start or 0.0)
+        return {
+            "workers": len(self._threads),
+            "items": self.items,
+            "failed": self.failed,
+            "active_seconds": active_seconds,
+            "busy_seconds": self.busy_seconds,
+            "blocked_seconds": self.blocked_seconds,
+            "items_per_second": self.items / active_seconds if active_seconds else 0.0,
+        }
+
+
+def run_ingestion_pipeline(
+    sources: list[Path] | list[str],
+    store: ElementStore,
+    extract: Callable[[Path], str | None] | None = None,
+    rebuild: bool = False,
+) -> None:
+    """
+    Ingest documents through concurrent extract, summarize and index stages connected by
+    bounded queues. The index stage embeds and writes the summaries of several files in
+    large batches, a file is searchable as soon as the batch with its summaries is written.
+    Progress is checkpointed per element: a re-run resumes where the last one stopped and
+    only removes documents of files that are gone once every file was ingested.
+    sources: raw documents, or names of processed files in the store if extract is None
+    store: element store the processed files are read from
+    extract: writes a raw document to the store and returns its name, None if it failed
+    rebuild: discard the checkpoints and the index and start from scratch
+    """
+    embeddings = create_embeddings()
+    vectorstore = create_vectorstore(embeddings)
+    docstore = create_docstore()
+    model = create_chat_model()
+    text_chain = create_text_summarize_chain(model)
+    image_chain = create_image_summarize_chain(model)
+    checkpoint = IngestionCheckpoint(vectorstore)
+    if rebuild:
+        checkpoint.clear()
+        reset_stores(vectorstore, docstore)
+    else:
+        vectorstore.create_collection()
+        create_text_search_index(vectorstore)
+        create_metadata_index(vectorstore)
+        print(f"Checkpointed elements: {checkpoint.progress()}")
+    deduplicator = ImageDeduplicator(
+        min_side=config.IMAGE_MIN_SIDE,
+        min_entropy=config.IMAGE_MIN_ENTROPY,
+        max_distance=config.IMAGE_PHASH_DISTANCE,
+    )
+    # Near copies of images indexed by earlier runs keep pointing to the same image
+    deduplicator.seed(checkpoint.image_hashes())
+    indexer = BatchIndexer(
+        vectorstore,
+        docstore,
+        embeddings,
+        checkpoint,
+        max_tokens=config.EMBED_BATCH_TOKENS,
+        max_inputs=config.EMBED_BATCH_SIZE,
+        ingestion_version=current_ingestion_version(),
+    )
+    ingested_ids: list[str] = []
+
+    def extract_file(source: Path | str) -> FileItem | None:
+        file_name = source
+        if extract is not None:
+            file_name = checkpoint.extracted_file(source)
+            if file_name is None or not store.has_file(file_name):
+                file_name = extract(source)
+                if file_name is None:
+                    raise RuntimeError(f"Could not extract {source}")
+                checkpoint.save_extracted(source, file_name)
+        texts, tables, images = store.load_file_data(file_name)
+        if not (texts or tables or images):
+            return None
+        item = FileItem.from_file_data(file_name, texts, tables, images, deduplicator)
+        checkpoint.save_image_hashes(deduplicator.pop_new_hashes())
+        return item
+
+    def summarize_file(item: FileItem) -> FileItem:
+        item.checkpointed = checkpoint.load(item.all_doc_ids())
+        failed = 0
+        for kind in KINDS:
+            doc_ids = item.doc_ids[kind]
+            summaries = {
+                i: item.checkpointed[doc_id]["summary"]
+                for i, doc_id in enumerate(doc_ids)
+                if item.checkpointed.get(doc_id, {}).get("summary") is not None
+            }
+            pending = [i for i in range(len(doc_ids)) if i not in summaries]
+            if not pending:
+                item.summaries[kind] = [summaries[i] for i in range(len(doc_ids))]
+                continue
+            if kind == "images":
+                chain = image_chain
+                inputs = [(item.contents[kind][i], item.image_formats[i]) for i in pending]
+            else:
+                chain = text_chain
+                inputs = [item.contents[kind][i] for i in pending]
+            with run_report.stage(f"summarize_{kind}", item.name):
+                # Every summary is checkpointed as soon as it arrives, so none is paid twice
+                for j, summary in chain.batch_as_completed(
+                    inputs, {"max_concurrency": 5}, return_exceptions=True
+                ):
+                    if isinstance(summary, Exception):
+                        failed += 1
+                        continue
+                    summaries[pending[j]] = summary
+                    checkpoint.save_summary(doc_ids[pending[j]], item.name, kind, summary)
+            if len(summaries) == len(doc_ids):
+                item.summaries[kind] = [summaries[i] for i in range(len(doc_ids))]
+        if failed:
+            raise RuntimeError(f"{failed} summaries failed, they are retried on the next run")
+        return item
+
+    def index_file(item: FileItem) -> FileItem:
+        rows = []
+        for kind, summaries in item.summaries.items():
+            for i, doc_id in enumerate(item.doc_ids[kind]):
+                state = item.checkpointed.get(doc_id, {})
+                if state.get("indexed"):
+                    continue
+                rows.append(
+                    IndexRow(
+                        item.name,
+                        kind,
+                        i,
+                        doc_id,
+                        summaries[i],
+                        item.contents[kind][i],
+                        state.get("embedding"),
+                    )
+                )
+        # Embedded and written together with the summaries of other files
+        indexer.add(rows)
+        ingested_ids.extend(item.all_doc_ids())
+        return item
+
+    sources_queue: Queue = Queue()
+    for source in sources:
+        sources_queue.put(source)
+    sources_queue.put(_DONE)
+    extracted: Queue = Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+    summarized: Queue = Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+    stages = [
+        Stage("extract", extract_file, config.EXTRACT_WORKERS, sources_queue, extracted),
+        Stage("summarize", summarize_file, config.SUMMARIZE_WORKERS, extracted, summarized),
+        # One worker, the batch is shared by all files
+        Stage(
+            "index",
+            index_file,
+            1,
+            summarized,
+            None,
+            flush=indexer.flush,
+            flush_interval=config.INDEX_FLUSH_SECONDS,
+        ),
+    ]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+
+    removed: list[str] = []
+    if any(stage.failed for stage in stages):
+        print("Some files were not fully ingested, run the ingestion again to resume")
+    elif ingested_ids:
+        removed = checkpoint.prune(ingested_ids)
+        if removed:
+            docstore.mdelete(removed)
+            bump_knowledge_version(vectorstore, "multimodalrag")
+            print(f"Removed {len(removed)} documents of files that are no longer ingested")
+    # part_2 reads the options of its metadata filters again when this version changes,
+    # once per run: they take a scan of the whole collection
+    if indexer.rows or removed:
+        bump_knowledge_version(vectorstore, "multimodalrag/metadata")
+
+    run_report.record_counts(
+        "images",
+        **deduplicator.counts,
+        vision_calls_avoided=deduplicator.vision_calls_avoided(),
+    )
+    print(
+        f"Images: {deduplicator.counts}, "
+        f"{deduplicator.vision_calls_avoided()} vision calls avoided by deduplication"
+    )
+    rate_limit = get_rate_limiter().counts
+    run_report.record_counts("rate_limit", **rate_limit)
+    print(
+        f"Rate limit: {rate_limit['admitted']} calls admitted after waiting "
+        f"{rate_limit['waited_seconds']:.1f} s in total, {rate_limit['shed']} shed"
+    )
+    run_report.record_throughput("index_batches", batches=indexer.batches, documents=indexer.rows)
+    for stage in stages:
+        throughput = stage.throughput()
+        run_report.record_throughput(stage.name, **throughput)
+        print(
+            f"{stage.name:>9}: {throughput['items']} files, "
+            f"{throughput['items_per_second']:.2f} files/s, "
+            f"busy {throughput['busy_seconds']:.1f} s, "
+            f"blocked by the next stage {throughput['blocked_seconds']:.1f} s"
+        )
@@ -0,0 +1,220 @@
+import cProfile
+import json
+import math
+import os
+import pstats
+import resource
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+import tiktoken
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+from langchain_core.outputs import LLMResult
+
+# (stage, file) the current thread is working on, used to attribute API calls and bytes.
+# LangChain's batch executors copy the context, so summarization threads inherit it.
+_current_stage: ContextVar[tuple[str, str | None] | None] = ContextVar(
+    "current_stage", default=None
+)
+
+
+def _peak_rss_mb() -> float:
+    """Highest RSS of the process so far, it never decreases."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _current_rss_mb() -> float:
+    """RSS of the process now, the peak so far where /proc is not available."""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return _peak_rss_mb()
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def _empty_stats() -> dict[str, float]:
+    return {
+        "runs": 0,
+        "wall_seconds": 0.0,
+        "cpu_seconds": 0.0,
+        "rss_mb": 0.0,
+        "api_calls": 0,
+        "tokens": 0,
+        "bytes_written": 0,
+    }
+
+
+class RunReport:
+    """
+    Collects wall time, process CPU time, RSS, API calls, tokens and bytes written per
+    stage and per file of an ingestion run, and writes them as a JSON report. A stage's
+    rss_mb is the highest RSS sampled when it started or ended, the run's peak_rss_mb
+    the highest RSS of the whole run.
+    Stages may be nested, counters go to the innermost one. With profile_stages, every
+    outermost stage runs under cProfile, one profiler per thread, and the merged profile
+    of the slowest stage is kept.
+    """
+
+    def __init__(self) -> None:
+        self.profile_stages = False
+        self.started_at = datetime.now(timezone.utc)
+        self._start = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._stages: dict[str, dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._profiles: dict[tuple[str, int], cProfile.Profile] = {}
+        self._throughput: dict[str, dict[str, float]] = {}
+        self._counts: dict[str, dict[str, float]] = {}
+
+    def _stats(self, stage: str, file: str | None) -> dict[str, float]:
+        stage_stats = self._stages.setdefault(stage, {**_empty_stats(), "files": {}})
+        if file is None:
+            return stage_stats
+        return stage_stats["files"].setdefault(file, _empty_stats())
+
+    def _add(self, stage: str, file: str | None, **values: float) -> None:
+        with self._lock:
+            targets = [self._stats(stage, None)]
+            if file is not None:
+                targets.append(self._stats(stage, file))
+            for stats in targets:
+                for key, value in values.items():
+                    if key == "rss_mb":
+                        stats[key] = max(stats[key], value)
+                    else:
+                        stats[key] += value
+
+    @contextmanager
+    def stage(self, name: str, file: str | None = None) -> Iterator[None]:
+        """Measure a stage, optionally for one input file."""
+        outermost = _current_stage.get() is None
+        profiler = None
+        if self.profile_stages and outermost:
+            key = (name, threading.get_ident())
+            profiler = self._profiles.get(key, cProfile.Profile())
+            try:
+                profiler.enable()
+                with self._lock:
+                    self._profiles[key] = profiler
+            except ValueError:
+                # Python 3.12+ allows one active profiler per process, not per thread
+                profiler = None
+        token = _current_stage.set((name, file))
+        start_rss = _current_rss_mb()
+        start, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+            _current_stage.reset(token)
+            if profiler is not None:
+                profiler.disable()
+            self._add(
+                name,
+                file,
+                runs=1,
+                wall_seconds=wall,
+                cpu_seconds=cpu,
+                rss_mb=max(start_rss, _current_rss_mb()),
+            )
+
+    def count_api_call(self, calls: int = 1, tokens: int = 0) -> None:
+        current = _current_stage.get() or ("unattributed", None)
+        self._add(*current, api_calls=calls, tokens=tokens)
+
+    def count_bytes_written(self, n_bytes: int) -> None:
+        current = _current_stage.get() or ("unattributed", None)
+        self._add(*current, bytes_written=n_bytes)
+
+    def record_throughput(self, stage: str, **values: float) -> None:
+        """Record the items processed by a pipeline stage and how long it was active."""
+        with self._lock:
+            self._throughput[stage] = dict(values)
+
+    def record_counts(self, name: str, **values: float) -> None:
+        """Record run-wide counters that belong to no single stage."""
+        with self._lock:
+            self._counts[name] = dict(values)
+
+    def to_dict(self) -> dict[str, Any]:
+        with self._lock:
+            report = {
+                "started_at": self.started_at.isoformat(),
+                "wall_seconds": time.perf_counter() - self._start,
+                "cpu_seconds": time.process_time() - self._start_cpu,
+                "peak_rss_mb": _peak_rss_mb(),
+                "stages": json.loads(json.dumps(self._stages)),
+            }
+            if self._throughput:
+                report["pipeline"] = json.loads(json.dumps(self._throughput))
+            if self._counts:
+                report["counts"] = json.loads(json.dumps(self._counts))
+            return report
+
+    def write(self, report_folder: Path) -> Path:
+        """Write the JSON report, and the cProfile dump of the slowest stage if profiled."""
+        report_folder.mkdir(parents=True, exist_ok=True)
+        report = self.to_dict()
+        name = f"ingestion_{self.started_at.strftime('%Y%m%dT%H%M%S')}"
+        if self._profiles:
+            stages = {stage for stage, _ in self._profiles}
+            slowest = max(stages, key=lambda s: report["stages"][s]["wall_seconds"])
+            profile_path = report_folder / f"{name}_{slowest}.prof"
+            pstats.Stats(
+                *[profile for (stage, _), profile in self._profiles.items() if stage == slowest]
+            ).dump_stats(profile_path)
+            report["profile"] = {"stage": slowest, "path": str(profile_path)}
+        report_path = report_folder / f"{name}.json"
+        with report_path.open("w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        return report_path
+
+
+run_report = RunReport()
+
+
+class ApiUsageCallbackHandler(BaseCallbackHandler):
+    """Counts chat model calls and their token usage in the run report."""
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        run_report.count_api_call(tokens=token_usage.get("total_tokens", 0))
+
+
+class CountingEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that times embedding as its own stage and counts API calls and
+    tokens in the run report. Calls are estimated from the wrapped model's chunk_size.
+    """
+
+    def __init__(self, embeddings: Embeddings, chunk_size: int = 2048) -> None:
+        self.embeddings = embeddings
+        self.chunk_size = chunk_size
+        self.tiktoken_model = tiktoken.get_encoding("cl100k_base")
+
+    def _count(self, texts: list[str]) -> None:
+        run_report.count_api_call(
+            calls=math.ceil(len(texts) / self.chunk_size),
+            tokens=sum(len(tokens) for tokens in self.tiktoken_model.encode_batch(texts)),
+        )
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        current = _current_stage.get()
+        with run_report.stage("embed", current[1] if current else None):
+            self._count(texts)
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        current = _current_stage.get()
+        with run_report.stage("embed", current[1] if current else None):
+            self._count([text])
+            return self.embeddings.embed_query(text)
@@ -0,0 +1,36 @@
+from collections.abc import Callable
+from functools import lru_cache
+from typing import Any
+
+import redis
+from common.ratelimit import RateLimiter
+from config import Config
+from langchain_core.runnables import Runnable, RunnableLambda
+
+config = Config()
+
+
+def admit_step(
+    rate_limiter: RateLimiter, deployment: str, count_tokens: Callable[[Any], int]
+) -> Runnable:
+    """Passes its input on once the deployment can take a call of count_tokens(input)."""
+
+    def admit(value: Any) -> Any:
+        rate_limiter.acquire(deployment, count_tokens(value))
+        return value
+
+    return RunnableLambda(admit)
+
+
+# data_load exports no metrics, the ingestion report reads RateLimiter.counts
+@lru_cache
+def get_rate_limiter() -> RateLimiter:
+    """Process-wide rate limiter, ingestion calls have batch priority."""
+    return RateLimiter(
+        redis.Redis.from_url(config.REDIS_URL, db=config.RATE_LIMIT_REDIS_DB),
+        None,
+        limits=config.LLM_RATE_LIMITS,
+        priority="batch",
+        max_wait_seconds=config.RATE_LIMIT_MAX_WAIT_SECONDS["batch"],
+        reserve=config.RATE_LIMIT_BATCH_RESERVE,
+    )
@@ -0,0 +1,54 @@
+import base64
+import io
+
+from image_dedup import ImageDeduplicator
+from PIL import Image, ImageDraw
+
+
+def encode(image: Image.Image) -> str:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def bar_chart() -> Image.Image:
+    image = Image.new("RGB", (600, 400), "white")
+    draw = ImageDraw.Draw(image)
+    for i, height in enumerate((120, 250, 180, 300)):
+        draw.rectangle((60 + i * 130, 380 - height, 140 + i * 130, 380), fill="steelblue")
+    return image
+
+
+def diagram() -> Image.Image:
+    """Two outlined boxes with a label each, joined by a line."""
+    image = Image.new("RGB", (600, 400), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((50, 50, 200, 120), outline="black")
+    draw.rectangle((350, 250, 550, 330), outline="black")
+    draw.line((200, 85, 350, 290), fill="black")
+    draw.text((70, 75), "Input", fill="black")
+    draw.text((370, 280), "Model", fill="black")
+    return image
+
+
+def test_charts_and_diagrams_are_not_decorative() -> None:
+    deduplicator = ImageDeduplicator()
+    for image in (bar_chart(), diagram()):
+        assert deduplicator.match(encode(image)) is not None
+    assert deduplicator.counts["decorative"] == 0
+
+
+def test_blank_and_tiny_images_are_decorative() -> None:
+    deduplicator = ImageDeduplicator()
+    assert deduplicator.match(encode(Image.new("RGB", (600, 400), "white"))) is None
+    assert deduplicator.match(encode(bar_chart().resize((48, 32)))) is None
+    assert deduplicator.counts["decorative"] == 2
+
+
+def test_copies_share_the_canonical_image() -> None:
+    deduplicator = ImageDeduplicator()
+    first = deduplicator.match(encode(bar_chart()))
+    exact = deduplicator.match(encode(bar_chart()))
+    near = deduplicator.match(encode(bar_chart().resize((540, 360))))
+    assert (first.kind, exact.kind, near.kind) == ("new", "exact", "near")
+    assert first.doc_id == exact.doc_id == near.doc_id
@@ -0,0 +1,71 @@
+import indexer
+import pytest
+import tiktoken
+from indexer import BatchIndexer, IndexRow
+
+
+class WordEncoding:
+    """One token per word, tiktoken's encodings are downloaded on first use."""
+
+    def encode(self, text: str) -> list[str]:
+        return text.split()
+
+
+class FakeCheckpoint:
+    def __init__(self) -> None:
+        self.indexed: list[str] = []
+
+    def save_indexed(self, doc_ids: list[str]) -> None:
+        self.indexed.extend(doc_ids)
+
+
+class FakeDocstore:
+    def mset(self, pairs: list[tuple[str, str]]) -> None:
+        pass
+
+
+@pytest.fixture
+def failing_copy(monkeypatch: pytest.MonkeyPatch) -> list[int]:
+    """COPY fails on the first call and succeeds afterwards, returns the rows written."""
+    written: list[int] = []
+
+    def copy_documents(vectorstore, rows: list[IndexRow], ingestion_version: str) -> None:
+        if not written:
+            written.append(0)
+            raise RuntimeError("COPY failed")
+        written.append(len(rows))
+
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: WordEncoding())
+    monkeypatch.setattr(indexer, "copy_documents", copy_documents)
+    monkeypatch.setattr(indexer, "bump_knowledge_version", lambda vectorstore, namespace: None)
+    return written
+
+
+def rows(file_name: str, count: int) -> list[IndexRow]:
+    return [
+        IndexRow(file_name, "texts", i, f"{file_name}-{i}", "summary", "content", [0.0])
+        for i in range(count)
+    ]
+
+
+def test_failed_flush_does_not_report_its_files(failing_copy, capsys) -> None:
+    checkpoint = FakeCheckpoint()
+    batch = BatchIndexer(
+        None, FakeDocstore(), None, checkpoint, max_inputs=2, ingestion_version="v1"
+    )
+    # The batch of a.pdf and the first row of b.pdf fails to flush when b.pdf is added
+    batch.add(rows("a.pdf", 1))
+    with pytest.raises(RuntimeError):
+        batch.add(rows("b.pdf", 3))
+
+    batch.add(rows("c.pdf", 1))
+    batch.flush()
+
+    output = capsys.readouterr().out
+    assert "Indexed c.pdf" in output
+    assert "Indexed a.pdf" not in output
+    assert "Indexed b.pdf" not in output
+    assert checkpoint.indexed == ["c.pdf-0"]
+    assert failing_copy == [0, 1]
+    # Nothing is left waiting for the rows that were dropped with the failed batch
+    assert batch._files == {}
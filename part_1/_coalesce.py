@@ -0,0 +1,66 @@
+import re
+import threading
+from collections.abc import Callable, Hashable
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+_TRAILING_PUNCTUATION = re.compile(r"[\s?!.]+$")
+
+
+def normalize_question(question: str) -> str:
+    """Questions differing only in case, spacing or final punctuation are the same request."""
+    return _TRAILING_PUNCTUATION.sub("", " ".join(question.casefold().split()))
+
+
+class _Call(Generic[T]):
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: T | None = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight(Generic[T]):
+    """
+    Runs a function once for concurrent calls with the same key: the first caller runs it,
+    the callers arriving while it runs wait and share its result or its exception.
+    Nothing is kept once the call returns, later calls run the function again.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _Call[T]] = {}
+        self.requests = 0
+        # Calls that shared the result of another one, i.e. calls saved
+        self.shared = 0
+
+    @property
+    def coalesce_ratio(self) -> float:
+        return self.shared / self.requests if self.requests else 0.0
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> tuple[T, bool]:
+        """Result of fn and whether it was shared with an identical call in flight."""
+        with self._lock:
+            self.requests += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result, not leader
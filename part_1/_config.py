@@ -29,6 +29,8 @@ class Config(BaseSettings):
     POSTGRES_PASSWORD: str = "postgres"
     POSTGRES_DB: str = "postgres"
 
+    REDIS_URL: str = "redis://host.docker.internal:6379"
+
     model_config = SettingsConfigDict(
         env_prefix="TI_",
         case_sensitive=True,
@@ -38,3 +40,16 @@ class Config(BaseSettings):
     )
 
     RAW_DATA_FOLDER: str = "txt_data"
+
+    METRICS_PORT: int = 9100
+
+    # (requests, tokens) per minute of each Azure OpenAI deployment, a budget shared by
+    # part_1, part_2 and data_load through this Redis database. Set it to the quotas of
+    # your deployments, e.g. TI_LLM_RATE_LIMITS='{"gpt-4o": [480, 80000]}'. Deployments
+    # not listed are not limited, so nothing is by default
+    LLM_RATE_LIMITS: dict[str, tuple[int, int]] = {}
+    RATE_LIMIT_REDIS_DB: int = 2
+    # Share of each budget batch ingestion leaves to chat, and how long a call of each
+    # priority may wait for capacity before it is rejected
+    RATE_LIMIT_BATCH_RESERVE: float = 0.2
+    RATE_LIMIT_MAX_WAIT_SECONDS: dict[str, float] = {"interactive": 10.0, "batch": 300.0}
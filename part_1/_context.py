@@ -0,0 +1,65 @@
+import hashlib
+
+import tiktoken
+
+
+class KnowledgeContext:
+    """
+    Retrieved chunks of one conversation, kept within a token budget.
+    Chunks are deduplicated by document id and by content. When the budget is exceeded,
+    chunks from the oldest turns are evicted first and, within a turn, the lowest ranked.
+    """
+
+    def __init__(self, max_tokens: int = 3000, model: str = "gpt-4") -> None:
+        self.max_tokens = max_tokens
+        self.tiktoken_model = tiktoken.encoding_for_model(model)
+        # doc_id -> (text, token count, turn, rank within the turn)
+        self._chunks: dict[str, tuple[str, int, int, int]] = {}
+        self._turn = 0
+
+    @property
+    def tokens(self) -> int:
+        return sum(n_tokens for _, n_tokens, _, _ in self._chunks.values())
+
+    def as_dict(self) -> dict[str, str]:
+        return {doc_id: text for doc_id, (text, _, _, _) in self._chunks.items()}
+
+    def to_prompt(self) -> str:
+        return "\n\n".join([f"{doc_id}: {text}" for doc_id, text in self.as_dict().items()])
+
+    def clear(self) -> None:
+        self._chunks.clear()
+
+    def add(self, chunks: dict[str, str]) -> None:
+        """Add the chunks of a new turn, ordered from best to worst match."""
+        self._turn += 1
+        content_hashes = {
+            hashlib.sha1(text.encode("utf-8")).digest(): doc_id
+            for doc_id, (text, _, _, _) in self._chunks.items()
+        }
+        for rank, (doc_id, text) in enumerate(chunks.items()):
+            if not doc_id or not text:
+                continue
+            content_hash = hashlib.sha1(text.encode("utf-8")).digest()
+            # Same text under another id: refresh the existing chunk instead
+            doc_id = content_hashes.get(content_hash, doc_id)
+            if doc_id in self._chunks:
+                text, n_tokens, _, _ = self._chunks.pop(doc_id)
+            else:
+                n_tokens = len(self.tiktoken_model.encode(text))
+            self._chunks[doc_id] = (text, n_tokens, self._turn, rank)
+            content_hashes[content_hash] = doc_id
+        self._evict()
+
+    def _evict(self) -> None:
+        tokens = self.tokens
+        # Oldest turn first, then the worst rank within that turn
+        for doc_id in sorted(
+            self._chunks, key=lambda d: (self._chunks[d][2], -self._chunks[d][3])
+        ):
+            if tokens <= self.max_tokens:
+                break
+            # The best match for the current question is always kept
+            if self._chunks[doc_id][2:] == (self._turn, 0):
+                continue
+            tokens -= self._chunks.pop(doc_id)[1]
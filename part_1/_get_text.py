@@ -1,16 +1,22 @@
 import json
+from datetime import datetime, timezone
 from pathlib import Path
 
 import psycopg2
 import tiktoken
 from _config import Config, logger
+from _metrics import STAGE_SECONDS, TOKENS
+from _ratelimit import get_rate_limiter
+from _search import ensure_metadata_index, ensure_text_search_index
+from common.cache import invalidate_answer_cache
 from openai import AzureOpenAI
 
 config = Config()
 
 
 class EmbeddingModel:
-    def __init__(self) -> None:
+    def __init__(self, priority: str = "interactive") -> None:
+        self.rate_limiter = get_rate_limiter(priority)
         self.client = AzureOpenAI(
             api_key=config.OAI_API_KEY,
             azure_endpoint=config.OAI_ENDPOINT,
@@ -32,17 +38,25 @@ class EmbeddingModel:
         chunks.append(chunk)
         return chunks
 
+    @STAGE_SECONDS.labels("embedding").time()
     def get_embedding(self, texts_to_embed: list[str]) -> list[list[float]]:
+        self.rate_limiter.acquire(
+            "text-embedding-ada-002",
+            sum(len(self.tiktoken_model.encode(text)) for text in texts_to_embed),
+        )
         response = self.client.embeddings.create(
             model="text-embedding-ada-002", input=texts_to_embed, dimensions=1536
         )
+        TOKENS.labels("text-embedding-ada-002", "prompt").inc(response.usage.prompt_tokens)
         return [item.embedding for item in response.data]
 
 
 def basic_extract_demo() -> None:
     # Load all text files from the data folders
     data = {}
-    em = EmbeddingModel()
+    # Chunks can be filtered by the load that wrote them
+    ingestion_version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    em = EmbeddingModel(priority="batch")
 
     logger.info("Loading text files...")
     for file in (Path(__file__).parent / config.RAW_DATA_FOLDER).glob("*.txt"):
@@ -71,6 +85,8 @@ def basic_extract_demo() -> None:
         port=config.POSTGRES_PORT,
     ) as conn:
         with conn.cursor() as cur:
+            ensure_text_search_index(cur)
+            ensure_metadata_index(cur)
             logger.info("Inserting embeddings into the database...")
             for document_id, embeddings_ in embeddings.items():
                 id_ = 0
@@ -87,11 +103,18 @@ def basic_extract_demo() -> None:
                         (
                             f"{document_id}_{id_}",
                             embedding,
-                            json.dumps({"document_id": document_id}),
+                            json.dumps(
+                                {
+                                    "document_id": document_id,
+                                    "type": "text",
+                                    "ingestion_version": ingestion_version,
+                                }
+                            ),
                             text,
                         ),
                     )
                     id_ += 1
+            invalidate_answer_cache(cur, "knowledge_base")
             conn.commit()
 
 
@@ -0,0 +1,31 @@
+from functools import lru_cache
+
+import redis
+from _config import Config
+from _metrics import LLM_QUEUE_SECONDS, LLM_SHED
+from common.ratelimit import RateLimiter
+
+config = Config()
+
+
+def _observe_wait(deployment: str, priority: str, seconds: float) -> None:
+    LLM_QUEUE_SECONDS.labels(deployment, priority).observe(seconds)
+
+
+def _observe_shed(deployment: str, priority: str) -> None:
+    LLM_SHED.labels(deployment, priority).inc()
+
+
+@lru_cache
+def get_rate_limiter(priority: str = "interactive") -> RateLimiter:
+    """Process-wide rate limiter for the calls of one priority."""
+    return RateLimiter(
+        redis.Redis.from_url(config.REDIS_URL, db=config.RATE_LIMIT_REDIS_DB),
+        None,
+        limits=config.LLM_RATE_LIMITS,
+        priority=priority,
+        max_wait_seconds=config.RATE_LIMIT_MAX_WAIT_SECONDS[priority],
+        reserve=config.RATE_LIMIT_BATCH_RESERVE if priority == "batch" else 0.0,
+        observe_wait=_observe_wait,
+        observe_shed=_observe_shed,
+    )
@@ -0,0 +1,170 @@
+import json
+from dataclasses import dataclass
+from typing import Any
+
+# Text search configuration used for both the generated column and the queries.
+TEXT_SEARCH_CONFIG = "english"
+
+# Idempotent so it can also upgrade databases created before the column existed.
+TEXT_SEARCH_SCHEMA = f"""
+ALTER TABLE knowledge_base
+    ADD COLUMN IF NOT EXISTS text_search tsvector
+    GENERATED ALWAYS AS (to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(text, ''))) STORED;
+CREATE INDEX IF NOT EXISTS knowledge_base_text_search_idx
+    ON knowledge_base USING gin (text_search);
+"""
+
+# Metadata filters are containment tests on additional_information, served by its GIN index
+METADATA_SCHEMA = """
+CREATE INDEX IF NOT EXISTS knowledge_base_metadata_idx
+    ON knowledge_base USING gin (additional_information jsonb_path_ops);
+"""
+
+# The searches read the chunks CTE: knowledge_base itself, or the chunks matching the
+# metadata filter, materialized first so the ivfflat index cannot drop matches by
+# filtering its approximate top-k afterwards
+VECTOR_SEARCH_QUERY = """
+WITH {chunks}
+SELECT document_id, text
+FROM chunks
+ORDER BY embedding <-> %(embedding)s::vector
+LIMIT %(k)s;
+"""
+
+# Vector and lexical candidates are ranked in separate CTEs and fused with
+# reciprocal-rank fusion, so both searches happen in a single round trip.
+# The question is turned into an OR query: plainto_tsquery would require every
+# word of a conversational question to be present in the chunk.
+HYBRID_SEARCH_QUERY = f"""
+WITH {{chunks}},
+query AS (
+    SELECT to_tsquery(
+        '{TEXT_SEARCH_CONFIG}',
+        replace(plainto_tsquery('{TEXT_SEARCH_CONFIG}', %(query)s)::text, ' & ', ' | ')
+    ) AS tsquery
+),
+vector_search AS (
+    SELECT document_id, text,
+           row_number() OVER (ORDER BY embedding <-> %(embedding)s::vector) AS rank
+    FROM chunks
+    ORDER BY embedding <-> %(embedding)s::vector
+    LIMIT %(candidates)s
+),
+lexical_search AS (
+    SELECT document_id, text,
+           row_number() OVER (ORDER BY ts_rank_cd(text_search, query.tsquery, 32) DESC) AS rank
+    FROM chunks, query
+    WHERE query.tsquery <> ''::tsquery AND text_search @@ query.tsquery
+    ORDER BY ts_rank_cd(text_search, query.tsquery, 32) DESC
+    LIMIT %(candidates)s
+)
+SELECT document_id,
+       coalesce(vector_search.text, lexical_search.text) AS text,
+       coalesce(1.0 / (%(rrf_k)s + vector_search.rank), 0.0)
+           + coalesce(1.0 / (%(rrf_k)s + lexical_search.rank), 0.0) AS score
+FROM vector_search
+FULL OUTER JOIN lexical_search USING (document_id)
+ORDER BY score DESC
+LIMIT %(k)s;
+"""
+
+FETCH_DOCUMENTS_QUERY = """
+SELECT document_id, text
+FROM knowledge_base
+WHERE document_id = ANY(%(document_ids)s);
+"""
+
+
+@dataclass(frozen=True)
+class MetadataFilter:
+    """
+    Restricts retrieval to chunks with one of the given values of every field that has
+    values: the source file (the document_id in additional_information), the element
+    type and the ingestion version.
+    """
+
+    files: tuple[str, ...] = ()
+    types: tuple[str, ...] = ()
+    ingestion_versions: tuple[str, ...] = ()
+
+    def __bool__(self) -> bool:
+        return bool(self.files or self.types or self.ingestion_versions)
+
+    def containments(self) -> list[list[str]]:
+        """For each restricted field, the jsonb values of which a chunk must contain one."""
+        fields = (
+            ("document_id", self.files),
+            ("type", self.types),
+            ("ingestion_version", self.ingestion_versions),
+        )
+        return [
+            [json.dumps({key: value}) for value in values] for key, values in fields if values
+        ]
+
+
+def _chunks(metadata_filter: MetadataFilter | None) -> tuple[str, dict[str, list[str]]]:
+    """The chunks CTE of the search queries and its parameters."""
+    columns = "SELECT document_id, text, embedding, text_search FROM knowledge_base"
+    if not metadata_filter:
+        # Inlined, so the searches still use the indexes of knowledge_base
+        return f"chunks AS NOT MATERIALIZED ({columns})", {}
+    conditions, params = [], {}
+    for i, values in enumerate(metadata_filter.containments()):
+        conditions.append(f"additional_information @> ANY(%(filter_{i})s::jsonb[])")
+        params[f"filter_{i}"] = values
+    return f"chunks AS MATERIALIZED ({columns} WHERE {' AND '.join(conditions)})", params
+
+
+def ensure_text_search_index(cur: Any) -> None:
+    """Add the generated tsvector column and its GIN index to knowledge_base."""
+    cur.execute(TEXT_SEARCH_SCHEMA)
+
+
+def ensure_metadata_index(cur: Any) -> None:
+    """Add the GIN index of the metadata filters to knowledge_base."""
+    cur.execute(METADATA_SCHEMA)
+
+
+def fetch_documents(cur: Any, document_ids: list[str]) -> dict[str, str]:
+    """Texts of the given chunks, keyed by document_id."""
+    cur.execute(FETCH_DOCUMENTS_QUERY, {"document_ids": document_ids})
+    return {document_id: text for document_id, text in cur.fetchall()}
+
+
+def vector_search(
+    cur: Any, embedding: list[float], k: int, metadata_filter: MetadataFilter | None = None
+) -> list[tuple[str, str]]:
+    """Top-k chunks by embedding distance, among those matching the metadata filter."""
+    chunks, params = _chunks(metadata_filter)
+    cur.execute(
+        VECTOR_SEARCH_QUERY.format(chunks=chunks), {"embedding": embedding, "k": k, **params}
+    )
+    return [(document_id, text) for document_id, text in cur.fetchall()]
+
+
+def hybrid_search(
+    cur: Any,
+    query: str,
+    embedding: list[float],
+    k: int,
+    candidates: int = 20,
+    rrf_k: int = 60,
+    metadata_filter: MetadataFilter | None = None,
+) -> list[tuple[str, str]]:
+    """Top-k chunks by reciprocal-rank fusion of vector and full-text search.
+    candidates: number of hits taken from each search before fusion
+    rrf_k: RRF damping constant, 60 is the value from the original paper
+    metadata_filter: only search the chunks matching it"""
+    chunks, params = _chunks(metadata_filter)
+    cur.execute(
+        HYBRID_SEARCH_QUERY.format(chunks=chunks),
+        {
+            "query": query,
+            "embedding": embedding,
+            "k": k,
+            "candidates": max(candidates, k),
+            "rrf_k": rrf_k,
+            **params,
+        },
+    )
+    return [(document_id, text) for document_id, text, _ in cur.fetchall()]
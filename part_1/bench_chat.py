@@ -0,0 +1,89 @@
+"""End-to-end chat latency of the chatbot under concurrent users.
+
+Every simulated user asks one question through Chatbot.chat in its own thread, the
+answer cache and coalescing are disabled so each question embeds, retrieves and completes.
+A burst of users then asks the same question at once, which is answered once and shared.
+Run inside the part_1 container after `_get_text.py` has loaded the data:
+    python3 bench_chat.py --concurrency 1 10 50 --burst 50
+"""
+import argparse
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from _config import logger
+from bench_retrieval import QUESTIONS
+from chatbot import Chatbot
+
+
+def timed_chat(chatbot: Chatbot, question: str) -> float:
+    start = time.perf_counter()
+    chatbot.chat(question)
+    return time.perf_counter() - start
+
+
+def run_burst(chatbot: Chatbot, burst: int) -> dict[str, float]:
+    """Latency and calls saved when all users ask the same question at the same time."""
+    chatbot.coalesce = True
+    requests, shared = chatbot.answer_flight.requests, chatbot.answer_flight.shared
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=burst) as executor:
+        latencies = sorted(
+            executor.map(lambda _: timed_chat(chatbot, QUESTIONS[1][0]), range(burst))
+        )
+    elapsed = time.perf_counter() - start
+    requests = chatbot.answer_flight.requests - requests
+    shared = chatbot.answer_flight.shared - shared
+    metrics = {
+        f"burst{burst}.p50_ms": 1000 * statistics.median(latencies),
+        f"burst{burst}.p99_ms": 1000 * latencies[int(0.99 * (len(latencies) - 1))],
+        f"burst{burst}.answers_per_second": burst / elapsed,
+        f"burst{burst}.coalesce_ratio": shared / requests,
+        f"burst{burst}.saved_completions": shared,
+    }
+    logger.info(
+        f"burst of {burst}: p50={metrics[f'burst{burst}.p50_ms']:.0f} ms, "
+        f"{shared} of {requests} answers shared ({shared / requests:.0%})"
+    )
+    return metrics
+
+
+def run_benchmark(concurrency_levels: list[int], rounds: int, burst: int) -> dict[str, float]:
+    chatbot = Chatbot()
+    chatbot.answer_cache = None
+    chatbot.coalesce = False
+    # Warm up the embedding and completion clients
+    timed_chat(chatbot, QUESTIONS[0][0])
+
+    metrics: dict[str, float] = {}
+    for concurrency in concurrency_levels:
+        questions = [QUESTIONS[i % len(QUESTIONS)][0] for i in range(concurrency * rounds)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = sorted(executor.map(lambda q: timed_chat(chatbot, q), questions))
+        elapsed = time.perf_counter() - start
+        p99 = latencies[int(0.99 * (len(latencies) - 1))]
+        metrics[f"c{concurrency}.p50_ms"] = 1000 * statistics.median(latencies)
+        metrics[f"c{concurrency}.p99_ms"] = 1000 * p99
+        metrics[f"c{concurrency}.answers_per_second"] = len(latencies) / elapsed
+        logger.info(
+            f"concurrency={concurrency:>3}: p50={metrics[f'c{concurrency}.p50_ms']:.0f} ms, "
+            f"p99={1000 * p99:.0f} ms, {len(latencies) / elapsed:.1f} answers/s"
+        )
+    if burst:
+        metrics.update(run_burst(chatbot, burst))
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--rounds", type=int, default=3, help="Questions per simulated user")
+    parser.add_argument("--burst", type=int, default=50, help="Users asking the same question")
+    parser.add_argument("--json", type=Path, help="Write the metrics to this file")
+    args = parser.parse_args()
+    metrics = run_benchmark(args.concurrency, args.rounds, args.burst)
+    if args.json:
+        args.json.write_text(json.dumps(metrics, indent=2))
@@ -0,0 +1,86 @@
+"""Compare vector and hybrid retrieval quality and latency on the knowledge base.
+
+Run inside the part_1 container after `_get_text.py` has loaded the data:
+    python3 bench_retrieval.py
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+import psycopg2
+from _config import Config, logger
+from _get_text import EmbeddingModel
+from _search import hybrid_search, vector_search
+
+config = Config()
+
+# (question, phrase that must appear in a retrieved chunk for it to count as a hit)
+QUESTIONS: list[tuple[str, str]] = [
+    ("When was the Union of Lublin signed?", "Union of Lublin"),
+    ("Where can I see European bison?", "Białowieża Forest"),
+    ("What is bigos?", "hunter's stew"),
+    ("Which treaty gave Poland back its independence?", "Treaty of Versailles"),
+    ("Tell me about the Wieliczka Salt Mine", "Wieliczka"),
+    ("Is Jagiellonian University old?", "Jagiellonian University"),
+    ("How long is school compulsory?", "between the ages of 7 and 18"),
+    ("What language family does Polish belong to?", "West Slavic"),
+]
+
+K_VALUES = (1, 2, 3, 5)
+
+
+def _first_hit_rank(results: list[tuple[str, str]], expected: str) -> int | None:
+    for rank, (_, text) in enumerate(results, start=1):
+        if expected.lower() in text.lower():
+            return rank
+    return None
+
+
+def run_benchmark() -> dict[str, float]:
+    em = EmbeddingModel()
+    embeddings = em.get_embedding([question for question, _ in QUESTIONS])
+    max_k = max(K_VALUES)
+    metrics: dict[str, float] = {}
+
+    with psycopg2.connect(
+        dbname=config.POSTGRES_DB,
+        user=config.POSTGRES_USER,
+        password=config.POSTGRES_PASSWORD,
+        host=config.POSTGRES_HOST,
+        port=config.POSTGRES_PORT,
+    ) as conn:
+        with conn.cursor() as cur:
+            for mode in ("vector", "hybrid"):
+                ranks = []
+                latencies = []
+                for (question, expected), embedding in zip(QUESTIONS, embeddings, strict=True):
+                    start = time.perf_counter()
+                    if mode == "hybrid":
+                        results = hybrid_search(cur, question, embedding, max_k)
+                    else:
+                        results = vector_search(cur, embedding, max_k)
+                    latencies.append(time.perf_counter() - start)
+                    ranks.append(_first_hit_rank(results, expected))
+
+                mrr = sum(1 / rank for rank in ranks if rank) / len(ranks)
+                metrics[f"{mode}.mrr"] = mrr
+                metrics[f"{mode}.mean_latency_ms"] = 1000 * sum(latencies) / len(latencies)
+                recall = ", ".join(
+                    f"recall@{k}={sum(1 for rank in ranks if rank and rank <= k) / len(ranks):.2f}"
+                    for k in K_VALUES
+                )
+                logger.info(
+                    f"{mode:>6}: {recall}, MRR={mrr:.3f}, "
+                    f"mean latency={metrics[f'{mode}.mean_latency_ms']:.1f} ms"
+                )
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--json", type=Path, help="Write the metrics to this file")
+    args = parser.parse_args()
+    metrics = run_benchmark()
+    if args.json:
+        args.json.write_text(json.dumps(metrics, indent=2))
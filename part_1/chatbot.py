@@ -1,10 +1,31 @@
+import time
+
 import psycopg2
+import tiktoken
+from _coalesce import SingleFlight, normalize_question
 from _config import Config, logger
+from _context import KnowledgeContext
 from _get_text import EmbeddingModel
+from _metrics import PROMPT_TOKENS, SINGLE_FLIGHT, STAGE_SECONDS, TOKENS
+from _ratelimit import get_rate_limiter
+from _search import MetadataFilter, fetch_documents, hybrid_search, vector_search
+from common.cache import SemanticCache
+from common.ratelimit import RateLimitExceeded
 from openai import AzureOpenAI
 
 config = Config()
 
+CONNECTION_PARAMS = {
+    "dbname": config.POSTGRES_DB,
+    "user": config.POSTGRES_USER,
+    "password": config.POSTGRES_PASSWORD,
+    "host": config.POSTGRES_HOST,
+    "port": config.POSTGRES_PORT,
+}
+
+# Completion tokens charged against the rate limit, no max_tokens bounds the answers
+COMPLETION_TOKENS_ESTIMATE = 1000
+
 
 class Chatbot:
     def __init__(self) -> None:
@@ -19,48 +40,195 @@ class Chatbot:
         Please provide the context you used at the end of a given paragraph as (_name_).
     
         Context: """
-        self.knowledge_context: dict[str, str] = dict()
+        # Token budget for the retrieved context of one conversation
+        self.context_max_tokens: int = 3000
         self.number_of_contexts: int = 1
+        # "hybrid" fuses vector and full-text search, "vector" is embedding distance only
+        self.search_mode: str = "hybrid"
+        # Serve earlier answers to near-identical questions, None disables the cache
+        self.answer_cache: SemanticCache | None = SemanticCache(
+            CONNECTION_PARAMS, namespace="knowledge_base", similarity_threshold=0.95
+        )
+        # Identical questions asked at the same time share one retrieval and, when their
+        # conversations have no context yet, the whole answer
+        self.coalesce: bool = True
+        self.retrieval_flight: SingleFlight[tuple] = SingleFlight()
+        self.answer_flight: SingleFlight[tuple[dict[str, str], str]] = SingleFlight()
+        # Chat calls share the deployments' budget with part_2 and ingestion, ahead of the latter
+        self.rate_limiter = get_rate_limiter("interactive")
+        self.tiktoken_model = tiktoken.encoding_for_model("gpt-4")
 
-    def _lookup_in_textbook(self, text: str) -> dict[str, str]:
+    @STAGE_SECONDS.labels("lookup_in_textbook").time()
+    def _lookup_in_textbook(
+        self,
+        text: str,
+        question_embedding: list[float] | None = None,
+        metadata_filter: MetadataFilter | None = None,
+    ) -> dict[str, str]:
         """Lookup the text in the textbook and return the relevant context."""
-        question_embedding = EmbeddingModel().get_embedding(text)[0]
+        if question_embedding is None:
+            question_embedding = EmbeddingModel().get_embedding(text)[0]
 
-        with psycopg2.connect(
-            dbname=config.POSTGRES_DB,
-            user=config.POSTGRES_USER,
-            password=config.POSTGRES_PASSWORD,
-            host=config.POSTGRES_HOST,
-            port=config.POSTGRES_PORT,
-        ) as conn:
+        with psycopg2.connect(**CONNECTION_PARAMS) as conn:
             with conn.cursor() as cur:
-                vector_search_query = f"SELECT document_id, text FROM knowledge_base ORDER BY embedding <-> %s::vector LIMIT {self.number_of_contexts};"
-                cur.execute(vector_search_query, (question_embedding,))
-                results = cur.fetchall()
+                if self.search_mode == "hybrid":
+                    results = hybrid_search(
+                        cur,
+                        text,
+                        question_embedding,
+                        self.number_of_contexts,
+                        metadata_filter=metadata_filter,
+                    )
+                else:
+                    results = vector_search(
+                        cur, question_embedding, self.number_of_contexts, metadata_filter
+                    )
                 if not results:
                     return {"": ""}
         return {result[0]: result[1] for result in results}
 
-    def _get_knowledge_context_str(self) -> str:
-        return "\n\n".join(
-            [f"{doc_id}: {text}" for doc_id, text in self.knowledge_context.items()]
+    def new_context(self) -> KnowledgeContext:
+        """Create the retrieved context state of a new conversation."""
+        return KnowledgeContext(max_tokens=self.context_max_tokens)
+
+    def _lookup_in_cache(
+        self, question_embedding: list[float]
+    ) -> tuple[str, dict[str, str]] | None:
+        """Return a cached answer for the question and the documents it was based on."""
+        try:
+            with STAGE_SECONDS.labels("answer_cache_lookup").time():
+                cached = self.answer_cache.lookup(question_embedding)
+            if cached is None:
+                return None
+            answer, doc_ids = cached
+            with psycopg2.connect(**CONNECTION_PARAMS) as conn:
+                with conn.cursor() as cur:
+                    documents = fetch_documents(cur, doc_ids)
+            return answer, {doc_id: documents[doc_id] for doc_id in doc_ids if doc_id in documents}
+        except Exception as e:
+            logger.exception(f"Error while looking up in answer cache: {e}")
+            return None
+
+    def _retrieve(
+        self, text: str, metadata_filter: MetadataFilter | None = None
+    ) -> tuple[list[float], tuple[str, dict[str, str]] | None, dict[str, str]]:
+        """Embed the text, then find a cached answer or else retrieve the chunks for it.
+        Cached answers are not scoped, filtered questions always retrieve."""
+        question_embedding = EmbeddingModel().get_embedding(text)[0]
+        if self.answer_cache is not None and not metadata_filter:
+            cached = self._lookup_in_cache(question_embedding)
+            if cached is not None:
+                return question_embedding, cached, {}
+        return (
+            question_embedding,
+            None,
+            self._lookup_in_textbook(text, question_embedding, metadata_filter),
         )
 
-    def chat(self, user_message: str) -> tuple[dict[str, str], str | None]:
+    def _request_key(self, user_message: str, metadata_filter: MetadataFilter | None) -> tuple:
+        return (
+            normalize_question(user_message),
+            self.search_mode,
+            self.number_of_contexts,
+            metadata_filter or None,
+        )
+
+    def chat(
+        self,
+        user_message: str,
+        context: KnowledgeContext | None = None,
+        metadata_filter: MetadataFilter | None = None,
+    ) -> tuple[dict[str, str], str | None]:
+        """Answer the message using the context of its conversation.
+        Without a context only the chunks retrieved for this message are used.
+        With a metadata filter only matching chunks are retrieved, e.g. of one file."""
+        if context is None:
+            context = self.new_context()
+        if not self.coalesce or context.as_dict():
+            answer = self._answer(user_message, context, metadata_filter)
+            return context.as_dict(), answer
+
+        # Without earlier context the answer only depends on the message and the settings
+        def answer_new_conversation() -> tuple[dict[str, str], str | None]:
+            new_context = self.new_context()
+            answer = self._answer(user_message, new_context, metadata_filter)
+            return new_context.as_dict(), answer
+
+        (chunks, answer), shared = self.answer_flight.do(
+            self._request_key(user_message, metadata_filter), answer_new_conversation
+        )
+        SINGLE_FLIGHT.labels("answer", "shared" if shared else "leader").inc()
+        context.add(chunks)
+        return context.as_dict(), answer
+
+    def _answer(
+        self,
+        user_message: str,
+        context: KnowledgeContext,
+        metadata_filter: MetadataFilter | None = None,
+    ) -> str | None:
+        start = time.perf_counter()
+        question_embedding = None
+        retrieved_ids: list[str] = []
         try:
-            self.knowledge_context.update(self._lookup_in_textbook(user_message))
+            if self.coalesce:
+                (question_embedding, cached, retrieved), shared = self.retrieval_flight.do(
+                    self._request_key(user_message, metadata_filter),
+                    lambda: self._retrieve(user_message, metadata_filter),
+                )
+                SINGLE_FLIGHT.labels("retrieval", "shared" if shared else "leader").inc()
+            else:
+                question_embedding, cached, retrieved = self._retrieve(
+                    user_message, metadata_filter
+                )
+            if cached is not None:
+                cached_answer, documents = cached
+                context.add(documents)
+                return cached_answer
+
+            retrieved_ids = [doc_id for doc_id in retrieved if doc_id]
+            context.add(retrieved)
+        except RateLimitExceeded:
+            raise
         except Exception as e:
             logger.exception(f"Error while looking up in textbook: {e}")
-            self.knowledge_context = dict()
-
-        response = self.client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": self.system_message + self._get_knowledge_context_str(),
-                },
-                {"role": "user", "content": user_message},
-            ],
+            context.clear()
+
+        messages = [
+            {"role": "system", "content": self.system_message + context.to_prompt()},
+            {"role": "user", "content": user_message},
+        ]
+        prompt_tokens = sum(
+            len(self.tiktoken_model.encode(message["content"])) for message in messages
         )
-        return self.knowledge_context, response.choices[0].message.content
+        self.rate_limiter.acquire("gpt-4", prompt_tokens + COMPLETION_TOKENS_ESTIMATE)
+        with STAGE_SECONDS.labels("completion").time():
+            response = self.client.chat.completions.create(model="gpt-4", messages=messages)
+        answer = response.choices[0].message.content
+        if response.usage is not None:
+            PROMPT_TOKENS.observe(response.usage.prompt_tokens)
+            TOKENS.labels("gpt-4", "prompt").inc(response.usage.prompt_tokens)
+            TOKENS.labels("gpt-4", "completion").inc(response.usage.completion_tokens)
+            logger.info(
+                f"Prompt tokens: {response.usage.prompt_tokens} "
+                f"(retrieved context: {context.tokens})"
+            )
+
+        if (
+            self.answer_cache is not None
+            and question_embedding is not None
+            and retrieved_ids
+            and not metadata_filter
+        ):
+            try:
+                self.answer_cache.store(
+                    user_message,
+                    question_embedding,
+                    retrieved_ids,
+                    answer,
+                    time.perf_counter() - start,
+                )
+            except Exception as e:
+                logger.exception(f"Error while storing in answer cache: {e}")
+        STAGE_SECONDS.labels("chat").observe(time.perf_counter() - start)
+        return answer
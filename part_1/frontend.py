@@ -2,11 +2,14 @@ import logging
 
 import chainlit as cl
 
+from _metrics import start_metrics_server
 from chatbot import Chatbot
+from common.ratelimit import RateLimitExceeded
 
 chatbot = Chatbot()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
+start_metrics_server()
 
 
 @cl.on_message
@@ -21,11 +24,27 @@ async def main(message: cl.Message) -> None:
     history = history[-3:]
     cl.user_session.set("history", history)
 
-    # Get the chatbot's response
-    knowledge_context, response = chatbot.chat("\n\n".join(history))
+    # Retrieved context is kept per session, within the chatbot's token budget
+    context = cl.user_session.get("knowledge_context")
+    if context is None:
+        context = chatbot.new_context()
+        cl.user_session.set("knowledge_context", context)
+
+    # Get the chatbot's response in a worker thread, so the event loop keeps serving the
+    # other sessions and their identical questions can share this one's retrieval and answer
+    try:
+        knowledge_context, response = await cl.make_async(chatbot.chat)(
+            "\n\n".join(history), context
+        )
+    except RateLimitExceeded as e:
+        logger.warning(f"Message shed: {e}")
+        await cl.Message(
+            content="The assistant is very busy right now, please try again in a minute."
+        ).send()
+        return
 
     # Log and display retrieved context
-    logger.info(f"Retrieved Context: {chatbot._get_knowledge_context_str()}")
+    logger.info(f"Retrieved Context: {context.to_prompt()}")
 
     # Use Chainlit's classes for displaying retrieved context
     elements = [
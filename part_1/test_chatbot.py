@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+import pytest
+import tiktoken
+
+
+class WordEncoding:
+    """One token per word, tiktoken's encodings are downloaded on first use."""
+
+    def encode(self, text: str) -> list[str]:
+        return text.split()
+
+
+class FakeCompletions:
+    def create(self, model: str, messages: list[dict[str, str]]) -> SimpleNamespace:
+        message = SimpleNamespace(content=f"Answer to: {messages[-1]['content']}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+@pytest.fixture
+def chatbot(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(tiktoken, "encoding_for_model", lambda model: WordEncoding())
+    import chatbot as module
+
+    bot = module.Chatbot()
+    bot.client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions()))
+    bot.answer_cache = None
+    bot.rate_limiter = SimpleNamespace(acquire=lambda deployment, tokens: None)
+    retrieved = {
+        "first question": {"doc1": "Warsaw is the capital of Poland."},
+        "second question": {"doc2": "Krakow was the capital before Warsaw."},
+    }
+    bot._retrieve = lambda text, metadata_filter=None: ([0.0], None, retrieved[text])
+    return bot
+
+
+@pytest.mark.parametrize("coalesce", [True, False])
+def test_each_turn_returns_the_context_it_was_answered_with(chatbot, coalesce: bool) -> None:
+    chatbot.coalesce = coalesce
+    context = chatbot.new_context()
+
+    chunks, answer = chatbot.chat("first question", context)
+    assert chunks == {"doc1": "Warsaw is the capital of Poland."}
+    assert answer == "Answer to: first question"
+
+    chunks, answer = chatbot.chat("second question", context)
+    assert chunks == {
+        "doc1": "Warsaw is the capital of Poland.",
+        "doc2": "Krakow was the capital before Warsaw.",
+    }
+    assert chunks == context.as_dict()
+    assert answer == "Answer to: second question"
@@ -0,0 +1,51 @@
+from collections import OrderedDict
+
+from _coalesce import AsyncSingleFlight
+from langchain_core.embeddings import Embeddings
+
+
+class QueryEmbeddingCache(Embeddings):
+    """
+    Keeps the most recent query embeddings, so the answer cache lookup and the
+    retriever can embed the same question without paying for a second API call.
+    """
+
+    def __init__(self, embeddings: Embeddings, max_size: int = 1024) -> None:
+        self.embeddings = embeddings
+        self.max_size = max_size
+        self._cache: OrderedDict[str, list[float]] = OrderedDict()
+        self._in_flight: AsyncSingleFlight[list[float]] = AsyncSingleFlight()
+
+    def _get(self, text: str) -> list[float] | None:
+        embedding = self._cache.get(text)
+        if embedding is not None:
+            self._cache.move_to_end(text)
+        return embedding
+
+    def _put(self, text: str, embedding: list[float]) -> None:
+        self._cache[text] = embedding
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        embedding = self._get(text)
+        if embedding is None:
+            embedding = self.embeddings.embed_query(text)
+            self._put(text, embedding)
+        return embedding
+
+    async def aembed_query(self, text: str) -> list[float]:
+        embedding = self._get(text)
+        if embedding is None:
+            # Concurrent sessions asking the same question wait for one API call
+            embedding, _ = await self._in_flight.do(
+                text, lambda: self.embeddings.aembed_query(text)
+            )
+            self._put(text, embedding)
+        return embedding
@@ -0,0 +1,123 @@
+import asyncio
+import re
+from collections.abc import AsyncIterator, Awaitable, Callable, Hashable
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+P = TypeVar("P")
+
+_TRAILING_PUNCTUATION = re.compile(r"[\s?!.]+$")
+
+
+def normalize_question(question: str) -> str:
+    """Questions differing only in case, spacing or final punctuation are the same request."""
+    return _TRAILING_PUNCTUATION.sub("", " ".join(question.casefold().split()))
+
+
+class AsyncSingleFlight(Generic[T]):
+    """
+    Awaits a coroutine once for concurrent calls with the same key: the first caller starts
+    it, the callers arriving while it runs await the same task and share its result or its
+    exception. The task is not cancelled with the caller that started it.
+    """
+
+    def __init__(self) -> None:
+        self._tasks: dict[Hashable, asyncio.Task[T]] = {}
+        self.requests = 0
+        # Calls that shared the result of another one, i.e. calls saved
+        self.shared = 0
+
+    @property
+    def coalesce_ratio(self) -> float:
+        return self.shared / self.requests if self.requests else 0.0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> tuple[T, bool]:
+        """Result of fn and whether it was shared with an identical call in flight."""
+        self.requests += 1
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            self.shared += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return await asyncio.shield(task), shared
+
+
+class _SharedStream(Generic[P]):
+    def __init__(self, payload: P) -> None:
+        self.payload = payload
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.changed = asyncio.Condition()
+        self.task: asyncio.Task | None = None
+
+    async def replay(self) -> AsyncIterator[str]:
+        """All chunks from the first one, waiting for the ones not produced yet."""
+        position = 0
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: len(self.chunks) > position or self.done)
+                chunks = self.chunks[position:]
+            for chunk in chunks:
+                yield chunk
+            position += len(chunks)
+            if not chunks and self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class StreamSingleFlight(Generic[P]):
+    """
+    Streams one answer to concurrent requests with the same key. The first request starts
+    the stream in a task of its own, so the answer keeps coming when that request goes
+    away, and every request replays the chunks as they arrive. The first request's
+    payload, e.g. what its answer was based on, is handed to the others.
+    """
+
+    def __init__(self) -> None:
+        self._streams: dict[Hashable, _SharedStream[P]] = {}
+        self.requests = 0
+        # Requests that shared the stream of another one, i.e. completions saved
+        self.shared = 0
+
+    @property
+    def coalesce_ratio(self) -> float:
+        return self.shared / self.requests if self.requests else 0.0
+
+    def join(
+        self, key: Hashable, produce: Callable[[], AsyncIterator[str]], payload: P
+    ) -> tuple[AsyncIterator[str], P, bool]:
+        """Chunks of the answer, the payload of the first request and whether it is shared."""
+        self.requests += 1
+        stream = self._streams.get(key)
+        shared = stream is not None
+        if shared:
+            self.shared += 1
+        else:
+            stream = self._streams[key] = _SharedStream(payload)
+            stream.task = asyncio.ensure_future(self._pump(key, stream, produce))
+        return stream.replay(), stream.payload, shared
+
+    async def _pump(
+        self, key: Hashable, stream: _SharedStream[P], produce: Callable[[], AsyncIterator[str]]
+    ) -> None:
+        try:
+            async for chunk in produce():
+                async with stream.changed:
+                    stream.chunks.append(chunk)
+                    stream.changed.notify_all()
+        except asyncio.CancelledError as e:
+            stream.error = e
+            raise
+        except Exception as e:
+            stream.error = e
+        finally:
+            # Requests arriving from now on start a new stream
+            self._streams.pop(key, None)
+            async with stream.changed:
+                stream.done = True
+                stream.changed.notify_all()
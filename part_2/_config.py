@@ -31,6 +31,10 @@ class Config(BaseSettings):
     POSTGRES_PASSWORD: str = "postgres"
     POSTGRES_DB: str = "postgres"
 
+    # Connections per worker process for the async retrieval path
+    POSTGRES_POOL_SIZE: int = 10
+    REDIS_POOL_SIZE: int = 50
+
     model_config = SettingsConfigDict(
         env_prefix="TI_",
         case_sensitive=True,
@@ -40,3 +44,39 @@ class Config(BaseSettings):
     )
 
     RAW_DATA_FOLDER: str = "txt_data"
+
+    # Token budget of the multimodal prompt and number of past turns kept in memory
+    PROMPT_MAX_TOKENS: int = 8000
+    MEMORY_WINDOW_TURNS: int = 5
+
+    # Worker processes for decoding and resizing retrieved images
+    IMAGE_WORKERS: int = 2
+
+    # Retrieved images ranked below IMAGE_HIGH_DETAIL_RANKS among the retrieved documents
+    # may be attached at high detail and those below IMAGE_ATTACH_RANKS at low detail,
+    # within IMAGE_MAX_TOKENS per prompt. The others are replaced by their summaries
+    IMAGE_HIGH_DETAIL_RANKS: int = 1
+    IMAGE_ATTACH_RANKS: int = 3
+    IMAGE_MAX_TOKENS: int = 1000
+
+    METRICS_PORT: int = 9100
+
+    # Time each dependency check of the /ready endpoint may take, the first one also
+    # connects to Postgres and sets up the vector store
+    READINESS_TIMEOUT_SECONDS: float = 5.0
+
+    # Session state lives in this Redis database, apart from the docstore that data_load
+    # flushes on a rebuild, and expires after SESSION_TTL_SECONDS without a message
+    SESSION_REDIS_DB: int = 1
+    SESSION_TTL_SECONDS: int = 24 * 60 * 60
+
+    # (requests, tokens) per minute of each Azure OpenAI deployment, a budget shared by
+    # part_1, part_2 and data_load through this Redis database. Set it to the quotas of
+    # your deployments, e.g. TI_LLM_RATE_LIMITS='{"gpt-4o": [480, 80000]}'. Deployments
+    # not listed are not limited, so nothing is by default
+    LLM_RATE_LIMITS: dict[str, tuple[int, int]] = {}
+    RATE_LIMIT_REDIS_DB: int = 2
+    # Share of each budget batch ingestion leaves to chat, and how long a call of each
+    # priority may wait for capacity before it is rejected
+    RATE_LIMIT_BATCH_RESERVE: float = 0.2
+    RATE_LIMIT_MAX_WAIT_SECONDS: dict[str, float] = {"interactive": 10.0, "batch": 300.0}
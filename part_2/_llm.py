@@ -0,0 +1,29 @@
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+from _config import Config
+
+if TYPE_CHECKING:
+    from langchain_openai import AzureChatOpenAI
+
+config = Config()
+
+
+@lru_cache
+def get_chat_model(model: str = "gpt-4o", streaming: bool = True) -> "AzureChatOpenAI":
+    """
+    Process-wide chat model per model settings, so all sessions share one HTTP connection pool.
+    Per-request settings such as temperature and max_tokens are bound on top of it with
+    `.bind(...)`, which does not create a new client.
+    """
+    # Imported on first use, it is the slowest import of the workers
+    from langchain_openai import AzureChatOpenAI
+
+    return AzureChatOpenAI(
+        model=model,
+        max_tokens=2048,
+        temperature=0,
+        azure_endpoint=config.OAI_ENDPOINT,
+        api_key=config.OAI_API_KEY,
+        streaming=streaming,
+    )
@@ -0,0 +1,58 @@
+from _config import Config, logger
+from prometheus_client import Counter, Histogram, start_http_server
+
+config = Config()
+
+# Observing a histogram is a lock and a few additions, cheap enough to stay on permanently
+STAGE_SECONDS = Histogram(
+    "chatbot_stage_seconds",
+    "Duration of the stages on the chatbot hot path",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+# Streamed Azure responses carry no usage, so part_2 counts tokens locally with tiktoken
+TOKENS = Counter(
+    "chatbot_tokens",
+    "Tokens used by chat completions and embeddings",
+    ["model", "type"],
+)
+
+# Retrieved images by how the image policy put them in the prompt: attached at "high" or
+# "low" detail, as their "summary", or "dropped" without a summary or over the budget
+PROMPT_IMAGES = Counter(
+    "chatbot_prompt_images",
+    "Retrieved images by how they were included in the prompt",
+    ["detail"],
+)
+
+
+# The share of "shared" requests is the coalesce ratio, each one is a call saved
+SINGLE_FLIGHT = Counter(
+    "chatbot_single_flight_requests",
+    "Requests by stage, run (leader) or served by an identical request in flight (shared)",
+    ["stage", "outcome"],
+)
+
+
+LLM_QUEUE_SECONDS = Histogram(
+    "llm_queue_wait_seconds",
+    "Time LLM calls waited for rate limit capacity of the deployment",
+    ["deployment", "priority"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+LLM_SHED = Counter(
+    "llm_requests_shed",
+    "LLM calls rejected because the deployment had no capacity within their wait limit",
+    ["deployment", "priority"],
+)
+
+
+def start_metrics_server() -> None:
+    """Expose the Prometheus metrics of this process on METRICS_PORT."""
+    try:
+        start_http_server(config.METRICS_PORT)
+        logger.info(f"Serving metrics on port {config.METRICS_PORT}")
+    except OSError as e:
+        logger.warning(f"Could not start metrics server on port {config.METRICS_PORT}: {e}")
@@ -0,0 +1,188 @@
+import math
+import sys
+from collections.abc import Sequence
+from dataclasses import dataclass
+
+import tiktoken
+from _config import logger
+from _metrics import PROMPT_IMAGES, TOKENS
+from langchain_core.messages import BaseMessage, HumanMessage
+
+# Vision token accounting of the OpenAI chat models
+LOW_DETAIL_IMAGE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """
+    Estimate the prompt tokens of an image from its dimensions.
+    High detail images are scaled to fit 2048x2048, then their shortest side to 768px,
+    and cost a fixed amount per 512px tile on top of the low detail base cost.
+    """
+    if detail == "low":
+        return LOW_DETAIL_IMAGE_TOKENS
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+    return LOW_DETAIL_IMAGE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+
+@dataclass
+class ImagePolicy:
+    """
+    Decides how each retrieved image goes into the prompt from its rank among the retrieved
+    documents: the best ranked images at high detail, the next ones at low detail and the
+    others as the summary they were indexed with. Attached images share max_image_tokens,
+    an image that does not fit falls back to low detail, then to its summary.
+    """
+
+    # Images ranked below high_detail_ranks may be sent at high detail, below attach_ranks
+    # at low detail
+    high_detail_ranks: int = 1
+    attach_ranks: int = 3
+    max_image_tokens: int = 1000
+
+    def decide(self, images: list[dict]) -> list[tuple[dict, str, int]]:
+        """(image, "high", "low" or "summary", its tokens) for each image, best ranked first."""
+        budget = self.max_image_tokens
+        decisions = []
+        for image in sorted(images, key=lambda image: image["rank"]):
+            options = []
+            if image["rank"] < self.high_detail_ranks:
+                options.append("high")
+            if image["rank"] < self.attach_ranks:
+                options.append("low")
+            decision = ("summary", 0)
+            for detail in options:
+                n_tokens = estimate_image_tokens(image["width"], image["height"], detail)
+                if n_tokens <= budget:
+                    decision = (detail, n_tokens)
+                    budget -= n_tokens
+                    break
+            decisions.append((image, *decision))
+        return decisions
+
+
+# Every image attached at high detail, as before the policy
+ATTACH_ALL_IMAGES = ImagePolicy(
+    high_detail_ranks=sys.maxsize, attach_ranks=sys.maxsize, max_image_tokens=sys.maxsize
+)
+
+
+class PromptBuilder:
+    """
+    Builds the multimodal prompt within a token budget.
+    The instructions and the question are always included. The remaining budget is filled
+    following priority, a sequence of "texts", "images" and "history": texts and images in
+    retrieval order, history from the most recent message backwards until one does not fit.
+    The image policy decides at which detail each image is attached, images it leaves out
+    are replaced by their summaries among the texts.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 8000,
+        priority: Sequence[str] = ("texts", "images", "history"),
+        model: str = "gpt-4o",
+        image_policy: ImagePolicy | None = None,
+    ) -> None:
+        self.max_tokens = max_tokens
+        self.priority = tuple(priority)
+        self.model = model
+        self.image_policy = image_policy or ImagePolicy()
+        self.tiktoken_model = tiktoken.encoding_for_model(model)
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tiktoken_model.encode(text))
+
+    def build(
+        self,
+        instructions: str,
+        question: str,
+        history: list[BaseMessage],
+        texts: list[dict],
+        images: list[dict],
+    ) -> list[HumanMessage]:
+        return self.build_counted(instructions, question, history, texts, images)[0]
+
+    def build_counted(
+        self,
+        instructions: str,
+        question: str,
+        history: list[BaseMessage],
+        texts: list[dict],
+        images: list[dict],
+    ) -> tuple[list[HumanMessage], int]:
+        """The prompt and its estimated number of tokens."""
+        budget = self.max_tokens - self.count_tokens(instructions) - self.count_tokens(question)
+
+        history_lines = [
+            f"{'User' if message.type == 'human' else 'Assistant'}: {message.content}"
+            for message in history
+        ]
+        attached, summaries, without_summary = [], [], 0
+        for image, detail, n_tokens in self.image_policy.decide(images):
+            if detail != "summary":
+                attached.append(((image, detail), n_tokens))
+            elif image.get("summary"):
+                summaries.append({"content": f"Image: {image['summary']}\n"})
+            else:
+                without_summary += 1
+        candidates: dict[str, list[tuple[object, int]]] = {
+            "texts": [
+                (text, self.count_tokens(text["content"])) for text in [*texts, *summaries]
+            ],
+            "images": attached,
+            "history": [(line, self.count_tokens(line)) for line in reversed(history_lines)],
+        }
+        selected: dict[str, list] = {kind: [] for kind in candidates}
+        dropped: dict[str, int] = {kind: 0 for kind in candidates}
+        for kind in self.priority:
+            for i, (item, n_tokens) in enumerate(candidates[kind]):
+                if n_tokens <= budget:
+                    selected[kind].append(item)
+                    budget -= n_tokens
+                elif kind == "history":
+                    # Keep the history contiguous, older messages are dropped altogether
+                    dropped[kind] += len(candidates[kind]) - i
+                    break
+                else:
+                    dropped[kind] += 1
+
+        prompt_tokens = self.max_tokens - budget
+        TOKENS.labels(self.model, "prompt").inc(prompt_tokens)
+        for _, detail in selected["images"]:
+            PROMPT_IMAGES.labels(detail).inc()
+        PROMPT_IMAGES.labels("summary").inc(len(summaries))
+        PROMPT_IMAGES.labels("dropped").inc(without_summary + dropped["images"])
+        if any(dropped.values()):
+            logger.info(
+                f"Prompt budget of {self.max_tokens} tokens exceeded, dropped "
+                f"{dropped['texts']} texts, {dropped['images']} images and "
+                f"{dropped['history']} history messages"
+            )
+
+        chat_history = "\n".join(reversed(selected["history"]))
+        content: list[dict] = [
+            {
+                "type": "text",
+                "text": (
+                    f"{instructions}\n"
+                    f"Chat History:\n{chat_history}\n"
+                    f"User-provided question: {question}\n"
+                    f"Text and tables:\n{''.join([text['content'] for text in selected['texts']])}"
+                ),
+            }
+        ]
+        for image, detail in selected["images"]:
+            content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/{image['format']};base64,{image['content']}",
+                    "detail": detail,
+                },
+            })
+        return [HumanMessage(content=content)], prompt_tokens
@@ -0,0 +1,53 @@
+import asyncio
+import threading
+from collections.abc import Awaitable, Callable
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class LazyResource(Generic[T]):
+    """
+    A dependency created on first use instead of at import, so a worker starts serving
+    while its databases are still starting. A failed creation is not cached, the next
+    use tries again.
+    """
+
+    def __init__(self, name: str, factory: Callable[[], T]) -> None:
+        self.name = name
+        self._factory = factory
+        self._value: T | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def created(self) -> bool:
+        return self._value is not None
+
+    def get(self) -> T:
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory()
+        return self._value
+
+    async def aget(self) -> T:
+        """Like get, creating the resource in a thread so it does not block the event loop."""
+        if self._value is not None:
+            return self._value
+        return await asyncio.to_thread(self.get)
+
+
+async def run_checks(checks: dict[str, Callable[[], Awaitable]], timeout: float) -> dict[str, str]:
+    """Run the health checks concurrently, "ok" or the error of each."""
+
+    async def run(check: Callable[[], Awaitable]) -> str:
+        try:
+            await asyncio.wait_for(check(), timeout)
+            return "ok"
+        except asyncio.TimeoutError:
+            return f"timed out after {timeout} s"
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+
+    results = await asyncio.gather(*[run(check) for check in checks.values()])
+    return dict(zip(checks, results))
@@ -0,0 +1,228 @@
+import json
+
+from _coalesce import AsyncSingleFlight, normalize_question
+from _metrics import SINGLE_FLIGHT
+from _tracing import span
+from langchain.retrievers import MultiVectorRetriever
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents.base import Document
+from langchain_core.runnables.config import run_in_executor
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Parameters are cast explicitly so the queries also run on asyncpg, which has no codec
+# for the vector type and does not infer the type of untyped parameters.
+# {metadata_filter} is replaced by the condition of _metadata_condition.
+VECTOR_SEARCH_QUERY = """
+SELECT e.cmetadata ->> CAST(:id_key AS text) AS doc_id, e.document AS summary
+FROM langchain_pg_embedding e
+JOIN langchain_pg_collection c ON e.collection_id = c.uuid
+WHERE c.name = :collection_name AND {metadata_filter}
+ORDER BY e.embedding <=> CAST(CAST(:embedding AS text) AS vector)
+LIMIT :k
+"""
+
+# Vector and lexical candidates are ranked in separate CTEs over LangChain's PGVector
+# tables and fused with reciprocal-rank fusion, so both searches are one round trip.
+# The lexical side matches the expression index created by the data_load ingestion.
+# Both return the summary each document was indexed with.
+HYBRID_SEARCH_QUERY = """
+WITH collection AS (
+    SELECT uuid FROM langchain_pg_collection WHERE name = :collection_name
+),
+query AS (
+    SELECT to_tsquery(
+        'english',
+        replace(plainto_tsquery('english', :query)::text, ' & ', ' | ')
+    ) AS tsquery
+),
+vector_search AS (
+    SELECT e.cmetadata ->> CAST(:id_key AS text) AS doc_id,
+           e.document AS summary,
+           row_number() OVER (ORDER BY e.embedding <=> CAST(CAST(:embedding AS text) AS vector)) AS rank
+    FROM langchain_pg_embedding e
+    JOIN collection c ON e.collection_id = c.uuid
+    WHERE {metadata_filter}
+    ORDER BY e.embedding <=> CAST(CAST(:embedding AS text) AS vector)
+    LIMIT :candidates
+),
+lexical_search AS (
+    SELECT e.cmetadata ->> CAST(:id_key AS text) AS doc_id,
+           e.document AS summary,
+           row_number() OVER (
+               ORDER BY ts_rank_cd(to_tsvector('english', e.document), q.tsquery, 32) DESC
+           ) AS rank
+    FROM langchain_pg_embedding e
+    JOIN collection c ON e.collection_id = c.uuid
+    CROSS JOIN query q
+    WHERE q.tsquery <> ''::tsquery AND to_tsvector('english', e.document) @@ q.tsquery
+      AND {metadata_filter}
+    ORDER BY ts_rank_cd(to_tsvector('english', e.document), q.tsquery, 32) DESC
+    LIMIT :candidates
+)
+SELECT doc_id,
+       coalesce(v.summary, l.summary) AS summary,
+       coalesce(1.0 / (:rrf_k + v.rank), 0.0) + coalesce(1.0 / (:rrf_k + l.rank), 0.0) AS score
+FROM vector_search v
+FULL OUTER JOIN lexical_search l USING (doc_id)
+ORDER BY score DESC
+LIMIT :k
+"""
+
+
+def _metadata_condition(metadata_filter: dict[str, list[str]]) -> tuple[str, dict]:
+    """
+    SQL condition and parameters matching documents whose metadata has, for every key of
+    the filter, one of its values. PGVector stores cmetadata as json, the condition is on
+    the jsonb cast that data_load's GIN index covers, one containment per key.
+    """
+    conditions, params = [], {}
+    for i, (key, values) in enumerate(sorted(metadata_filter.items())):
+        if not values:
+            continue
+        conditions.append(
+            f"CAST(e.cmetadata AS jsonb) @> ANY(CAST(CAST(:filter_{i} AS text[]) AS jsonb[]))"
+        )
+        params[f"filter_{i}"] = [json.dumps({key: value}) for value in values]
+    return " AND ".join(conditions) or "TRUE", params
+
+
+def _to_document(
+    doc: Document | str, doc_id: str, id_key: str, summary: str | None
+) -> Document:
+    """The docstore content with its id and, under "summary", the summary it was found by."""
+    if not isinstance(doc, Document):
+        doc = Document(page_content=doc)
+    doc.metadata.setdefault(id_key, doc_id)
+    if summary is not None:
+        doc.metadata.setdefault("summary", summary)
+    return doc
+
+
+# Identical queries of concurrent sessions share one embedding, search and docstore fetch
+retrieval_flight: AsyncSingleFlight[list[Document]] = AsyncSingleFlight()
+
+
+class DocumentIdMultiVectorRetriever(MultiVectorRetriever):
+    """
+    Multi-vector retriever that returns Documents carrying their docstore id in the
+    metadata under id_key, so callers can refer back to what was retrieved.
+    Expects a langchain_community PGVector vectorstore. With an async_engine, async
+    retrieval queries the PGVector tables over its connection pool instead of
+    running the synchronous search in a thread.
+    """
+
+    async_engine: AsyncEngine | None = None
+    # Share the retrieval with identical queries in flight in this process
+    coalesce: bool = True
+    # Only documents whose metadata has one of the listed values of every key are
+    # retrieved, e.g. {"type": ["table"], "file_name": ["a.pdf", "b.pdf"]}
+    metadata_filter: dict[str, list[str]] = {}
+
+    def _search_query(self, query: str, embedding: list[float]) -> tuple[str, dict]:
+        condition, filter_params = _metadata_condition(self.metadata_filter)
+        return VECTOR_SEARCH_QUERY.format(metadata_filter=condition), {
+            "collection_name": self.vectorstore.collection_name,
+            "id_key": self.id_key,
+            "embedding": str(embedding),
+            "k": int(self.search_kwargs.get("k", 4)),
+            **filter_params,
+        }
+
+    def _search(self, query: str) -> dict[str, str]:
+        """Summaries of the best matches by document id, best first."""
+        with span("embed"):
+            embedding = self.vectorstore.embeddings.embed_query(query)
+        sql, params = self._search_query(query, embedding)
+        with span("vector_search"), self.vectorstore._make_session() as session:
+            rows = session.execute(text(sql), params).fetchall()
+        summaries: dict[str, str] = {}
+        for row in rows:
+            if row.doc_id is not None:
+                summaries.setdefault(row.doc_id, row.summary)
+        return summaries
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        summaries = self._search(query)
+        with span("docstore_fetch"):
+            docs = self.docstore.mget(list(summaries))
+        return [
+            _to_document(d, i, self.id_key, summaries[i])
+            for d, i in zip(docs, summaries, strict=True)
+            if d is not None
+        ]
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        if not self.coalesce:
+            return await self._aretrieve(query)
+        key = (
+            type(self).__name__,
+            self.vectorstore.collection_name,
+            json.dumps(self.search_kwargs, sort_keys=True, default=str),
+            json.dumps(self.metadata_filter, sort_keys=True),
+            normalize_question(query),
+        )
+        docs, shared = await retrieval_flight.do(key, lambda: self._aretrieve(query))
+        SINGLE_FLIGHT.labels("retrieval", "shared" if shared else "leader").inc()
+        return list(docs)
+
+    async def _aretrieve(self, query: str) -> list[Document]:
+        if self.async_engine is None:
+            summaries = await run_in_executor(None, self._search, query)
+            with span("docstore_fetch"):
+                docs = await self.docstore.amget(list(summaries))
+            return [
+                _to_document(d, i, self.id_key, summaries[i])
+                for d, i in zip(docs, summaries, strict=True)
+                if d is not None
+            ]
+
+        with span("embed"):
+            embedding = await self.vectorstore.embeddings.aembed_query(query)
+        sql, params = self._search_query(query, embedding)
+        summaries: dict[str, str] = {}
+        with span("vector_search"):
+            async with self.async_engine.connect() as conn:
+                rows = (await conn.execute(text(sql), params)).fetchall()
+        for row in rows:
+            if row.doc_id is not None:
+                summaries.setdefault(row.doc_id, row.summary)
+        # The k rows arrive together, their documents are fetched in one round trip
+        with span("docstore_fetch"):
+            docs = await self.docstore.amget(list(summaries))
+        return [
+            _to_document(d, i, self.id_key, summaries[i])
+            for d, i in zip(docs, summaries, strict=True)
+            if d is not None
+        ]
+
+
+class HybridMultiVectorRetriever(DocumentIdMultiVectorRetriever):
+    """
+    Multi-vector retriever that ranks summaries by reciprocal-rank fusion of
+    pgvector similarity and Postgres full-text search instead of vector similarity only.
+    """
+
+    candidates: int = 20
+    rrf_k: int = 60
+
+    def _search_query(self, query: str, embedding: list[float]) -> tuple[str, dict]:
+        k = int(self.search_kwargs.get("k", 4))
+        condition, filter_params = _metadata_condition(self.metadata_filter)
+        return HYBRID_SEARCH_QUERY.format(metadata_filter=condition), {
+            "collection_name": self.vectorstore.collection_name,
+            "query": query,
+            "id_key": self.id_key,
+            "embedding": str(embedding),
+            "candidates": max(self.candidates, k),
+            "rrf_k": self.rrf_k,
+            "k": k,
+            **filter_params,
+        }
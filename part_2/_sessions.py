@@ -0,0 +1,78 @@
+import json
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+from redis.asyncio import Redis as AsyncRedis
+
+if TYPE_CHECKING:
+    from langchain.memory import ConversationBufferWindowMemory
+
+
+@dataclass
+class SessionState:
+    """
+    Everything a worker needs to answer the next message of a conversation.
+    Only plain data: the chain is rebuilt from the settings and the memory from the
+    history, retrieved documents are kept as docstore ids, never as image bytes.
+    """
+
+    settings: dict
+    # ("human" | "ai", content) messages of the last turns, oldest first
+    history: list[tuple[str, str]] = field(default_factory=list)
+    # Docstore ids the last answer was based on
+    retrieved_ids: list[str] = field(default_factory=list)
+
+    def memory(self, window_turns: int) -> "ConversationBufferWindowMemory":
+        # Imported on first use, the workers start serving without it
+        from langchain.memory import ConversationBufferWindowMemory
+
+        memory = ConversationBufferWindowMemory(k=window_turns, return_messages=True)
+        for role, content in self.history:
+            if role == "human":
+                memory.chat_memory.add_user_message(content)
+            else:
+                memory.chat_memory.add_ai_message(content)
+        return memory
+
+    def add_turn(self, question: str, answer: str, window_turns: int) -> None:
+        """Record a turn, keeping only the turns the memory window can use."""
+        self.history += [("human", question), ("ai", answer)]
+        self.history = self.history[-2 * window_turns:]
+
+    def dumps(self) -> str:
+        return json.dumps(
+            {"s": self.settings, "h": self.history, "r": self.retrieved_ids},
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+
+    @classmethod
+    def loads(cls, data: str) -> "SessionState":
+        state = json.loads(data)
+        return cls(
+            settings=state["s"],
+            history=[(role, content) for role, content in state["h"]],
+            retrieved_ids=state["r"],
+        )
+
+
+class RedisSessionStore:
+    """
+    Session states in Redis, so any worker process can serve any message of a session.
+    A session expires ttl_seconds after its last message.
+    """
+
+    def __init__(self, client: AsyncRedis, ttl_seconds: int, namespace: str = "session") -> None:
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.namespace = namespace
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.namespace}/{session_id}"
+
+    async def load(self, session_id: str) -> SessionState | None:
+        data = await self.client.get(self._key(session_id))
+        return SessionState.loads(data) if data is not None else None
+
+    async def save(self, session_id: str, state: SessionState) -> None:
+        await self.client.set(self._key(session_id), state.dumps(), ex=self.ttl_seconds)
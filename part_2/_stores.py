@@ -0,0 +1,20 @@
+from collections.abc import Sequence
+
+from langchain_community.storage import RedisStore
+from redis.asyncio import Redis as AsyncRedis
+
+
+class AsyncRedisStore(RedisStore):
+    """
+    RedisStore whose async reads go through a redis.asyncio client and its connection pool,
+    instead of running the synchronous client in a thread.
+    """
+
+    def __init__(self, *, async_client: AsyncRedis, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.async_client = async_client
+
+    async def amget(self, keys: Sequence[str]) -> list[str | None]:
+        if not keys:
+            return []
+        return await self.async_client.mget([self._get_prefixed_key(key) for key in keys])
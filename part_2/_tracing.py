@@ -0,0 +1,41 @@
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from _config import logger
+from _metrics import STAGE_SECONDS
+
+# Stage durations in seconds of the request being handled. The dict is shared by reference
+# with the tasks LangChain spawns for parallel steps, so their spans end up in it too.
+_current_trace: ContextVar[dict[str, float] | None] = ContextVar("current_trace", default=None)
+
+
+def start_trace() -> dict[str, float]:
+    """Start collecting spans for the current request."""
+    trace: dict[str, float] = {}
+    _current_trace.set(trace)
+    return trace
+
+
+def record_span(name: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(name).observe(seconds)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace[name] = trace.get(name, 0.0) + seconds
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Time a stage of the current request and export it as a chatbot_stage_seconds sample."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def log_trace(trace: dict[str, float]) -> None:
+    logger.info(
+        "Latency spans: " + ", ".join(f"{name}={1000 * seconds:.0f}ms" for name, seconds in trace.items())
+    )
@@ -69,3 +69,29 @@ def resize_base64_image(
     # Encode the resized image to Base64
     buf = buffered.getvalue()
     return buf, base64.b64encode(buf).decode("utf-8")
+
+
+def prepare_image(b64_string: str, max_size: int = 512) -> dict:
+    """
+    Decode a base64-encoded image once, downsize it if either side is larger than max_size
+    and return its content, format, dimensions and, if resized, the resized bytes.
+    Top-level and free of shared state, so it can run in a process pool.
+    """
+    img = Image.open(BytesIO(base64.b64decode(b64_string)))
+    width, height = img.size
+    image_format = img.format.lower()
+    buf = None
+    if width > max_size or height > max_size:
+        resized_img = img.resize((max_size, max_size), Image.Resampling.LANCZOS)
+        buffered = io.BytesIO()
+        resized_img.save(buffered, format=img.format)
+        buf = buffered.getvalue()
+        b64_string = base64.b64encode(buf).decode("utf-8")
+        width, height = max_size, max_size
+    return {
+        "content": b64_string,
+        "format": image_format,
+        "width": width,
+        "height": height,
+        "buf": buf,
+    }
@@ -0,0 +1,131 @@
+"""End-to-end chat latency of the multimodal RAG chain under concurrent sessions.
+
+Each simulated session gets its own Chainlit context, memory and chain as `setup` creates
+them, and asks a few questions in a row, streaming the answers. The answer cache and
+coalescing are not used, every question retrieves and completes. A burst of sessions then
+asks the same first question at once, sharing one retrieval and one streamed completion.
+Run inside the part_2 container after data_load:
+    python3 bench_chat.py --concurrency 1 10 50 --burst 50
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from pathlib import Path
+
+from _config import Config, logger
+from bench_retrieval_concurrency import QUESTIONS
+from chainlit.context import init_http_context
+from _retrievers import retrieval_flight
+from frontend import answer_flight, answer_key, create_retriever, multi_modal_rag_chain
+from langchain.memory import ConversationBufferWindowMemory
+
+config = Config()
+
+SETTINGS = {"Num_Documents_To_Retrieve": 3, "Hybrid_Search": True}
+
+
+async def run_session(questions: list[str]) -> list[tuple[float, float]]:
+    """Latencies to the first token and to the full answer of each question."""
+    init_http_context()
+    memory = ConversationBufferWindowMemory(k=config.MEMORY_WINDOW_TURNS, return_messages=True)
+    retriever = create_retriever(SETTINGS).model_copy(update={"coalesce": False})
+    runnable = multi_modal_rag_chain(retriever, memory)
+    latencies = []
+    for question in questions:
+        start = time.perf_counter()
+        first_token = None
+        answer = ""
+        async for chunk in runnable.astream(question):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            answer += chunk
+        latencies.append((first_token or 0.0, time.perf_counter() - start))
+        memory.chat_memory.add_user_message(question)
+        memory.chat_memory.add_ai_message(answer)
+    return latencies
+
+
+async def burst_session(question: str) -> float:
+    """A new session's first question, answered the way handle_new_message does."""
+    init_http_context()
+    memory = ConversationBufferWindowMemory(k=config.MEMORY_WINDOW_TURNS, return_messages=True)
+    runnable = multi_modal_rag_chain(create_retriever(SETTINGS), memory)
+    start = time.perf_counter()
+    chunks, _, _ = answer_flight.join(
+        answer_key(question, SETTINGS), lambda: runnable.astream(question), None
+    )
+    async for _ in chunks:
+        pass
+    return time.perf_counter() - start
+
+
+async def run_burst(burst: int) -> dict[str, float]:
+    """Latency and calls saved when all sessions ask the same question at the same time."""
+    answers, retrievals = answer_flight.shared, retrieval_flight.shared
+    latencies = sorted(await asyncio.gather(*[burst_session(QUESTIONS[1]) for _ in range(burst)]))
+    answers = answer_flight.shared - answers
+    retrievals = retrieval_flight.shared - retrievals
+    metrics = {
+        f"burst{burst}.full_answer.p50_ms": 1000 * statistics.median(latencies),
+        f"burst{burst}.full_answer.p99_ms": 1000 * latencies[int(0.99 * (len(latencies) - 1))],
+        f"burst{burst}.coalesce_ratio": answers / burst,
+        f"burst{burst}.saved_completions": answers,
+        # A shared completion also skips its retrieval
+        f"burst{burst}.saved_retrievals": answers + retrievals,
+    }
+    logger.info(
+        f"burst of {burst}: full answer p50={metrics[f'burst{burst}.full_answer.p50_ms']:.0f} ms, "
+        f"{answers} of {burst} completions shared ({answers / burst:.0%})"
+    )
+    return metrics
+
+
+async def run_benchmark(
+    concurrency_levels: list[int], rounds: int, burst: int
+) -> dict[str, float]:
+    # Warm up embeddings, connection pools and the image workers
+    await run_session(QUESTIONS[:1])
+
+    metrics: dict[str, float] = {}
+    for concurrency in concurrency_levels:
+        start = time.perf_counter()
+        sessions = await asyncio.gather(
+            *[
+                run_session([QUESTIONS[(i + r) % len(QUESTIONS)] for r in range(rounds)])
+                for i in range(concurrency)
+            ]
+        )
+        elapsed = time.perf_counter() - start
+        first_tokens = sorted(first for session in sessions for first, _ in session)
+        full_answers = sorted(full for session in sessions for _, full in session)
+        for name, latencies in (("first_token", first_tokens), ("full_answer", full_answers)):
+            metrics[f"c{concurrency}.{name}.p50_ms"] = 1000 * statistics.median(latencies)
+            metrics[f"c{concurrency}.{name}.p99_ms"] = (
+                1000 * latencies[int(0.99 * (len(latencies) - 1))]
+            )
+        metrics[f"c{concurrency}.answers_per_second"] = len(full_answers) / elapsed
+        logger.info(
+            f"concurrency={concurrency:>3}: "
+            f"first token p50={metrics[f'c{concurrency}.first_token.p50_ms']:.0f} ms "
+            f"p99={metrics[f'c{concurrency}.first_token.p99_ms']:.0f} ms, "
+            f"full answer p50={metrics[f'c{concurrency}.full_answer.p50_ms']:.0f} ms "
+            f"p99={metrics[f'c{concurrency}.full_answer.p99_ms']:.0f} ms, "
+            f"{len(full_answers) / elapsed:.1f} answers/s"
+        )
+    if burst:
+        metrics.update(await run_burst(burst))
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--rounds", type=int, default=3, help="Questions per simulated session")
+    parser.add_argument("--burst", type=int, default=50, help="Sessions asking the same question")
+    parser.add_argument("--json", type=Path, help="Write the metrics to this file")
+    args = parser.parse_args()
+    metrics = asyncio.run(run_benchmark(args.concurrency, args.rounds, args.burst))
+    if args.json:
+        args.json.write_text(json.dumps(metrics, indent=2))
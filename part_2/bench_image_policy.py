@@ -0,0 +1,114 @@
+"""Prompt size and answer latency with and without the image token policy.
+
+Retrieves ten documents for each question of the London brochure set and builds the
+prompt twice: with every retrieved image attached at high detail, as before the policy,
+and with the configured policy, which attaches the best ranked images at high or low
+detail within a token cap and sends the others as their summaries. Then answers each
+question through the chain with either policy. Run inside the part_2 container after
+data_load:
+    python3 bench_image_policy.py --rounds 3
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from pathlib import Path
+
+import frontend
+from _config import logger
+from _prompt import ATTACH_ALL_IMAGES, ImagePolicy
+from bench_retrieval_concurrency import QUESTIONS
+from chainlit.context import init_http_context
+from frontend import asplit_image_text_types, create_retriever, multi_modal_rag_chain
+from langchain.memory import ConversationBufferWindowMemory
+
+SETTINGS = {"Num_Documents_To_Retrieve": 10, "Hybrid_Search": True}
+
+
+def prompt_size(context: dict, question: str, policy: ImagePolicy) -> dict[str, float]:
+    """Estimated image and prompt tokens and the payload size of one prompt."""
+    frontend.prompt_builder.image_policy = policy
+    messages, prompt_tokens = frontend.img_prompt_func(
+        {"question": question, "history": [], "context": context}
+    )
+    decisions = policy.decide(context["images"])
+    return {
+        "image_tokens": sum(n_tokens for _, _, n_tokens in decisions),
+        "images_attached": sum(detail != "summary" for _, detail, _ in decisions),
+        "prompt_tokens": prompt_tokens,
+        "prompt_kb": len(json.dumps(messages[0].content)) / 1024,
+    }
+
+
+async def answer_latencies(
+    questions: list[str], policy: ImagePolicy
+) -> list[tuple[float, float]]:
+    """Latencies to the first token and to the full answer of each question."""
+    frontend.prompt_builder.image_policy = policy
+    latencies = []
+    for question in questions:
+        memory = ConversationBufferWindowMemory(k=1, return_messages=True)
+        retriever = create_retriever(SETTINGS).model_copy(update={"coalesce": False})
+        runnable = multi_modal_rag_chain(retriever, memory)
+        start = time.perf_counter()
+        first_token = None
+        async for _ in runnable.astream(question):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+        latencies.append((first_token or 0.0, time.perf_counter() - start))
+    return latencies
+
+
+async def run_benchmark(rounds: int) -> dict[str, float]:
+    init_http_context()
+    configured = frontend.prompt_builder.image_policy
+    policies = {"all_images": ATTACH_ALL_IMAGES, "policy": configured}
+    retriever = create_retriever(SETTINGS).model_copy(update={"coalesce": False})
+    contexts = [
+        await asplit_image_text_types(await retriever.ainvoke(question)) for question in QUESTIONS
+    ]
+
+    metrics: dict[str, float] = {}
+    for name, policy in policies.items():
+        sizes = [
+            prompt_size(context, question, policy)
+            for context, question in zip(contexts, QUESTIONS, strict=True)
+        ]
+        for key in sizes[0]:
+            metrics[f"{name}.{key}"] = statistics.mean(size[key] for size in sizes)
+        # Warm up, then time every question rounds times
+        await answer_latencies(QUESTIONS[:1], policy)
+        latencies = await answer_latencies(QUESTIONS * rounds, policy)
+        for i, stage in enumerate(("first_token", "full_answer")):
+            metrics[f"{name}.{stage}.p50_ms"] = 1000 * statistics.median(
+                latency[i] for latency in latencies
+            )
+        logger.info(
+            f"{name:>10}: {metrics[f'{name}.images_attached']:.1f} images attached, "
+            f"{metrics[f'{name}.image_tokens']:.0f} image tokens, "
+            f"{metrics[f'{name}.prompt_tokens']:.0f} prompt tokens, "
+            f"{metrics[f'{name}.prompt_kb']:.0f} kB, "
+            f"first token p50={metrics[f'{name}.first_token.p50_ms']:.0f} ms, "
+            f"full answer p50={metrics[f'{name}.full_answer.p50_ms']:.0f} ms"
+        )
+    frontend.prompt_builder.image_policy = configured
+
+    for key in ("image_tokens", "prompt_tokens"):
+        before = metrics[f"all_images.{key}"]
+        metrics[f"{key}_saved"] = 1 - metrics[f"policy.{key}"] / before if before else 0.0
+    logger.info(
+        f"The policy saves {metrics['image_tokens_saved']:.0%} of the image tokens and "
+        f"{metrics['prompt_tokens_saved']:.0%} of the prompt tokens"
+    )
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=3, help="Times each question is answered")
+    parser.add_argument("--json", type=Path, help="Write the metrics to this file")
+    args = parser.parse_args()
+    metrics = asyncio.run(run_benchmark(args.rounds))
+    if args.json:
+        args.json.write_text(json.dumps(metrics, indent=2))
@@ -0,0 +1,164 @@
+"""Search latency with and without metadata filters, and whether the filters use their index.
+
+Copies synthetic summaries with random embeddings, spread over many files, the three
+element types and two ingestion versions, into a collection of its own. Then times the
+vector and hybrid search queries of the retrievers, without embedding or docstore calls,
+unfiltered and filtered to one file, one element type or one ingestion version, and
+checks with EXPLAIN that the filtered queries scan the GIN index of the metadata.
+Run inside the part_2 container, against Postgres only, the model is not called:
+    python3 bench_metadata_filter.py --files 200 --elements 50
+"""
+import argparse
+import asyncio
+import io
+import json
+import random
+import statistics
+import time
+import uuid
+from pathlib import Path
+
+from _config import logger
+from _retrievers import DocumentIdMultiVectorRetriever, HybridMultiVectorRetriever
+from frontend import _create_vectorstore, async_engine, docstore, id_key
+from sqlalchemy import text
+
+COLLECTION = "bench_metadata_filter"
+DIMENSIONS = 1536
+VOCABULARY = [f"term{i}" for i in range(2000)]
+TYPES = {"text": 0.7, "image": 0.2, "table": 0.1}
+VERSIONS = ("20240101T000000", "20240201T000000")
+
+COPY_QUERY = """
+COPY langchain_pg_embedding (uuid, collection_id, embedding, document, cmetadata, custom_id)
+FROM STDIN
+"""
+
+# Same statement as data_load's create_metadata_index
+METADATA_INDEX = """
+CREATE INDEX IF NOT EXISTS langchain_pg_embedding_cmetadata_idx
+ON langchain_pg_embedding USING gin ((cmetadata::jsonb) jsonb_path_ops)
+"""
+
+
+def random_embedding() -> list[float]:
+    return [round(random.gauss(0.0, 1.0), 4) for _ in range(DIMENSIONS)]
+
+
+def load_collection(vectorstore, files: int, elements: int) -> None:
+    """Replace the bench collection with files * elements synthetic rows, one COPY per file."""
+    vectorstore.delete_collection()
+    vectorstore.create_collection()
+    with vectorstore._make_session() as session:
+        collection = vectorstore.get_collection(session)
+        session.execute(text(METADATA_INDEX))
+        for f in range(files):
+            buffer = io.StringIO()
+            for i in range(elements):
+                doc_id = str(uuid.uuid4())
+                metadata = {
+                    id_key: doc_id,
+                    "file_name": f"file_{f}.pdf",
+                    "index": i,
+                    "type": random.choices(list(TYPES), weights=list(TYPES.values()))[0],
+                    "ingestion_version": VERSIONS[f % len(VERSIONS)],
+                }
+                fields = [
+                    str(uuid.uuid4()),
+                    str(collection.uuid),
+                    json.dumps(random_embedding(), separators=(",", ":")),
+                    " ".join(random.choices(VOCABULARY, k=40)),
+                    json.dumps(metadata),
+                    doc_id,
+                ]
+                buffer.write("\t".join(fields) + "\n")
+            buffer.seek(0)
+            with session.connection().connection.cursor() as cursor:
+                cursor.copy_expert(COPY_QUERY, buffer)
+        session.execute(text("ANALYZE langchain_pg_embedding"))
+        session.commit()
+
+
+async def timed_searches(retriever, queries: list[tuple[str, list[float]]]) -> list[float]:
+    latencies = []
+    async with async_engine.connect() as conn:
+        for query, embedding in queries:
+            sql, params = retriever._search_query(query, embedding)
+            start = time.perf_counter()
+            (await conn.execute(text(sql), params)).fetchall()
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def uses_metadata_index(retriever, query: str, embedding: list[float]) -> bool:
+    sql, params = retriever._search_query(query, embedding)
+    async with async_engine.connect() as conn:
+        plan = (await conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"), params)).scalar()
+    return "langchain_pg_embedding_cmetadata_idx" in json.dumps(plan)
+
+
+async def run_benchmark(files: int, elements: int, k: int, rounds: int) -> dict[str, float]:
+    vectorstore = _create_vectorstore()
+    vectorstore.collection_name = COLLECTION
+    start = time.perf_counter()
+    load_collection(vectorstore, files, elements)
+    logger.info(f"Loaded {files * elements} rows in {time.perf_counter() - start:.1f} s")
+
+    filters = {
+        "unfiltered": {},
+        "file": {"file_name": ["file_0.pdf"]},
+        "type": {"type": ["table"]},
+        "version": {"ingestion_version": [VERSIONS[0]]},
+    }
+    queries = [
+        (" ".join(random.choices(VOCABULARY, k=5)), random_embedding()) for _ in range(rounds)
+    ]
+    metrics: dict[str, float] = {}
+    try:
+        for mode, retriever_cls in (
+            ("vector", DocumentIdMultiVectorRetriever),
+            ("hybrid", HybridMultiVectorRetriever),
+        ):
+            for name, metadata_filter in filters.items():
+                retriever = retriever_cls(
+                    vectorstore=vectorstore,
+                    docstore=docstore,
+                    async_engine=async_engine,
+                    id_key=id_key,
+                    search_kwargs={"k": k},
+                    metadata_filter=metadata_filter,
+                )
+                # Warm up the connection and the cache
+                await timed_searches(retriever, queries[:2])
+                latencies = sorted(await timed_searches(retriever, queries))
+                prefix = f"{mode}.{name}"
+                metrics[f"{prefix}.p50_ms"] = 1000 * statistics.median(latencies)
+                metrics[f"{prefix}.p95_ms"] = 1000 * latencies[int(0.95 * (len(latencies) - 1))]
+                plan = ""
+                if metadata_filter:
+                    used = await uses_metadata_index(retriever, *queries[0])
+                    metrics[f"{prefix}.uses_index"] = float(used)
+                    plan = ", metadata index used" if used else ", metadata index NOT used"
+                logger.info(
+                    f"{mode:>6} {name:>10}: p50={metrics[f'{prefix}.p50_ms']:.1f} ms "
+                    f"p95={metrics[f'{prefix}.p95_ms']:.1f} ms{plan}"
+                )
+            metrics[f"{mode}.file.speedup"] = (
+                metrics[f"{mode}.unfiltered.p50_ms"] / metrics[f"{mode}.file.p50_ms"]
+            )
+    finally:
+        vectorstore.delete_collection()
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--elements", type=int, default=50, help="Rows per file")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=50, help="Queries per search and filter")
+    parser.add_argument("--json", type=Path, help="Write the metrics to this file")
+    args = parser.parse_args()
+    metrics = asyncio.run(run_benchmark(args.files, args.elements, args.k, args.rounds))
+    if args.json:
+        args.json.write_text(json.dumps(metrics, indent=2))
@@ -0,0 +1,154 @@
+"""Shared rate limiting of chat and ingestion calls to one deployment.
+
+Batch workers call as fast as the limiter admits them, like an ingestion run, while chat
+calls arrive at random at a fraction of the limit. After a warm-up that drains the
+buckets to the batch workers' share, records how long chat calls waited, how many calls
+of each priority were shed and the throughput left to the batch workers. Runs without and
+with the batch reserve, against Redis only, the model is not called:
+    python3 bench_rate_limit.py --reserve 0 0.2
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from pathlib import Path
+
+import redis
+import redis.asyncio
+from _config import Config, logger
+from common.ratelimit import RateLimiter, RateLimitExceeded
+
+config = Config()
+
+DEPLOYMENT = "bench"
+
+
+def create_limiter(
+    limits: dict[str, tuple[int, int]],
+    priority: str,
+    max_wait_seconds: float,
+    reserve: float,
+    namespace: str,
+) -> RateLimiter:
+    return RateLimiter(
+        redis.Redis.from_url(config.REDIS_URL, db=config.RATE_LIMIT_REDIS_DB),
+        redis.asyncio.Redis.from_url(config.REDIS_URL, db=config.RATE_LIMIT_REDIS_DB),
+        limits=limits,
+        priority=priority,
+        max_wait_seconds=max_wait_seconds,
+        reserve=reserve,
+        namespace=namespace,
+    )
+
+
+async def batch_worker(
+    limiter: RateLimiter, tokens: int, until: float, measure_from: float, counts: dict[str, int]
+) -> None:
+    while time.monotonic() < until:
+        try:
+            await limiter.aacquire(DEPLOYMENT, tokens)
+        except RateLimitExceeded:
+            counts["shed"] += 1
+            continue
+        if time.monotonic() >= measure_from:
+            counts["admitted"] += 1
+
+
+async def chat_call(limiter: RateLimiter, tokens: int, waits: list[float], counts: dict) -> None:
+    try:
+        waits.append(await limiter.aacquire(DEPLOYMENT, tokens))
+    except RateLimitExceeded:
+        counts["shed"] += 1
+
+
+async def run_scenario(
+    reserve: float,
+    rpm: int,
+    tpm: int,
+    chat_rate: float,
+    chat_tokens: int,
+    batch_workers: int,
+    batch_tokens: int,
+    warmup: float,
+    duration: float,
+) -> dict[str, float]:
+    limits = {DEPLOYMENT: (rpm, tpm)}
+    namespace = f"bench-ratelimit-{uuid.uuid4()}"
+    chat = create_limiter(
+        limits, "interactive", config.RATE_LIMIT_MAX_WAIT_SECONDS["interactive"], 0.0, namespace
+    )
+    batch = create_limiter(limits, "batch", warmup + duration, reserve, namespace)
+
+    start = time.monotonic()
+    measure_from, until = start + warmup, start + warmup + duration
+    batch_counts = {"admitted": 0, "shed": 0}
+    chat_counts = {"shed": 0}
+    waits: list[float] = []
+    workers = [
+        asyncio.create_task(batch_worker(batch, batch_tokens, until, measure_from, batch_counts))
+        for _ in range(batch_workers)
+    ]
+    await asyncio.sleep(warmup)
+    calls = []
+    while time.monotonic() < until:
+        calls.append(asyncio.create_task(chat_call(chat, chat_tokens, waits, chat_counts)))
+        # Poisson arrivals
+        await asyncio.sleep(random.expovariate(chat_rate))
+    await asyncio.gather(*calls, *workers)
+
+    waits.sort()
+    name = f"reserve{round(reserve * 100)}"
+    metrics = {
+        f"{name}.chat.wait_p50_ms": 1000 * waits[len(waits) // 2] if waits else 0.0,
+        f"{name}.chat.wait_p95_ms": 1000 * waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+        f"{name}.chat.shed": chat_counts["shed"],
+        f"{name}.batch.calls_per_minute": batch_counts["admitted"] * 60 / duration,
+        f"{name}.batch.shed": batch_counts["shed"],
+        f"{name}.tokens_per_minute": (
+            (batch_counts["admitted"] * batch_tokens + len(waits) * chat_tokens) * 60 / duration
+        ),
+    }
+    logger.info(
+        f"reserve={reserve:.0%}: chat wait p50={metrics[f'{name}.chat.wait_p50_ms']:.0f} ms "
+        f"p95={metrics[f'{name}.chat.wait_p95_ms']:.0f} ms, {chat_counts['shed']} of "
+        f"{len(calls)} chat calls shed, batch {metrics[f'{name}.batch.calls_per_minute']:.0f} "
+        f"calls/min, {metrics[f'{name}.tokens_per_minute']:.0f} tokens/min admitted (limit {tpm})"
+    )
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reserve", type=float, nargs="+", default=[0.0, 0.2])
+    parser.add_argument("--rpm", type=int, default=600)
+    parser.add_argument("--tpm", type=int, default=60_000)
+    parser.add_argument("--chat-rate", type=float, default=1.0, help="Chat calls per second")
+    parser.add_argument("--chat-tokens", type=int, default=300)
+    parser.add_argument("--batch-workers", type=int, default=4)
+    parser.add_argument("--batch-tokens", type=int, default=500)
+    parser.add_argument("--warmup", type=float, default=5.0, help="Seconds of batch calls only")
+    # The buckets hold a minute of capacity, shorter runs overstate the throughput
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--json", type=Path, help="Write the metrics to this file")
+    args = parser.parse_args()
+    metrics: dict[str, float] = {}
+    for reserve in args.reserve:
+        metrics.update(
+            asyncio.run(
+                run_scenario(
+                    reserve,
+                    args.rpm,
+                    args.tpm,
+                    args.chat_rate,
+                    args.chat_tokens,
+                    args.batch_workers,
+                    args.batch_tokens,
+                    args.warmup,
+                    args.duration,
+                )
+            )
+        )
+    if args.json:
+        args.json.write_text(json.dumps(metrics, indent=2))
@@ -0,0 +1,84 @@
+"""Per-question retrieval latency under concurrent load, sync vs async retrieval path.
+
+The sync path is the one LangChain falls back to, the PGVector search and the Redis
+mget run in executor threads. The async path uses the asyncpg pool and redis.asyncio.
+Run inside the part_2 container after data_load:
+    python3 bench_retrieval_concurrency.py --slo-ms 500
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from pathlib import Path
+
+from _config import logger
+from frontend import create_retriever, docstore, redis_client
+from langchain_community.storage import RedisStore
+
+QUESTIONS = [
+    "Tell me about Trafalgar square",
+    "What colour is the fountain?",
+    "Which museums are free in London?",
+    "How do I get around London by public transport?",
+    "What can I see at the Tower of London?",
+]
+CONCURRENCY_LEVELS = (1, 5, 10, 25, 50, 100)
+
+
+async def timed_retrieval(retriever, question: str) -> float:
+    start = time.perf_counter()
+    await retriever.ainvoke(question)
+    return time.perf_counter() - start
+
+
+async def run_benchmark(k: int, slo_ms: float) -> dict[str, float]:
+    settings = {"Num_Documents_To_Retrieve": k, "Hybrid_Search": True}
+    # Every query is retrieved, identical ones in flight are not coalesced
+    async_retriever = create_retriever(settings).model_copy(update={"coalesce": False})
+    sync_retriever = create_retriever(settings).model_copy(
+        update={
+            "coalesce": False,
+            "async_engine": None,
+            "docstore": RedisStore(client=redis_client, namespace=docstore.namespace),
+        }
+    )
+    # Warm up embeddings, connection pools and the query embedding cache
+    for question in QUESTIONS:
+        await async_retriever.ainvoke(question)
+
+    metrics: dict[str, float] = {}
+    for name, retriever in (("sync", sync_retriever), ("async", async_retriever)):
+        max_sessions = 0
+        for concurrency in CONCURRENCY_LEVELS:
+            latencies = sorted(
+                await asyncio.gather(
+                    *[
+                        timed_retrieval(retriever, QUESTIONS[i % len(QUESTIONS)])
+                        for i in range(concurrency)
+                    ]
+                )
+            )
+            p95 = latencies[int(0.95 * (len(latencies) - 1))]
+            if 1000 * p95 <= slo_ms:
+                max_sessions = concurrency
+            metrics[f"{name}.c{concurrency}.p50_ms"] = 1000 * statistics.median(latencies)
+            metrics[f"{name}.c{concurrency}.p95_ms"] = 1000 * p95
+            logger.info(
+                f"{name:>5} concurrency={concurrency:>3}: "
+                f"p50={1000 * statistics.median(latencies):.0f} ms, p95={1000 * p95:.0f} ms"
+            )
+        logger.info(f"{name:>5}: max concurrent questions within {slo_ms:.0f} ms p95: {max_sessions}")
+        metrics[f"{name}.max_sessions_within_slo"] = max_sessions
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--slo-ms", type=float, default=500.0)
+    parser.add_argument("--json", type=Path, help="Write the metrics to this file")
+    args = parser.parse_args()
+    metrics = asyncio.run(run_benchmark(args.k, args.slo_ms))
+    if args.json:
+        args.json.write_text(json.dumps(metrics, indent=2))
@@ -0,0 +1,70 @@
+"""Measure session start latency and open sockets with per-session vs shared chat models.
+
+Each simulated session creates its model the way `setup` does and sends a one token
+completion, which is where the HTTP connection is opened. Run inside the part_2 container:
+    python3 bench_sessions.py --sessions 100
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from _config import Config, logger
+from _llm import get_chat_model
+from langchain_openai import AzureChatOpenAI
+
+config = Config()
+
+
+def count_open_sockets() -> int:
+    fd_dir = "/proc/self/fd"
+    sockets = 0
+    for fd in os.listdir(fd_dir):
+        try:
+            if os.readlink(os.path.join(fd_dir, fd)).startswith("socket:"):
+                sockets += 1
+        except OSError:
+            continue
+    return sockets
+
+
+async def start_session(shared: bool, keep: list) -> float:
+    start = time.perf_counter()
+    if shared:
+        model = get_chat_model("gpt-4o").bind(temperature=0.0, max_tokens=1)
+    else:
+        model = AzureChatOpenAI(
+            model="gpt-4o",
+            max_tokens=1,
+            temperature=0,
+            azure_endpoint=config.OAI_ENDPOINT,
+            api_key=config.OAI_API_KEY,
+            streaming=True,
+        )
+    await model.ainvoke("ping")
+    # Sessions keep their model alive, as cl.user_session does
+    keep.append(model)
+    return time.perf_counter() - start
+
+
+async def run_benchmark(sessions: int) -> None:
+    for shared in (False, True):
+        keep: list = []
+        sockets_before = count_open_sockets()
+        latencies = sorted(
+            await asyncio.gather(*[start_session(shared, keep) for _ in range(sessions)])
+        )
+        sockets = count_open_sockets() - sockets_before
+        logger.info(
+            f"{'shared' if shared else 'per-session':>11}: {sessions} sessions, "
+            f"p50={1000 * statistics.median(latencies):.0f} ms, "
+            f"p95={1000 * latencies[int(0.95 * (len(latencies) - 1))]:.0f} ms, "
+            f"open sockets={sockets}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=100)
+    asyncio.run(run_benchmark(parser.parse_args().sessions))
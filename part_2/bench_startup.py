@@ -0,0 +1,117 @@
+"""Cold start of part_2: from process start to serving, to ready and to the first answer.
+
+Starts the Chainlit server and polls /ready, recording when it first answers and when all
+dependencies are ready. Then starts fresh processes that import the frontend, run the
+readiness checks and answer a first question without the answer cache. Medians of a few
+runs. Run inside the part_2 container after data_load:
+    python3 bench_startup.py --runs 5
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+from pathlib import Path
+
+
+def start_server(port: int, timeout: float) -> dict[str, float]:
+    start = time.time()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "chainlit", "run", "frontend.py", "-h", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    result: dict[str, float] = {}
+    try:
+        while time.time() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=10):
+                    result.setdefault("listening_seconds", time.time() - start)
+                    result["ready_seconds"] = time.time() - start
+                    return result
+            except urllib.error.HTTPError:
+                # 503 while a dependency is not ready
+                result.setdefault("listening_seconds", time.time() - start)
+            except OSError:
+                pass
+            time.sleep(0.05)
+        raise RuntimeError(f"part_2 was not ready after {timeout} s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def first_answer() -> None:
+    """Child process: print when the frontend was imported, ready and answered."""
+    import frontend
+
+    imported = time.time()
+    from bench_retrieval_concurrency import QUESTIONS
+    from chainlit.context import init_http_context
+
+    async def run() -> dict[str, float]:
+        checks = await frontend.check_readiness()
+        ready = time.time()
+        init_http_context()
+        state = await frontend.load_session(f"bench-startup-{uuid.uuid4()}")
+        async for _ in frontend.create_session_chain(state).astream(QUESTIONS[0]):
+            pass
+        return {"ready": ready, "answered": time.time(), "checks": checks}
+
+    print(json.dumps({"imported": imported, **asyncio.run(run())}))
+
+
+def measure_first_answer() -> dict[str, float]:
+    start = time.time()
+    output = subprocess.run(
+        [sys.executable, __file__, "--first-answer"], capture_output=True, text=True, check=True
+    ).stdout
+    times = json.loads(output.strip().splitlines()[-1])
+    if any(result != "ok" for result in times["checks"].values()):
+        raise RuntimeError(f"part_2 is not ready: {times['checks']}")
+    return {
+        "import_seconds": times["imported"] - start,
+        "ready_seconds": times["ready"] - start,
+        "first_answer_seconds": times["answered"] - start,
+    }
+
+
+def run_benchmark(runs: int, port: int, timeout: float) -> dict[str, float]:
+    samples: dict[str, list[float]] = {}
+    for _ in range(runs):
+        results = {f"server.{key}": value for key, value in start_server(port, timeout).items()}
+        results.update(measure_first_answer())
+        for key, value in results.items():
+            samples.setdefault(key, []).append(value)
+    metrics = {key: statistics.median(values) for key, values in samples.items()}
+    print(
+        f"Server: listening after {metrics['server.listening_seconds']:.2f} s, "
+        f"ready after {metrics['server.ready_seconds']:.2f} s"
+    )
+    print(
+        f"Process: imported after {metrics['import_seconds']:.2f} s, "
+        f"ready after {metrics['ready_seconds']:.2f} s, "
+        f"first answer after {metrics['first_answer_seconds']:.2f} s"
+    )
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=9998)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--first-answer", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--json", type=Path, help="Write the metrics to this file")
+    args = parser.parse_args()
+    if args.first_answer:
+        first_answer()
+    else:
+        metrics = run_benchmark(args.runs, args.port, args.timeout)
+        if args.json:
+            args.json.write_text(json.dumps(metrics, indent=2))
@@ -0,0 +1,126 @@
+"""Chat throughput of 1 to N worker processes sharing the session state in Redis.
+
+Sessions ask a few questions in a row. Each next question goes to a shared queue as soon
+as the previous answer is saved, so whichever worker is free serves it, loading the
+session from Redis, answering with the chain built from it and saving it back. Reports
+the turns per second per worker count and how many turns were served by another worker
+than the previous turn of their session. Run inside the part_2 container after data_load:
+    python3 bench_workers.py --workers 1 2 4 --sessions 40
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import queue
+import time
+import uuid
+from pathlib import Path
+
+from _config import logger
+from bench_retrieval_concurrency import QUESTIONS
+
+# Questions each worker process answers at the same time
+CONCURRENCY_PER_WORKER = 8
+
+
+async def _serve(worker_id: int, tasks: multiprocessing.Queue, done: multiprocessing.Queue) -> None:
+    from chainlit.context import init_http_context
+    from frontend import config, create_session_chain, load_session, session_store
+
+    async def consume() -> None:
+        init_http_context()
+        loop = asyncio.get_running_loop()
+        while True:
+            task = await loop.run_in_executor(None, tasks.get)
+            if task is None:
+                return
+            session_id, question = task
+            start = time.perf_counter()
+            state = await load_session(session_id)
+            answer = ""
+            async for chunk in create_session_chain(state).astream(question):
+                answer += chunk
+            state.add_turn(question, answer, config.MEMORY_WINDOW_TURNS)
+            await session_store.save(session_id, state)
+            done.put((session_id, worker_id, time.perf_counter() - start))
+
+    await asyncio.gather(*[consume() for _ in range(CONCURRENCY_PER_WORKER)])
+
+
+def _worker(worker_id: int, tasks: multiprocessing.Queue, done: multiprocessing.Queue) -> None:
+    asyncio.run(_serve(worker_id, tasks, done))
+
+
+def run_round(workers: int, sessions: int, rounds: int) -> dict[str, float]:
+    context = multiprocessing.get_context("spawn")
+    tasks, done = context.Queue(), context.Queue()
+    processes = [
+        context.Process(target=_worker, args=(i, tasks, done)) for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    # Warm up every worker: imports, pools, the image workers
+    for _ in range(workers * CONCURRENCY_PER_WORKER):
+        tasks.put((f"warmup-{uuid.uuid4()}", QUESTIONS[0]))
+    for _ in range(workers * CONCURRENCY_PER_WORKER):
+        done.get()
+
+    run_id = uuid.uuid4().hex
+    asked = {f"{run_id}-{i}": 0 for i in range(sessions)}
+    last_worker: dict[str, int] = {}
+    moved = 0
+    start = time.perf_counter()
+    for i, session_id in enumerate(asked):
+        tasks.put((session_id, QUESTIONS[i % len(QUESTIONS)]))
+    for _ in range(sessions * rounds):
+        try:
+            session_id, worker_id, _ = done.get(timeout=600)
+        except queue.Empty:
+            raise RuntimeError("Workers stopped answering") from None
+        if last_worker.get(session_id, worker_id) != worker_id:
+            moved += 1
+        last_worker[session_id] = worker_id
+        asked[session_id] += 1
+        if asked[session_id] < rounds:
+            i = int(session_id.rsplit("-", 1)[1]) + asked[session_id]
+            tasks.put((session_id, QUESTIONS[i % len(QUESTIONS)]))
+    elapsed = time.perf_counter() - start
+
+    for _ in range(workers * CONCURRENCY_PER_WORKER):
+        tasks.put(None)
+    for process in processes:
+        process.join()
+    follow_ups = sessions * (rounds - 1)
+    return {
+        "turns_per_second": sessions * rounds / elapsed,
+        "moved_turns_share": moved / follow_ups if follow_ups else 0.0,
+    }
+
+
+def run_benchmark(worker_counts: list[int], sessions: int, rounds: int) -> dict[str, float]:
+    metrics: dict[str, float] = {}
+    for workers in worker_counts:
+        result = run_round(workers, sessions, rounds)
+        metrics.update({f"w{workers}.{key}": value for key, value in result.items()})
+        logger.info(
+            f"{workers} workers: {result['turns_per_second']:.2f} turns/s, "
+            f"{result['moved_turns_share']:.0%} of follow-up turns served by another worker"
+        )
+    base = metrics[f"w{worker_counts[0]}.turns_per_second"]
+    for workers in worker_counts[1:]:
+        metrics[f"w{workers}.speedup"] = metrics[f"w{workers}.turns_per_second"] / base
+        logger.info(f"{workers} workers: {metrics[f'w{workers}.speedup']:.2f}x")
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--sessions", type=int, default=40)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--json", type=Path, help="Write the metrics to this file")
+    args = parser.parse_args()
+    metrics = run_benchmark(args.workers, args.sessions, args.rounds)
+    if args.json:
+        args.json.write_text(json.dumps(metrics, indent=2))
@@ -1,24 +1,56 @@
+import asyncio
+import importlib
+import json
+import multiprocessing
+import time
+from collections.abc import AsyncIterator
+from concurrent.futures import ProcessPoolExecutor
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from operator import itemgetter
+from typing import TYPE_CHECKING
 
 import chainlit as cl
 import redis
-from _config import Config
-from _utils import is_image_data, looks_like_base64, resize_base64_image, get_image_dimensions, get_image_format
+import redis.asyncio
+from _cache import QueryEmbeddingCache
+from _coalesce import StreamSingleFlight, normalize_question
+from _config import Config, logger
+from _llm import get_chat_model
+from _metrics import SINGLE_FLIGHT, TOKENS, start_metrics_server
+from _prompt import ImagePolicy, PromptBuilder
+from _ratelimit import get_rate_limiter
+from _resources import LazyResource, run_checks
+from _sessions import RedisSessionStore, SessionState
+from _stores import AsyncRedisStore
+from _tracing import log_trace, record_span, span, start_trace
+from _utils import is_image_data, looks_like_base64, prepare_image
 from chainlit.element import Element
-from chainlit.input_widget import InputWidget, Slider
-from langchain.memory import ConversationBufferMemory
-from langchain.retrievers import MultiVectorRetriever
-from langchain.schema.output_parser import StrOutputParser
-from langchain.schema.runnable import RunnableSerializable
-from langchain.schema.runnable.config import RunnableConfig
-from langchain_community.storage import RedisStore
-from langchain_community.vectorstores import PGVector
+from chainlit.input_widget import InputWidget, Select, Slider, Switch
+from chainlit.server import app
+from common.cache import SemanticCache
+from common.embeddings import RateLimitedEmbeddings
+from common.ratelimit import RateLimitExceeded
+from fastapi.responses import JSONResponse
 from langchain_core.documents.base import Document
 from langchain_core.messages import HumanMessage
-from langchain_core.runnables import RunnableLambda, RunnablePassthrough
-from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import (
+    RunnableConfig,
+    RunnableLambda,
+    RunnablePassthrough,
+    RunnableSerializable,
+)
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+if TYPE_CHECKING:
+    from langchain.memory import ConversationBufferWindowMemory
+    from langchain.retrievers import MultiVectorRetriever
+    from langchain_community.vectorstores.pgvector import PGVector
 
 config = Config()
+start_metrics_server()
 
 
 widgets: list[InputWidget] = [
@@ -42,19 +74,80 @@ widgets: list[InputWidget] = [
         tooltip="Set the number of documents to retrieve for each query.",
         description="A higher number will retrieve more documents, but may slow down response times and make the output more complex.",
     ),
+    Switch(
+        id="Hybrid_Search",
+        label="Hybrid Search",
+        initial=True,
+        tooltip="Combine vector similarity with full-text search.",
+        description="Full-text search helps with exact terms such as route names or booking codes, so fewer documents need to be retrieved.",
+    ),
 ]
 
-embeddings = AzureOpenAIEmbeddings(
-    model="text-embedding-ada-002",
-    api_key=config.OAI_API_KEY,
-    azure_endpoint=config.OAI_ENDPOINT,
-    api_version="2024-06-01",
-)
 
-vectorstore = PGVector(
-    connection_string=f"postgresql://{config.POSTGRES_USER}:{config.POSTGRES_PASSWORD}@{config.POSTGRES_HOST}:{config.POSTGRES_PORT}/{config.POSTGRES_DB}",
-    embedding_function=embeddings,
-    collection_name="knowledge_base",
+# Settings that restrict the retrieval to documents with one metadata value, by setting id:
+# the metadata key and the label. Their options are the values in the knowledge base.
+# An image deduplicated across files is indexed once, under the first file it was found in,
+# so filtering by another file that contains it does not retrieve it
+FILTER_SETTINGS = {
+    "Source_File": ("file_name", "Source File"),
+    "Element_Type": ("type", "Element Type"),
+    "Ingestion_Version": ("ingestion_version", "Ingestion Version"),
+}
+# Option of the filter settings that does not restrict the retrieval
+ALL = "All"
+
+KNOWLEDGE_VERSION_QUERY = """
+SELECT version FROM knowledge_version WHERE namespace = :namespace
+"""
+
+FILTER_OPTIONS_QUERY = """
+SELECT DISTINCT e.cmetadata ->> 'file_name' AS file_name,
+                e.cmetadata ->> 'type' AS type,
+                e.cmetadata ->> 'ingestion_version' AS ingestion_version
+FROM langchain_pg_embedding e
+JOIN langchain_pg_collection c ON e.collection_id = c.uuid
+WHERE c.name = :collection_name
+"""
+
+
+def _create_embeddings() -> QueryEmbeddingCache:
+    # langchain_openai takes a second to import, the workers start without it
+    from langchain_openai import AzureOpenAIEmbeddings
+
+    return QueryEmbeddingCache(
+        RateLimitedEmbeddings(
+            AzureOpenAIEmbeddings(
+                model="text-embedding-ada-002",
+                api_key=config.OAI_API_KEY,
+                azure_endpoint=config.OAI_ENDPOINT,
+                api_version="2024-06-01",
+            ),
+            get_rate_limiter(),
+        )
+    )
+
+
+def _create_vectorstore() -> "PGVector":
+    # PGVector connects and creates the extension and collection when constructed
+    from langchain_community.vectorstores.pgvector import PGVector
+
+    return PGVector(
+        connection_string=f"postgresql://{config.POSTGRES_USER}:{config.POSTGRES_PASSWORD}@{config.POSTGRES_HOST}:{config.POSTGRES_PORT}/{config.POSTGRES_DB}",
+        embedding_function=embeddings.get(),
+        collection_name="knowledge_base",
+    )
+
+
+# Created on first use, the readiness probe creates them before the first message does
+embeddings = LazyResource("embeddings", _create_embeddings)
+vectorstore = LazyResource("vectorstore", _create_vectorstore)
+
+# Shared connection pool for the async vector search of all sessions, connects on first use
+async_engine = create_async_engine(
+    f"postgresql+asyncpg://{config.POSTGRES_USER}:{config.POSTGRES_PASSWORD}@{config.POSTGRES_HOST}:{config.POSTGRES_PORT}/{config.POSTGRES_DB}",
+    pool_size=config.POSTGRES_POOL_SIZE,
+    max_overflow=config.POSTGRES_POOL_SIZE,
+    pool_pre_ping=True,
 )
 # Initialize the storage layer
 id_key = "document_id"
@@ -62,114 +155,324 @@ id_key = "document_id"
 redis_url = config.REDIS_URL
 redis_host, redis_port = redis_url.split("redis://")[1].split(":")
 redis_client = redis.StrictRedis(host=redis_host, port=redis_port, decode_responses=True)
+async_redis_client = redis.asyncio.Redis(
+    connection_pool=redis.asyncio.ConnectionPool.from_url(
+        redis_url, max_connections=config.REDIS_POOL_SIZE, decode_responses=True
+    )
+)
 
-docstore = RedisStore(client=redis_client, namespace="multimodalrag")
+docstore = AsyncRedisStore(
+    client=redis_client, async_client=async_redis_client, namespace="multimodalrag"
+)
 
+# Conversations are kept in Redis, not in the process, so any worker can serve any message
+session_store = RedisSessionStore(
+    redis.asyncio.Redis(
+        connection_pool=redis.asyncio.ConnectionPool.from_url(
+            redis_url,
+            db=config.SESSION_REDIS_DB,
+            max_connections=config.REDIS_POOL_SIZE,
+            decode_responses=True,
+        )
+    ),
+    ttl_seconds=config.SESSION_TTL_SECONDS,
+)
 
-def split_image_text_types(docs: list[Document]) -> dict[str, list]:
+# Image decoding and resizing is CPU-bound, it runs in worker processes off the event loop
+image_pool = ProcessPoolExecutor(
+    max_workers=config.IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+)
+
+prompt_builder = PromptBuilder(
+    max_tokens=config.PROMPT_MAX_TOKENS,
+    image_policy=ImagePolicy(
+        high_detail_ranks=config.IMAGE_HIGH_DETAIL_RANKS,
+        attach_ranks=config.IMAGE_ATTACH_RANKS,
+        max_image_tokens=config.IMAGE_MAX_TOKENS,
+    ),
+)
+
+# Answers to first questions of a conversation are cached, follow-ups depend on the history
+answer_cache = SemanticCache(
+    {
+        "dbname": config.POSTGRES_DB,
+        "user": config.POSTGRES_USER,
+        "password": config.POSTGRES_PASSWORD,
+        "host": config.POSTGRES_HOST,
+        "port": config.POSTGRES_PORT,
+    },
+    namespace="multimodalrag",
+    similarity_threshold=0.95,
+    pool_size=config.POSTGRES_POOL_SIZE,
+)
+
+
+async def _check_postgres() -> None:
+    async with async_engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+
+
+def _import_chain_modules() -> None:
+    """Import the retriever and memory modules the session chains are built from."""
+    for module in ("_retrievers", "langchain.memory"):
+        importlib.import_module(module)
+
+
+async def check_readiness() -> dict[str, str]:
+    """Health of each dependency, creating the lazy ones so the first message does not."""
+    return await run_checks(
+        {
+            "postgres": _check_postgres,
+            "redis": async_redis_client.ping,
+            "sessions": session_store.client.ping,
+            "embeddings": embeddings.aget,
+            "vectorstore": vectorstore.aget,
+            "chat_model": lambda: asyncio.to_thread(get_chat_model, "gpt-4o"),
+            "chain_modules": lambda: asyncio.to_thread(_import_chain_modules),
+        },
+        timeout=config.READINESS_TIMEOUT_SECONDS,
+    )
+
+
+@app.get("/ready")
+async def ready() -> JSONResponse:
+    checks = await check_readiness()
+    is_ready = all(result == "ok" for result in checks.values())
+    return JSONResponse({"ready": is_ready, "checks": checks}, status_code=200 if is_ready else 503)
+
+
+# Chainlit serves its UI on a catch-all route, the probe has to be matched before it
+_ready_route = next(route for route in app.router.routes if getattr(route, "path", None) == "/ready")
+app.router.routes.remove(_ready_route)
+app.router.routes.insert(0, _ready_route)
+
+
+# Options of the filter settings, None until read, and the metadata version they were read
+# at. data_load bumps that version once per ingestion run, not after every indexed batch
+_filter_options: tuple[str | None, dict[str, list[str]] | None] = (None, None)
+
+
+async def load_filter_options() -> dict[str, list[str]]:
+    """Values of each filtered metadata key, read again after every ingestion run."""
+    global _filter_options
+    try:
+        async with async_engine.connect() as conn:
+            version = (
+                await conn.execute(
+                    text(KNOWLEDGE_VERSION_QUERY), {"namespace": "multimodalrag/metadata"}
+                )
+            ).scalar()
+            if _filter_options[1] is None or version != _filter_options[0]:
+                rows = (
+                    await conn.execute(
+                        text(FILTER_OPTIONS_QUERY), {"collection_name": "knowledge_base"}
+                    )
+                ).fetchall()
+                options = {
+                    key: sorted({getattr(row, key) for row in rows} - {None})
+                    for key, _ in FILTER_SETTINGS.values()
+                }
+                _filter_options = (version, options)
+    except Exception as e:
+        # Nothing ingested yet or Postgres unavailable, the filters only offer All
+        logger.warning(f"Could not load the metadata filter options: {e}")
+    return _filter_options[1] or {}
+
+
+async def create_filter_widgets() -> list[InputWidget]:
+    options = await load_filter_options()
+    return [
+        Select(
+            id=setting,
+            label=label,
+            values=[ALL, *options.get(key, [])],
+            initial_value=ALL,
+            tooltip=f"Only retrieve documents with this {label.lower()}.",
+        )
+        for setting, (key, label) in FILTER_SETTINGS.items()
+    ]
+
+
+def metadata_filter(settings: dict) -> dict[str, list[str]]:
+    """Metadata filter of the retriever for the filter settings that are not All."""
+    return {
+        key: [settings[setting]]
+        for setting, (key, _) in FILTER_SETTINGS.items()
+        if settings.get(setting, ALL) != ALL
+    }
+
+
+def create_retriever(settings: dict) -> "MultiVectorRetriever":
     """
-    Split base64-encoded images and texts
+    Create the multi-vector retriever for the given chat settings
+    """
+    # langchain.retrievers takes a second to import, the workers start without it
+    from _retrievers import DocumentIdMultiVectorRetriever, HybridMultiVectorRetriever
+
+    retriever_cls = (
+        HybridMultiVectorRetriever
+        if settings.get("Hybrid_Search", True)
+        else DocumentIdMultiVectorRetriever
+    )
+    return retriever_cls(
+        vectorstore=vectorstore.get(),
+        docstore=docstore,
+        async_engine=async_engine,
+        id_key=id_key,
+        search_kwargs={
+            "k": int(settings["Num_Documents_To_Retrieve"]),
+        },
+        metadata_filter=metadata_filter(settings),
+    )
+
+
+@dataclass
+class RetrievedContext:
+    """What the answer to the current message was based on, dropped after the message."""
+
+    # Resized image bytes to display with the answer
+    images: list[bytes] = field(default_factory=list)
+    texts: list[dict] = field(default_factory=list)
+    doc_ids: list[str] = field(default_factory=list)
+
+
+# Set by handle_new_message, the chain records the retrieved documents in it
+_retrieved: ContextVar[RetrievedContext | None] = ContextVar("retrieved", default=None)
+
+# First questions only depend on the question and the settings, identical ones asked at
+# the same time share one streamed completion and what it was based on
+answer_flight: StreamSingleFlight[RetrievedContext] = StreamSingleFlight()
+
+
+def answer_key(question: str, settings: dict) -> tuple[str, str]:
+    return normalize_question(question), json.dumps(settings, sort_keys=True)
+
+
+def _doc_content_and_metadata(doc: Document | str) -> tuple[str, dict]:
+    # Check if the document is of type Document and extract page_content if so
+    if isinstance(doc, Document):
+        return doc.page_content, doc.metadata
+    return doc, {}
+
+
+def _is_image(doc_content: str) -> bool:
+    return looks_like_base64(doc_content) and is_image_data(doc_content)
+
+
+def _collect_images_and_texts(docs: list[Document], prepared_images: list[dict]) -> dict[str, list]:
+    """
+    Split documents into images and texts, given the prepared images in document order,
+    and record what was retrieved for the current message
     """
     b64_images = []
     unique_images = set()  # Set to track unique images
     texts = []
     unique_texts = set()  # Set to track unique texts
-    for doc in docs:
-        # Check if the document is of type Document and extract page_content if so
-        if isinstance(doc, Document):
-            doc_content = doc.page_content
-            doc_metadata = doc.metadata
-        else:
-            doc_content = doc
-            doc_metadata = {}
-
-        if looks_like_base64(doc_content) and is_image_data(doc_content):
-            # Check the dimensions of the image
-            width, height = get_image_dimensions(doc_content)
-            buf = None  # Initialize buf to None
-            if width > 512 or height > 512:
-                buf, doc_content = resize_base64_image(doc_content, size=(512, 512))
+    doc_ids = []
+    retrieved = _retrieved.get()
+    prepared = iter(prepared_images)
+    for rank, doc in enumerate(docs):
+        doc_content, doc_metadata = _doc_content_and_metadata(doc)
+        if id_key in doc_metadata:
+            doc_ids.append(doc_metadata[id_key])
+
+        if _is_image(doc_content):
+            image = next(prepared)
+            buf = image.pop("buf")
+            # The image policy decides by rank whether to send the image or its summary
+            image["rank"] = rank
+            image["summary"] = doc_metadata.get("summary")
 
             # Add the image to the list if it's not a duplicate
-            if doc_content not in unique_images:
-                unique_images.add(doc_content)
-                image_format = get_image_format(doc_content)
-                b64_images.append({"content": doc_content, "format": image_format})
-                images = cl.user_session.get("retrieved_images")
-                if images:
-                    if buf:
-                        images.append(buf)
-                    cl.user_session.set("retrieved_images", images)
-                else:
-                    if buf:
-                        cl.user_session.set("retrieved_images", [buf])
+            if image["content"] not in unique_images:
+                unique_images.add(image["content"])
+                b64_images.append(image)
+                if retrieved is not None and buf:
+                    retrieved.images.append(buf)
         else:
             # Add the text to the list if it's not a duplicate
             if doc_content not in unique_texts:
                 unique_texts.add(doc_content)
                 texts.append({"content": doc_content, "metadata": doc_metadata})
-                stored_texts = cl.user_session.get("retrieved_texts")
-                if stored_texts:
-                    stored_texts.append({"content": doc_content, "metadata": doc_metadata})
-                    cl.user_session.set("retrieved_texts", stored_texts)
-                else:
-                    cl.user_session.set(
-                        "retrieved_texts", [{"content": doc_content, "metadata": doc_metadata}]
-                    )
+                if retrieved is not None:
+                    retrieved.texts.append({"content": doc_content, "metadata": doc_metadata})
+    if retrieved is not None:
+        retrieved.doc_ids = doc_ids
     return {"images": b64_images, "texts": texts}
 
 
-def img_prompt_func(data_dict: dict) -> list[HumanMessage]:
-    content = []
+def split_image_text_types(docs: list[Document]) -> dict[str, list]:
+    """
+    Split base64-encoded images and texts
+    """
+    with span("image_prep"):
+        image_contents = [c for c, _ in map(_doc_content_and_metadata, docs) if _is_image(c)]
+        prepared_images = [prepare_image(content) for content in image_contents]
+        return _collect_images_and_texts(docs, prepared_images)
 
-    # Add text content
-    content.append({
-        "type": "text",
-        "text": (
-            "You are an assistant for a company called DFDS.\n"
-            f"Chat History: {data_dict['history']}\n"
-            f"User-provided question: {data_dict['question']}\n"
-            f"Text and tables:\n{''.join([text['content'] for text in data_dict['context']['texts']])}"
+
+async def asplit_image_text_types(docs: list[Document]) -> dict[str, list]:
+    """
+    Split base64-encoded images and texts, decoding and resizing the images in the
+    image worker pool so they do not block the event loop
+    """
+    with span("image_prep"):
+        image_contents = [c for c, _ in map(_doc_content_and_metadata, docs) if _is_image(c)]
+        loop = asyncio.get_running_loop()
+        prepared_images = await asyncio.gather(
+            *[
+                loop.run_in_executor(image_pool, prepare_image, content)
+                for content in image_contents
+            ]
         )
-    })
+        return _collect_images_and_texts(docs, list(prepared_images))
 
-    # Add images
-    for image in data_dict["context"]["images"]:
-        content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/{image['format']};base64,{image['content']}"
-            }
-        })
 
-    return [HumanMessage(content=content)]
+def img_prompt_func(data_dict: dict) -> tuple[list[HumanMessage], int]:
+    return prompt_builder.build_counted(
+        instructions="You are an assistant for a company called DFDS.",
+        question=data_dict["question"],
+        history=data_dict["history"],
+        texts=data_dict["context"]["texts"],
+        images=data_dict["context"]["images"],
+    )
 
 
 def multi_modal_rag_chain(
-    retriever: MultiVectorRetriever, temp: float = 0.0, max_tokens: int = 1024
+    retriever: "MultiVectorRetriever",
+    memory: "ConversationBufferWindowMemory",
+    temp: float = 0.0,
+    max_tokens: int = 2048,
 ) -> RunnableSerializable:
     """
     Multi-modal RAG chain
     """
 
-    # Multi-modal LLM
-    model = AzureChatOpenAI(
-        model="gpt-4o",
-        max_tokens=2048,
-        temperature=0,
-        azure_endpoint=config.OAI_ENDPOINT,
-        api_key=config.OAI_API_KEY,
-        streaming=True,
-    )
-    memory = cl.user_session.get("memory")  # type: ConversationBufferMemory
+    # Multi-modal LLM, shared by all sessions with this session's settings bound per request
+    model = get_chat_model("gpt-4o").bind(temperature=temp, max_tokens=max_tokens)
+    rate_limiter = get_rate_limiter()
+
+    # Azure charges the prompt plus max_tokens against the deployment's limit
+    def admit(prompt: tuple[list[HumanMessage], int]) -> list[HumanMessage]:
+        messages, prompt_tokens = prompt
+        rate_limiter.acquire("gpt-4o", prompt_tokens + max_tokens)
+        return messages
+
+    async def aadmit(prompt: tuple[list[HumanMessage], int]) -> list[HumanMessage]:
+        messages, prompt_tokens = prompt
+        await rate_limiter.aacquire("gpt-4o", prompt_tokens + max_tokens)
+        return messages
+
     # RAG pipeline
     chain: RunnableSerializable = (
         {
-            "context": retriever | RunnableLambda(split_image_text_types),
+            "context": retriever
+            | RunnableLambda(split_image_text_types, afunc=asplit_image_text_types),
             "question": RunnablePassthrough(),
             "history": RunnableLambda(memory.load_memory_variables) | itemgetter("history"),
         }
         | RunnableLambda(img_prompt_func)
+        | RunnableLambda(admit, afunc=aadmit)
         | model
         | StrOutputParser()
     )
@@ -177,30 +480,37 @@ def multi_modal_rag_chain(
     return chain
 
 
+def create_session_chain(state: SessionState) -> RunnableSerializable:
+    """
+    Chain for the next message of a session, built from its state on whichever worker
+    serves the message
+    """
+    memory = state.memory(config.MEMORY_WINDOW_TURNS)
+    retriever = create_retriever(state.settings)
+    return multi_modal_rag_chain(retriever, memory, float(state.settings.get("Temperature", 0.0)))
+
+
+async def load_session(session_id: str) -> SessionState:
+    """State of the session, a new one with the default settings if it expired."""
+    state = await session_store.load(session_id)
+    if state is None:
+        settings = {widget.id: widget.initial for widget in widgets}
+        state = SessionState(settings={**settings, **{setting: ALL for setting in FILTER_SETTINGS}})
+    return state
+
+
 @cl.on_chat_start
 async def setup() -> None:
     msg = cl.Message(content="Loading. `Please Wait`...")
-    settings = await cl.ChatSettings(widgets).send()
+    settings = await cl.ChatSettings(widgets + await create_filter_widgets()).send()
     await msg.send()
-    cl.user_session.set("settings", settings)
-    cl.user_session.set("memory", ConversationBufferMemory(return_messages=True))
-    # Create the multi-vector retriever
-    retriever = MultiVectorRetriever(
-        vectorstore=vectorstore,
-        docstore=docstore,
-        id_key=id_key,
-        search_kwargs={
-            "k": int(settings["Num_Documents_To_Retrieve"]),
-        },
-    )
-    runnable = multi_modal_rag_chain(retriever)
-    cl.user_session.set("runnable", runnable)
+    await session_store.save(cl.context.session.id, SessionState(settings=settings))
     # Add a welcome message with instructions on how to use the chatbot
     welcome_message = (
         "Hello\n"
         "Welcome to the RAG Chatbot Powered by the GPT-4o with Vision 🤖! "
         "Here's how you can interact with it:\n\n"
-        "1. Use the **sliders and switches** on the left to adjust the settings.\n"
+        "1. Use the **sliders, switches and filters** on the left to adjust the settings.\n"
         "2. Type your query in the **input box at the bottom**. This mode uses a multimodal RAG that includes tables and images, which are sent to gpt-4o for processing and response generation.\n"
         "3. The application will process your query and provide a response with the texts and images that were used to generate a response.\n\n"
         "Now, please type your query to start a conversation."
@@ -212,60 +522,136 @@ async def setup() -> None:
 
 @cl.on_settings_update
 async def change_settings(settings: dict) -> None:
-    settings = cl.user_session.get("settings")
-    retriever = MultiVectorRetriever(
-        vectorstore=vectorstore,
-        docstore=docstore,
-        id_key=id_key,
-        search_kwargs={
-            "k": int(settings["Num_Documents_To_Retrieve"]),
-        },
-    )
-    runnable = multi_modal_rag_chain(retriever, float(settings["Temperature"]))
-    cl.user_session.set("runnable", runnable)
+    state = await load_session(cl.context.session.id)
+    state.settings = settings
+    await session_store.save(cl.context.session.id, state)
+
+
+async def lookup_cached_answer(question: str) -> str | None:
+    """
+    Return a cached answer for the question and load the documents it was based on
+    into the session, as split_image_text_types does for a regular retrieval.
+    """
+    try:
+        with span("answer_cache_lookup"):
+            question_embedding = await (await embeddings.aget()).aembed_query(question)
+            cached = await cl.make_async(answer_cache.lookup)(question_embedding)
+        if cached is None:
+            return None
+        answer, doc_ids = cached
+        docs = await docstore.amget(doc_ids)
+        if any(doc is None for doc in docs):
+            return None
+        await asplit_image_text_types(docs)
+        return answer
+    except Exception as e:
+        logger.exception(f"Error while looking up in answer cache: {e}")
+        return None
+
+
+async def store_cached_answer(
+    question: str, answer: str, latency_seconds: float, doc_ids: list[str]
+) -> None:
+    if not doc_ids:
+        return
+    try:
+        question_embedding = await (await embeddings.aget()).aembed_query(question)
+        await cl.make_async(answer_cache.store)(
+            question, question_embedding, doc_ids, answer, latency_seconds
+        )
+    except Exception as e:
+        logger.exception(f"Error while storing in answer cache: {e}")
 
 
 @cl.on_message
 async def handle_new_message(message: cl.Message) -> None:
-    runnable = cl.user_session.get("runnable")  # type: RunnableLambda
-    memory = cl.user_session.get("memory")  # type: ConversationBufferMemory
-    cl.user_session.set("retrieved_images", None)
-    cl.user_session.set("retrieved_texts", None)
+    start = time.perf_counter()
+    session_id = cl.context.session.id
+    try:
+        await vectorstore.aget()
+    except Exception as e:
+        logger.exception(f"Knowledge base is not available: {e}")
+        await cl.Message(
+            content="The knowledge base is not available right now, please try again in a moment."
+        ).send()
+        return
+    state = await load_session(session_id)
+    runnable = create_session_chain(state)
+    retrieved = RetrievedContext()
+    _retrieved.set(retrieved)
+    first_question = not state.history
+    # Cached answers were not retrieved under the filter, filtered questions are answered
+    cacheable = first_question and not metadata_filter(state.settings)
+    trace = start_trace()
 
     res = cl.Message(content="")
 
-    async for chunk in runnable.astream(
-        message.content,
-        config=RunnableConfig(callbacks=[cl.LangchainCallbackHandler()]),
-    ):
-        await res.stream_token(chunk)
+    cached_answer = await lookup_cached_answer(message.content) if cacheable else None
+    if cached_answer is not None:
+        await res.stream_token(cached_answer)
+    else:
+
+        def produce() -> AsyncIterator[str]:
+            return runnable.astream(
+                message.content,
+                config=RunnableConfig(callbacks=[cl.LangchainCallbackHandler()]),
+            )
+
+        shared = False
+        if first_question:
+            chunks, leader_retrieved, shared = answer_flight.join(
+                answer_key(message.content, state.settings), produce, retrieved
+            )
+            SINGLE_FLIGHT.labels("answer", "shared" if shared else "leader").inc()
+        else:
+            chunks = produce()
+        first_token = True
+        try:
+            async for chunk in chunks:
+                if first_token:
+                    record_span("first_token", time.perf_counter() - start)
+                    first_token = False
+                await res.stream_token(chunk)
+        except RateLimitExceeded as e:
+            # Shed before the model was called, nothing was streamed yet
+            logger.warning(f"Message shed: {e}")
+            await cl.Message(
+                content="The assistant is very busy right now, please try again in a minute."
+            ).send()
+            return
+        if shared:
+            retrieved = leader_retrieved
+        else:
+            TOKENS.labels("gpt-4o", "completion").inc(prompt_builder.count_tokens(res.content))
+            if cacheable:
+                await store_cached_answer(
+                    message.content, res.content, time.perf_counter() - start, retrieved.doc_ids
+                )
 
     await res.send()
+    record_span("full_answer", time.perf_counter() - start)
+    log_trace(trace)
 
-    ret_images = cl.user_session.get("retrieved_images")
-    ret_texts = cl.user_session.get("retrieved_texts")
     elements: list[Element] = []
-    if ret_images:
-        for i, img in enumerate(ret_images):
-            elements.append(
-                cl.Image(
-                    content=img,
-                    name=f"Image {i + 1}",
-                    display="inline",
-                )
+    for i, img in enumerate(retrieved.images):
+        elements.append(
+            cl.Image(
+                content=img,
+                name=f"Image {i + 1}",
+                display="inline",
             )
-    if ret_texts:
-        for i, text in enumerate(ret_texts):
-            elements.append(
-                cl.Text(
-                    content=text["content"],
-                    name=f"Text {i + 1}",
-                    display="inline",
-                )
+        )
+    for i, text in enumerate(retrieved.texts):
+        elements.append(
+            cl.Text(
+                content=text["content"],
+                name=f"Text {i + 1}",
+                display="inline",
             )
+        )
     res.elements = elements
     await res.update()
 
-    memory.chat_memory.add_user_message(message.content)
-    memory.chat_memory.add_ai_message(res.content)
-    cl.user_session.set("memory", memory)
+    state.add_turn(message.content, res.content, config.MEMORY_WINDOW_TURNS)
+    state.retrieved_ids = retrieved.doc_ids
+    await session_store.save(session_id, state)
@@ -9,9 +9,12 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-E
         document_id varchar PRIMARY KEY,
         embedding vector(1536),
         additional_information jsonb,
-        text text
+        text text,
+        text_search tsvector GENERATED ALWAYS AS (to_tsvector('english', coalesce(text, ''))) STORED
     );
     CREATE INDEX ON public.knowledge_base USING ivfflat (embedding) WITH (lists = 100);
+    CREATE INDEX knowledge_base_text_search_idx ON public.knowledge_base USING gin (text_search);
+    CREATE INDEX knowledge_base_metadata_idx ON public.knowledge_base USING gin (additional_information jsonb_path_ops);
 EOSQL
 
 sleep 10